@@ -0,0 +1,178 @@
+import os
+import sys
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Timeouts in seconds. Vision models are slow, so the read timeout is generous.
+ANALYSIS_CONNECT_TIMEOUT = float(os.environ.get('ANALYSIS_CONNECT_TIMEOUT', 5))
+ANALYSIS_READ_TIMEOUT = float(os.environ.get('ANALYSIS_READ_TIMEOUT', 300))
+# Keep-alive connections kept per backend; should cover the batch concurrency
+ANALYSIS_POOL_SIZE = int(os.environ.get('ANALYSIS_POOL_SIZE', 16))
+
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
+
+
+class AnalysisBackend:
+    # A vision service that turns (model, prompt, base64 JPEG) into response text.
+    # Subclasses hold one long-lived, thread-safe client so connections are reused.
+    name = None
+    default_model = None
+
+    def analyze(self, model, prompt, base64_image):
+        raise NotImplementedError
+
+    def is_retryable(self, error):
+        return False
+
+    def configuration_error(self):
+        # Why the service cannot be used as configured, or None
+        return None
+
+
+class HTTPBackend(AnalysisBackend):
+    # Base for services spoken to over plain HTTP via a pooled requests.Session
+    def __init__(self, base_url, pool_size=ANALYSIS_POOL_SIZE,
+                 connect_timeout=ANALYSIS_CONNECT_TIMEOUT, read_timeout=ANALYSIS_READ_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Created on first use, like ClaudeBackend.client, so startup does not
+        # pay for importing requests
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def post(self, path, payload):
+        response = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def is_retryable(self, error):
+        # Rate limits, server errors and dropped connections are worth another
+        # try. Until requests is imported no error can have come from it.
+        requests = sys.modules.get('requests')
+        if requests is None:
+            return False
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code == 429 or error.response.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class OllamaBackend(HTTPBackend):
+    name = 'ollama'
+    default_model = 'llava'
+
+    def __init__(self, base_url=OLLAMA_URL, **kwargs):
+        super().__init__(base_url, **kwargs)
+
+    def analyze(self, model, prompt, base64_image):
+        payload = {
+            "model": model,
+            "stream": False,
+            "prompt": prompt,
+            "images": [base64_image]
+        }
+        return self.post('/api/generate', payload)['response']
+
+
+class ClaudeBackend(AnalysisBackend):
+    name = 'claude'
+    default_model = 'claude-3-5-sonnet-20240620'
+
+    def __init__(self, api_key, connect_timeout=ANALYSIS_CONNECT_TIMEOUT, read_timeout=ANALYSIS_READ_TIMEOUT):
+        self.api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Created on first use and shared by all threads; the SDK keeps a pool
+        # of keep-alive connections per client
+        if self._client is None:
+            if not self.api_key:
+                raise ValueError(self.configuration_error())
+            with self._lock:
+                if self._client is None:
+                    import anthropic
+                    self._client = anthropic.Anthropic(
+                        api_key=self.api_key,
+                        # Retries are handled by the caller so rate limiting stays in one place
+                        max_retries=0,
+                        timeout=anthropic.Timeout(self.read_timeout, connect=self.connect_timeout),
+                    )
+        return self._client
+
+    def analyze(self, model, prompt, base64_image):
+        response = self.client.messages.create(
+            model=model,
+            max_tokens=1024,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/jpeg",
+                                "data": base64_image
+                            }
+                        },
+                        {
+                            "type": "text",
+                            "text": prompt
+                        }
+                    ]
+                }
+            ]
+        )
+        return response.content[0].text
+
+    def configuration_error(self):
+        return None if self.api_key else "ANTHROPIC_API_KEY environment variable is not set"
+
+    def is_retryable(self, error):
+        anthropic = sys.modules.get('anthropic')
+        if anthropic is None:
+            return False
+        if isinstance(error, anthropic.APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, anthropic.APIConnectionError)
+
+
+_backends = {}
+
+def register_backend(backend):
+    # New vision services plug in here; routes look them up by name
+    _backends[backend.name] = backend
+    logger.info(f"Registered analysis backend: {backend.name}")
+    return backend
+
+def get_backend(name):
+    backend = _backends.get(name)
+    if backend is None:
+        raise ValueError(f"Invalid service specified: {name}")
+    return backend
+
+def backend_names():
+    return list(_backends)
+
+def is_retryable_error(error):
+    return any(backend.is_retryable(error) for backend in _backends.values())
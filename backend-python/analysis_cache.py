@@ -0,0 +1,148 @@
+import os
+import io
+import base64
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock the size limit holds per server process
+    fcntl = None
+
+from image_formats import open_image
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_IMAGE_SIZE = 1024
+ANALYSIS_CACHE_DIR = os.environ.get('ANALYSIS_CACHE_DIR', 'analysis_cache')
+# Prepared JPEGs are ~100-300 KB, so the default keeps a few thousand
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get('ANALYSIS_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Bytes held by the cache, shared by the server processes using it
+USAGE_FILE = 'usage'
+
+
+class PayloadCache:
+    # Disk cache of prepared analysis JPEGs keyed by content hash, evicting the
+    # least recently used entries once the total size passes max_bytes. The
+    # limit holds for every server process sharing the directory: the running
+    # total lives in USAGE_FILE, updated under flock, and eviction removes the
+    # files with the oldest mtimes, which reads bump.
+    def __init__(self, directory=ANALYSIS_CACHE_DIR, max_bytes=ANALYSIS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.jpg')
+
+    def scan(self):
+        # (mtime, path, size) of every entry, oldest first
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if not file.endswith('.jpg'):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+        return entries
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since it was read
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a partial file
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+
+        with self.lock, open(os.path.join(self.directory, USAGE_FILE), 'a+') as usage:
+            if fcntl:
+                fcntl.flock(usage, fcntl.LOCK_EX)
+            usage.seek(0)
+            try:
+                total = int(usage.read())
+            except ValueError:
+                # A new cache, or one from before the total was kept
+                total = sum(size for _, _, size in self.scan())
+            try:
+                total -= os.stat(path).st_size
+            except OSError:
+                pass
+            os.replace(temp_path, path)
+            total += len(data)
+            if total > self.max_bytes:
+                total = self.evict(keep=path)
+            usage.seek(0)
+            usage.truncate()
+            usage.write(str(total))
+
+    def evict(self, keep):
+        # Caller holds the usage lock. The total is recounted from the
+        # directory, which also corrects any drift. Returns the new total.
+        entries = self.scan()
+        total = sum(size for _, _, size in entries)
+        evicted = 0
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.debug(f"Evicted {evicted} entries from the analysis cache")
+        return total
+
+
+payload_cache = PayloadCache()
+
+def encode_analysis_image(file_path, max_size=ANALYSIS_IMAGE_SIZE):
+    # RAW files give the smallest embedded preview covering max_size
+    with open_image(file_path, size=max_size) as source:
+        img = source.image
+        # JPEGs decode straight at the nearest DCT scale at or above the target
+        img.draft('RGB', (max_size, max_size))
+        # Convert image to RGB if it's not
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        # Resize image if it's too large
+        if max(img.size) > max_size:
+            img.thumbnail((max_size, max_size))
+
+        buffered = io.BytesIO()
+        img.save(buffered, format="JPEG")
+        return buffered.getvalue()
+
+def prepare_image_for_analysis(file_path, image_hash=None, cache=payload_cache):
+    # The prepared image depends only on the content, so any service or model
+    # re-analyzing the same hash reuses it
+    data = cache.get(image_hash) if image_hash else None
+    if data is None:
+        data = encode_analysis_image(file_path)
+        if image_hash:
+            cache.put(image_hash, data)
+    return base64.b64encode(data).decode('utf-8')
@@ -0,0 +1,159 @@
+import os
+import time
+import random
+import logging
+import threading
+import concurrent.futures
+
+from db import create_connection
+from file_query import FilesQuery
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_CONCURRENCY = int(os.environ.get('ANALYSIS_CONCURRENCY', 4))
+# Provider quota; the token bucket refills at this rate and allows short bursts
+ANALYSIS_REQUESTS_PER_MINUTE = float(os.environ.get('ANALYSIS_REQUESTS_PER_MINUTE', 50))
+ANALYSIS_BURST = int(os.environ.get('ANALYSIS_BURST', 5))
+ANALYSIS_MAX_RETRIES = int(os.environ.get('ANALYSIS_MAX_RETRIES', 5))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cancel_event=None):
+        # Blocks until a token is available; returns False if cancelled while waiting
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if cancel_event and cancel_event.wait(wait):
+                return False
+            if not cancel_event:
+                time.sleep(wait)
+
+
+def retry_after(error):
+    # Honour a Retry-After header (in seconds) when the provider sends one
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def retry_with_backoff(fn, is_retryable, max_retries=ANALYSIS_MAX_RETRIES, cancel_event=None, on_retry=None):
+    # Exponential backoff with full jitter. Returns (result, attempts).
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return fn(), attempt
+        except Exception as e:
+            if attempt > max_retries or not is_retryable(e):
+                raise
+            delay = retry_after(e) or random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            logger.info(f"Retrying after {delay:.1f}s (attempt {attempt}): {e}")
+            if on_retry:
+                on_retry(e)
+            if cancel_event and cancel_event.wait(delay):
+                raise
+            if not cancel_event:
+                time.sleep(delay)
+
+
+def select_pending_images(options):
+    # One file per content hash that has no stored analysis yet; a row holding
+    # only labels added by hand has no description and still needs one
+    conditions = ['f.thumbnail_path IS NOT NULL', 'ia.description IS NULL']
+    params = []
+    if options.get('ids'):
+        ids = [int(image_id) for image_id in options['ids']]
+        conditions.append(f"f.id IN ({', '.join('?' for _ in ids)})")
+        params.extend(ids)
+    if options.get('filter'):
+        query = FilesQuery(options['filter'])
+        conditions.extend(query.conditions)
+        params.extend(query.params)
+
+    conn = create_connection()
+    try:
+        rows = conn.execute(f'''
+        SELECT f.hash, MIN(f.id) AS id, f.file_path
+        FROM files f
+        LEFT JOIN image_analysis ia ON f.hash = ia.hash
+        WHERE {' AND '.join(conditions)}
+        GROUP BY f.hash
+        ORDER BY MIN(f.id)
+        ''', params).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+
+def run_batch_analysis(job, analyze, is_retryable):
+    # analyze(image_hash, file_path, service, model) performs one remote call and stores the result
+    options = job.options
+    service, model = options['service'], options['model']
+    concurrency = max(1, int(options.get('concurrency') or ANALYSIS_CONCURRENCY))
+    per_minute = float(options.get('requests_per_minute') or ANALYSIS_REQUESTS_PER_MINUTE)
+    max_retries = int(options.get('max_retries', ANALYSIS_MAX_RETRIES))
+    bucket = TokenBucket(per_minute / 60, max(1, int(options.get('burst') or ANALYSIS_BURST)))
+
+    images = select_pending_images(options)
+    progress = {'done': 0, 'total': len(images), 'succeeded': 0, 'failed': 0, 'retries': 0}
+    lock = threading.Lock()
+    logger.info(f"Batch analysis of {len(images)} images with {service}/{model}, "
+                f"concurrency {concurrency}, {per_minute} requests/minute")
+
+    def count(key):
+        with lock:
+            progress[key] += 1
+
+    def analyze_one(image):
+        if job.is_cancelled():
+            return
+        job.record_item(image['hash'], 'running')
+
+        def attempt():
+            if not bucket.acquire(job.cancel_event):
+                raise InterruptedError("Job cancelled")
+            return analyze(image['hash'], image['file_path'], service, model)
+
+        try:
+            _, attempts = retry_with_backoff(attempt, is_retryable, max_retries, job.cancel_event,
+                                             on_retry=lambda error: count('retries'))
+            job.record_item(image['hash'], 'succeeded', attempts)
+            count('succeeded')
+        except Exception as e:
+            if job.is_cancelled():
+                job.record_item(image['hash'], 'cancelled')
+                return
+            logger.error(f"Analysis failed for {image['file_path']}: {e}")
+            job.record_item(image['hash'], 'failed', error=str(e))
+            count('failed')
+        finally:
+            with lock:
+                progress['done'] += 1
+                snapshot = dict(progress)
+            job.report(snapshot)
+
+    for image in images:
+        job.record_item(image['hash'], 'queued')
+    job.report(dict(progress))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in concurrent.futures.as_completed(
+                [executor.submit(analyze_one, image) for image in images]):
+            future.result()
+    job.report(dict(progress))
@@ -0,0 +1,638 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import platform
+import sqlite3
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+from PIL import Image, ImageDraw
+
+# Reproducible performance runs against a throwaway library:
+#
+#   python benchmark.py                                  # everything, defaults
+#   python benchmark.py --suites api --scales 10000,100000 --output after.json --compare before.json
+#
+# index     generates a synthetic image tree and times a full and a no-change index run
+# api       seeds synthetic rows and times the files, duplicates and search routes at each scale
+# analysis  runs a batch analysis job against a local stub of the Ollama API
+#
+# Trees and seeded databases are kept in the work directory and reused by later
+# runs with the same settings, so only the first run pays for building them.
+
+RESULTS_VERSION = 1
+SUITES = ('index', 'api', 'analysis')
+DEFAULT_WORK_DIR = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'revue-benchmark')
+DEFAULT_SCALES = (10000, 100000, 1000000)
+DEFAULT_FORMATS = 'jpeg=0.7,png=0.2,webp=0.1'
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp', 'gif': '.gif', 'bmp': '.bmp', 'tiff': '.tif'}
+FILES_PER_DIRECTORY = 200
+RSS_SAMPLE_INTERVAL = 0.05
+SEED_BATCH_SIZE = 5000
+# Share of seeded contents that carry an analysis row, and so are searchable
+# by description and filterable by tag
+ANALYZED_RATIO = 0.3
+# Relative change past which compare() reports a metric
+DEFAULT_THRESHOLD = 0.1
+
+WORDS = ('beach', 'sunset', 'mountain', 'forest', 'portrait', 'street', 'city', 'river', 'snow', 'desert',
+         'dog', 'cat', 'bird', 'flower', 'car', 'bridge', 'night', 'market', 'harbor', 'garden')
+CAMERAS = (('Canon', 'EOS R5'), ('Nikon', 'Z6'), ('Sony', 'A7 III'), ('Apple', 'iPhone 13'), (None, None))
+
+# Routes timed at every scale. The legacy duplicate route returns every
+# duplicate at once, so it is the slowest to run at large scales.
+ENDPOINTS = {
+    'files': '/api/v1/files?limit=100',
+    'files_sorted': '/api/v1/files?limit=100&sort=file_size&order=desc',
+    'files_cursor': '/api/v1/files?limit=100&cursor={middle_cursor}',
+    'files_tag': '/api/v1/files?limit=100&tags={word}',
+    'facets': '/api/v1/facets?facets=tags,categories',
+    'duplicates': '/api/v1/duplicates?limit=50',
+    'duplicates_legacy': '/api/v1/get-duplicate-files',
+    'search': '/api/v1/search?q={word}',
+    'search_filtered': '/api/v1/search?q={word}&format=.jpg&limit=20',
+}
+
+# Metrics compared between runs and whether a larger value is better
+HIGHER_IS_BETTER = ('files_per_sec', 'mb_per_sec', 'images_per_sec')
+LOWER_IS_BETTER = ('p50_ms', 'p90_ms', 'p99_ms', 'mean_ms', 'seconds', 'peak_rss_bytes')
+COMPARED_CONFIG = ('seed', 'duplicate_ratio', 'tree_files', 'formats', 'image_size', 'requests', 'warmup',
+                   'analysis_images', 'analysis_concurrency', 'stub_latency_ms')
+
+
+def parse_formats(text):
+    formats = {}
+    for part in text.split(','):
+        name, _, weight = part.strip().partition('=')
+        name = name.lower()
+        if name not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown format {name}; expected one of {', '.join(FORMAT_EXTENSIONS)}")
+        formats[name] = float(weight or 1)
+    if not formats or sum(formats.values()) <= 0:
+        raise ValueError("The format mix needs a positive weight")
+    return formats
+
+def percentile(sorted_values, fraction):
+    # Linear interpolation between the closest ranks
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def latency_stats(durations):
+    values = sorted(duration * 1000 for duration in durations)
+    return {
+        'requests': len(values),
+        'min_ms': round(values[0], 3),
+        'p50_ms': round(percentile(values, 0.5), 3),
+        'p90_ms': round(percentile(values, 0.9), 3),
+        'p99_ms': round(percentile(values, 0.99), 3),
+        'max_ms': round(values[-1], 3),
+        'mean_ms': round(sum(values) / len(values), 3),
+    }
+
+
+class RssSampler:
+    # Peak resident memory of this process and its children (the index image
+    # workers) while the block runs
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name='rss-sampler', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    # /api/generate with a fixed analysis after a fixed delay, standing in for
+    # a vision model so runs measure our side of the analysis path
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/api/generate':
+            self.send_error(404)
+            return
+        time.sleep(self.latency)
+        analysis = {
+            'description': 'A synthetic benchmark image of overlapping shapes',
+            'subjects': ['shapes'], 'colors': ['red', 'blue'], 'mood': ['calm'],
+            'composition': 'centered', 'text': [], 'tags': ['benchmark', 'synthetic'],
+            'categories': ['abstract'], 'quality': 'high', 'unique_features': [],
+        }
+        body = json.dumps({'response': json.dumps(analysis)}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_stub_ollama(latency):
+    handler = type('Handler', (StubOllamaHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-ollama', daemon=True).start()
+    return server
+
+
+def synthetic_image(rng, size):
+    # Random shapes on a random background: unique per file, and compresses
+    # about like a photo rather than like noise
+    img = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        box = (x0, y0, x0 + rng.randrange(1, width // 2), y0 + rng.randrange(1, height // 2))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)(box, fill=color)
+    return img
+
+def generate_tree(root, manifest_path, files, formats, duplicate_ratio, image_size, seed):
+    # Writes files images under root, FILES_PER_DIRECTORY to a directory. A
+    # duplicate_ratio share of them are byte copies of earlier images.
+    config = {'files': files, 'formats': formats, 'duplicate_ratio': duplicate_ratio,
+              'image_size': list(image_size), 'seed': seed}
+    if os.path.exists(manifest_path) and os.path.isdir(root):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['config'] == config:
+            return manifest
+    shutil.rmtree(root, ignore_errors=True)
+
+    print(f"Generating {files} images in {root}")
+    rng = random.Random(seed)
+    names, weights = list(formats), list(formats.values())
+    originals = []
+    total_bytes = 0
+    duplicates = 0
+    for i in range(files):
+        directory = os.path.join(root, f"{i // (FILES_PER_DIRECTORY * 50):03d}", f"{i // FILES_PER_DIRECTORY:05d}")
+        os.makedirs(directory, exist_ok=True)
+        if originals and rng.random() < duplicate_ratio:
+            source = rng.choice(originals)
+            path = os.path.join(directory, f"copy_{i:07d}{os.path.splitext(source)[1]}")
+            shutil.copyfile(source, path)
+            duplicates += 1
+        else:
+            fmt = rng.choices(names, weights)[0]
+            path = os.path.join(directory, f"img_{i:07d}{FORMAT_EXTENSIONS[fmt]}")
+            synthetic_image(rng, image_size).save(path, fmt.upper())
+            originals.append(path)
+        total_bytes += os.path.getsize(path)
+
+    manifest = {'config': config, 'files': files, 'bytes': total_bytes, 'duplicates': duplicates}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def use_database(path):
+    # Every module opens connections through db.create_connection, which reads
+    # DB_NAME on each call
+    import db
+    db.DB_NAME = path
+    db.create_table()
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def content_index(seed, i, duplicate_ratio):
+    # Row i holds the content of the first row in its chain of copies. Each row
+    # decides from its own seed, so any row range can be generated on its own.
+    while i > 0:
+        rng = random.Random(f"{seed}-{i}")
+        if rng.random() >= duplicate_ratio:
+            break
+        i = rng.randrange(i)
+    return i
+
+def synthetic_row(seed, i, duplicate_ratio):
+    content = content_index(seed, i, duplicate_ratio)
+    rng = random.Random(f"{seed}-content-{content}")
+    file_format = rng.choice(('.jpg', '.jpg', '.jpg', '.png', '.webp', '.heic'))
+    file_hash = hashlib.sha256(f"{seed}-{content}".encode()).hexdigest()
+    timestamp = 1262304000 + rng.randrange(15 * 365 * 86400)
+    date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+    camera_make, camera_model = rng.choice(CAMERAS)
+    row = {
+        'id': i + 1,
+        'file_name': f"IMG_{i:07d}{file_format}",
+        'file_path': f"/benchmark/library/{i // 100000:02d}/{i // 1000:04d}/IMG_{i:07d}{file_format}",
+        'file_size': rng.randrange(200 * 1024, 12 * 1024 * 1024),
+        'file_format': file_format,
+        'date_created': date,
+        'date_modified': date,
+        'hash': file_hash,
+        'thumbnail_path': f"thumbnails/{file_hash}.jpg",
+        'mtime_ns': timestamp * 1000000000,
+        'inode': i + 1,
+        'width': rng.choice((1920, 3024, 4000, 6000)),
+        'height': rng.choice((1080, 2268, 3000, 4000)),
+        'date_taken': date if camera_make else None,
+        'camera_make': camera_make,
+        'camera_model': camera_model,
+    }
+    analysis = None
+    if content == i and rng.random() < ANALYZED_RATIO:
+        words = rng.sample(WORDS, 4)
+        analysis = {
+            'hash': file_hash,
+            'description': f"A photo of a {words[0]} and a {words[1]} near the {words[2]}",
+            'subjects': json.dumps(words[:2]),
+            'colors': json.dumps(['blue', 'green']),
+            'tags': json.dumps(words),
+            'categories': json.dumps([rng.choice(('landscape', 'portrait', 'street', 'animals'))]),
+        }
+    return row, analysis
+
+def seed_rows(conn, seed, duplicate_ratio, rows):
+    # Grows the files table to rows synthetic rows; rows already present from
+    # an earlier run are kept since every row is generated the same way
+    existing = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    if existing >= rows:
+        return
+    print(f"Seeding rows {existing}..{rows}")
+    started = time.perf_counter()
+    for start in range(existing, rows, SEED_BATCH_SIZE):
+        generated = [synthetic_row(seed, i, duplicate_ratio) for i in range(start, min(start + SEED_BATCH_SIZE, rows))]
+        files = [row for row, _ in generated]
+        analyses = [analysis for _, analysis in generated if analysis]
+        with conn:
+            conn.executemany(f"INSERT INTO files ({', '.join(files[0])}) VALUES "
+                             f"({', '.join(':' + column for column in files[0])})", files)
+            if analyses:
+                conn.executemany(f"INSERT INTO image_analysis ({', '.join(analyses[0])}) VALUES "
+                                 f"({', '.join(':' + column for column in analyses[0])})", analyses)
+    conn.execute('ANALYZE')
+    print(f"Seeded {rows - existing} rows in {time.perf_counter() - started:.1f}s")
+
+
+def time_requests(client, url, requests, warmup):
+    # The first request is reported on its own as the cold one; warmup
+    # requests are not counted
+    def fetch():
+        started = time.perf_counter()
+        response = client.get(url)
+        body = response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}: {body[:200]!r}")
+        return elapsed, len(body)
+
+    cold, size = fetch()
+    for _ in range(warmup):
+        fetch()
+    durations = [fetch()[0] for _ in range(requests)]
+    return {'url': url, 'cold_ms': round(cold * 1000, 3), 'response_bytes': size, **latency_stats(durations)}
+
+def stage_breakdown(before, after):
+    # Seconds and runs of each stage between two Metrics.stage_totals() calls.
+    # Image stages run in parallel workers, so their seconds can add up to
+    # more than the wall time.
+    stages = {}
+    for stage, total in after.items():
+        count = total['count'] - before.get(stage, {}).get('count', 0)
+        if count:
+            seconds = total['seconds'] - before.get(stage, {}).get('seconds', 0.0)
+            stages[stage] = {'count': count, 'seconds': round(seconds, 3),
+                             'mean_ms': round(seconds / count * 1000, 3)}
+    return stages
+
+def run_index_suite(args, work_dir):
+    from indexer import index_directory
+    from metrics import metrics
+
+    tree = os.path.join(work_dir, 'tree')
+    manifest = generate_tree(tree, os.path.join(work_dir, 'tree-manifest.json'), args.tree_files,
+                             args.formats, args.duplicate_ratio, args.image_size, args.seed)
+    database = os.path.join(work_dir, 'index.db')
+    remove_database(database)
+    shutil.rmtree(os.path.join(work_dir, 'thumbnails'), ignore_errors=True)
+    use_database(database)
+
+    results = {'tree': manifest}
+    for name, incremental in (('full', False), ('rescan', True)):
+        print(f"Indexing {tree} ({name})")
+        stages = metrics.stage_totals()
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            stats = index_directory(tree, incremental=incremental)
+            seconds = time.perf_counter() - started
+        results[name] = {
+            'seconds': round(seconds, 3),
+            'files_per_sec': round(manifest['files'] / seconds, 1),
+            'mb_per_sec': round(manifest['bytes'] / seconds / (1024 * 1024), 2),
+            'peak_rss_bytes': rss.peak,
+            'stats': {key: value for key, value in stats.items() if isinstance(value, (int, float))},
+            'stages': stage_breakdown(stages, metrics.stage_totals()),
+        }
+    return results
+
+def scale_database(work_dir, args, scale):
+    # One database per scale, so each is timed at exactly its row count. A new
+    # one starts as a copy of the largest smaller one and is seeded from there.
+    def path(rows):
+        return os.path.join(work_dir, f"rows-s{args.seed}-d{args.duplicate_ratio}-n{rows}.db")
+
+    database = path(scale)
+    if not os.path.exists(database):
+        smaller = [rows for rows in args.scales if rows < scale and os.path.exists(path(rows))]
+        if smaller:
+            shutil.copyfile(path(max(smaller)), database)
+    use_database(database)
+    conn = sqlite3.connect(database)
+    try:
+        seed_rows(conn, args.seed, args.duplicate_ratio, scale)
+        # Folds the WAL back in so the file can be copied for the next scale
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    return database
+
+def run_api_suite(args, work_dir, client):
+    from file_query import encode_cursor
+
+    endpoints = {name: ENDPOINTS[name] for name in args.endpoints}
+    results = {}
+    for scale in sorted(args.scales):
+        scale_database(work_dir, args, scale)
+        print(f"Timing {len(endpoints)} routes at {scale} rows")
+        results[str(scale)] = {}
+        with RssSampler() as rss:
+            for i, (name, template) in enumerate(endpoints.items()):
+                url = template.format(word=WORDS[(i + scale) % len(WORDS)],
+                                      middle_cursor=encode_cursor(scale // 2, scale // 2))
+                results[str(scale)][name] = time_requests(client, url, args.requests, args.warmup)
+        results[str(scale)]['peak_rss_bytes'] = rss.peak
+    return results
+
+def run_analysis_suite(args, work_dir, client):
+    import db
+    from analysis_backends import OllamaBackend, register_backend
+
+    database = os.path.join(work_dir, 'index.db')
+    if db.DB_NAME != database:
+        # Analysis needs an indexed tree; index it untimed if the index suite
+        # did not just do so
+        if not os.path.exists(database):
+            run_index_suite(args, work_dir)
+        use_database(database)
+    conn = db.create_connection()
+    try:
+        with conn:
+            conn.execute('DELETE FROM image_analysis')
+        ids = [row[0] for row in conn.execute(
+            'SELECT MIN(id) FROM files WHERE thumbnail_path IS NOT NULL GROUP BY hash ORDER BY MIN(id) LIMIT ?',
+            (args.analysis_images,))]
+    finally:
+        conn.close()
+
+    stub = start_stub_ollama(args.stub_latency_ms / 1000)
+    register_backend(OllamaBackend(base_url=f"http://127.0.0.1:{stub.server_address[1]}"))
+    print(f"Analyzing {len(ids)} images, concurrency {args.analysis_concurrency}")
+    try:
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            response = client.post('/api/v1/analyze-images', json={
+                'service': 'ollama', 'ids': ids, 'concurrency': args.analysis_concurrency,
+                'requests_per_minute': 1e9, 'burst': args.analysis_concurrency,
+            })
+            if response.status_code != 202:
+                raise RuntimeError(f"Analysis job was not started: {response.get_json()}")
+            job_id = response.get_json()['job_id']
+            while True:
+                job = client.get(f'/api/v1/jobs/{job_id}').get_json()
+                if job['status'] not in ('queued', 'running'):
+                    break
+                time.sleep(0.05)
+            seconds = time.perf_counter() - started
+    finally:
+        stub.shutdown()
+        stub.server_close()
+
+    progress = job.get('progress') or {}
+    return {
+        'status': job['status'],
+        'images': len(ids),
+        'succeeded': progress.get('succeeded', 0),
+        'failed': progress.get('failed', 0),
+        'concurrency': args.analysis_concurrency,
+        'stub_latency_ms': args.stub_latency_ms,
+        'seconds': round(seconds, 3),
+        'images_per_sec': round(progress.get('succeeded', 0) / seconds, 2),
+        'peak_rss_bytes': rss.peak,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'memory_bytes': psutil.virtual_memory().total,
+        'sqlite': sqlite3.sqlite_version,
+        'revision': git_revision(),
+    }
+
+def flatten_metrics(results, prefix=''):
+    metrics = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            metrics.update(flatten_metrics(value, name))
+        elif isinstance(value, (int, float)) and key in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            metrics[name] = (key, value)
+    return metrics
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    # Metrics present in both runs that moved by more than threshold, as
+    # regressions and improvements
+    before = flatten_metrics(baseline['results'])
+    after = flatten_metrics(current['results'])
+    regressions, improvements = [], []
+    for name, (key, value) in after.items():
+        if name not in before or not before[name][1]:
+            continue
+        old = before[name][1]
+        change = (value - old) / old
+        worse = change < -threshold if key in HIGHER_IS_BETTER else change > threshold
+        better = change > threshold if key in HIGHER_IS_BETTER else change < -threshold
+        if worse or better:
+            (regressions if worse else improvements).append(
+                {'metric': name, 'before': old, 'after': value, 'change': round(change, 4)})
+    # Runs with different data or request counts are not like for like
+    config_changes = sorted(key for key in COMPARED_CONFIG
+                            if baseline.get('config', {}).get(key) != current['config'].get(key))
+    return {'threshold': threshold, 'config_changes': config_changes, 'regressions': regressions,
+            'improvements': improvements}
+
+
+def print_summary(results):
+    indexing = results.get('index')
+    if indexing:
+        for name in ('full', 'rescan'):
+            run = indexing[name]
+            print(f"index {name:<7} {run['files_per_sec']:>10} files/s {run['mb_per_sec']:>8} MB/s "
+                  f"{run['seconds']:>8}s  peak RSS {run['peak_rss_bytes'] / 2 ** 20:.0f} MB")
+            for stage, total in sorted(run['stages'].items(), key=lambda item: -item[1]['seconds']):
+                print(f"      {stage:<16} {total['seconds']:>8}s over {total['count']} runs")
+    for scale, routes in results.get('api', {}).items():
+        for name, stats in routes.items():
+            if isinstance(stats, dict):
+                print(f"{scale:>8} rows {name:<18} p50 {stats['p50_ms']:>9} ms  p90 {stats['p90_ms']:>9} ms  "
+                      f"p99 {stats['p99_ms']:>9} ms")
+    analysis = results.get('analysis')
+    if analysis:
+        print(f"analysis {analysis['images_per_sec']} images/s ({analysis['succeeded']}/{analysis['images']} "
+              f"succeeded in {analysis['seconds']}s)")
+
+def parse_args(argv):
+    def scales(text):
+        return [int(value) for value in text.split(',') if value.strip()]
+
+    def image_size(text):
+        width, _, height = text.lower().partition('x')
+        return int(width), int(height or width)
+
+    def formats(text):
+        try:
+            return parse_formats(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    def endpoints(text):
+        names = [name.strip() for name in text.split(',') if name.strip()]
+        unknown = [name for name in names if name not in ENDPOINTS]
+        if unknown:
+            raise argparse.ArgumentTypeError(f"Unknown endpoints: {', '.join(unknown)}")
+        return names
+
+    parser = argparse.ArgumentParser(description='Benchmark indexing, the file API and batch analysis')
+    parser.add_argument('--suites', default=','.join(SUITES), type=lambda text: text.split(','),
+                        help=f"comma separated subset of {', '.join(SUITES)}")
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR, help='where trees and databases are kept')
+    parser.add_argument('--output', help='results file (default: results-<time>.json in the work directory)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative change reported by --compare')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--tree-files', type=int, default=2000, help='images in the generated tree')
+    parser.add_argument('--formats', type=formats, default=parse_formats(DEFAULT_FORMATS),
+                        help=f"format mix of the tree, e.g. {DEFAULT_FORMATS}")
+    parser.add_argument('--image-size', type=image_size, default=(1024, 768), help='WIDTHxHEIGHT')
+    parser.add_argument('--scales', type=scales, default=list(DEFAULT_SCALES), help='row counts for the api suite')
+    parser.add_argument('--endpoints', type=endpoints, default=list(ENDPOINTS),
+                        help=f"routes timed by the api suite: {', '.join(ENDPOINTS)}")
+    parser.add_argument('--requests', type=int, default=30, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed requests per route after the cold one')
+    parser.add_argument('--analysis-images', type=int, default=200)
+    parser.add_argument('--analysis-concurrency', type=int, default=8)
+    parser.add_argument('--stub-latency-ms', type=float, default=50, help='delay of each stub Ollama response')
+    args = parser.parse_args(argv)
+    unknown = [suite for suite in args.suites if suite not in SUITES]
+    if unknown:
+        parser.error(f"Unknown suites: {', '.join(unknown)}")
+    if not 0 <= args.duplicate_ratio < 1:
+        parser.error('--duplicate-ratio must be in [0, 1)')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    output = os.path.abspath(args.output or os.path.join(work_dir, f"results-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    # Thumbnails and the default database are relative to the working directory
+    os.chdir(work_dir)
+    import server
+    logging.getLogger().setLevel(logging.WARNING)
+    client = server.app.test_client()
+
+    run = {'version': RESULTS_VERSION, 'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+           'environment': environment(),
+           # Round-tripped so it compares equal to a config read back from a results file
+           'config': json.loads(json.dumps({key: value for key, value in vars(args).items()
+                                            if key not in ('output', 'compare', 'work_dir')})),
+           'results': {}}
+    started = time.perf_counter()
+    if 'index' in args.suites:
+        run['results']['index'] = run_index_suite(args, work_dir)
+    if 'api' in args.suites:
+        run['results']['api'] = run_api_suite(args, work_dir, client)
+    if 'analysis' in args.suites:
+        run['results']['analysis'] = run_analysis_suite(args, work_dir, client)
+    run['seconds'] = round(time.perf_counter() - started, 3)
+
+    if baseline:
+        run['comparison'] = compare(baseline, run, args.threshold)
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+
+    print_summary(run['results'])
+    print(f"Results written to {output}")
+    if baseline:
+        if run['comparison']['config_changes']:
+            print(f"Settings differ from the baseline: {', '.join(run['comparison']['config_changes'])}")
+        for item in run['comparison']['regressions']:
+            print(f"REGRESSION {item['metric']}: {item['before']} -> {item['after']} ({item['change']:+.1%})")
+        for item in run['comparison']['improvements']:
+            print(f"improved   {item['metric']}: {item['before']} -> {item['after']} ({item['change']:+.1%})")
+        return 1 if run['comparison']['regressions'] else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
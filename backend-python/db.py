@@ -0,0 +1,501 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = 'imagedb.db'
+
+# Connection tuning. WAL lets the API keep reading while an index run writes.
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 64 * 1024))
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 30))
+
+# Connection pool, off unless enable_connection_pool is called (the production
+# server does). Each thread keeps up to DB_POOL_SIZE closed connections to hand
+# out again, so a request skips connecting and the PRAGMAs, and statements stay
+# prepared in sqlite3's per-connection cache of DB_STATEMENT_CACHE entries.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', 256))
+
+# Indexing writer: rows per executemany batch and seconds between commits
+WRITE_BATCH_SIZE = int(os.environ.get('DB_WRITE_BATCH_SIZE', 500))
+WRITE_COMMIT_INTERVAL = float(os.environ.get('DB_WRITE_COMMIT_INTERVAL', 2.0))
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_STATEMENT_CACHE)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    # Negative cache_size is in KiB rather than pages
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+class PooledConnection:
+    # What create_connection returns while pooling: the connection itself for
+    # everything but close(), which hands it back to the pool
+    def __init__(self, pool, path, conn):
+        self._pool = pool
+        self._path = path
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(self._path, conn)
+
+
+class ConnectionPool:
+    # Idle connections per thread and database path. sqlite3 connections stay
+    # on the thread that opened them, so threads never share one; nested
+    # create_connection calls on one thread each get their own.
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = size
+        self.local = threading.local()
+
+    def idle(self, path):
+        pools = self.local.__dict__.setdefault('pools', {})
+        return pools.setdefault(path, [])
+
+    def acquire(self, path):
+        idle = self.idle(path)
+        return PooledConnection(self, path, idle.pop() if idle else connect(path))
+
+    def release(self, path, conn):
+        try:
+            # As with close(), uncommitted changes are discarded
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken, or released from another thread; not worth keeping
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            return
+        idle = self.idle(path)
+        if len(idle) < self.size:
+            idle.append(conn)
+        else:
+            conn.close()
+
+
+_pool = None
+
+def enable_connection_pool(size=DB_POOL_SIZE):
+    global _pool
+    _pool = ConnectionPool(size) if size > 0 else None
+
+def create_connection():
+    if _pool is not None:
+        return _pool.acquire(DB_NAME)
+    return connect(DB_NAME)
+
+def create_table():
+    conn = create_connection()
+    cursor = conn.cursor()
+    
+    # Create files table (unchanged)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        file_path TEXT NOT NULL,
+        file_size INTEGER NOT NULL,
+        file_format TEXT NOT NULL,
+        date_created TEXT NOT NULL,
+        date_modified TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        thumbnail_path TEXT,
+        mtime_ns INTEGER,
+        inode INTEGER,
+        ahash INTEGER,
+        dhash INTEGER,
+        phash INTEGER,
+        width INTEGER,
+        height INTEGER,
+        date_taken TEXT,
+        camera_make TEXT,
+        camera_model TEXT,
+        gps_latitude REAL,
+        gps_longitude REAL
+    )
+    ''')
+
+    # Columns added after the first release; older databases lack them.
+    # mtime_ns and inode back the incremental stat cache, the hashes are
+    # perceptual hashes stored as signed 64-bit integers, and the rest are
+    # image properties read from the header and EXIF while indexing.
+    for column, column_type in (('mtime_ns', 'INTEGER'), ('inode', 'INTEGER'), ('ahash', 'INTEGER'),
+                                ('dhash', 'INTEGER'), ('phash', 'INTEGER'), ('width', 'INTEGER'),
+                                ('height', 'INTEGER'), ('date_taken', 'TEXT'), ('camera_make', 'TEXT'),
+                                ('camera_model', 'TEXT'), ('gps_latitude', 'REAL'), ('gps_longitude', 'REAL')):
+        try:
+            cursor.execute(f'ALTER TABLE files ADD COLUMN {column} {column_type}')
+        except sqlite3.OperationalError:
+            # Column already exists, ignore the error
+            pass
+
+    # One row per path. Older databases may hold repeated paths; keep the first
+    # row of each before the unique index is created.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='idx_files_file_path'")
+    if not cursor.fetchone():
+        cursor.execute('DELETE FROM files WHERE id NOT IN (SELECT MIN(id) FROM files GROUP BY file_path)')
+        cursor.execute('CREATE UNIQUE INDEX idx_files_file_path ON files (file_path)')
+    # Hash lookups, and duplicate grouping as an index-only scan
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_hash_file_size_inode ON files (hash, file_size, inode)')
+    cursor.execute('DROP INDEX IF EXISTS idx_files_hash')
+    # Sort and filter columns of /api/v1/files; the implicit rowid makes each
+    # of these a (column, id) keyset index
+    for column in ('file_name', 'file_size', 'file_format', 'date_created', 'date_modified',
+                   'width', 'height', 'date_taken', 'camera_make', 'camera_model'):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_files_{column} ON files ({column})')
+    # "Photos from this camera, by date" is answered from one index range
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_camera_model_date_taken ON files (camera_model, date_taken)')
+
+    # Check if image_analysis table exists
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='image_analysis'")
+    table_exists = cursor.fetchone()
+
+    if table_exists:
+        # Alter existing table
+        try:
+            cursor.execute('ALTER TABLE image_analysis RENAME COLUMN category TO categories')
+        except sqlite3.OperationalError:
+            # Column might already be renamed, ignore the error
+            pass
+    else:
+        # Create new table with updated schema
+        cursor.execute('''
+        CREATE TABLE image_analysis (
+            hash TEXT PRIMARY KEY,
+            description TEXT,
+            subjects TEXT,
+            colors TEXT,
+            mood TEXT,
+            composition TEXT,
+            visible_text TEXT,
+            tags TEXT,
+            categories TEXT,
+            quality TEXT,
+            unique_features TEXT
+        )
+        ''')
+
+    # Background jobs survive restarts so interrupted runs can be resumed
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        options TEXT NOT NULL,
+        progress TEXT,
+        errors TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        updated_at REAL
+    )
+    ''')
+    # process_owner() of the server process running the job (see jobs.py)
+    try:
+        cursor.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+    except sqlite3.OperationalError:
+        # Column already exists, ignore the error
+        pass
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+    # At most one queued or running embedding job per model, enforced by the
+    # insert itself so concurrent submissions cannot both start one
+    try:
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_embed_model ON jobs (kind, json_extract(options, '$.model'))
+        WHERE kind = 'embed' AND status IN ('queued', 'running')
+        ''')
+    except sqlite3.IntegrityError:
+        logger.warning("Several embedding jobs for one model are active; "
+                       "only one per model is enforced once they finish")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS job_items (
+        job_id TEXT NOT NULL,
+        item_key TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        updated_at REAL,
+        PRIMARY KEY (job_id, item_key)
+    )
+    ''')
+
+    # Row of each content hash's vector in an embedding model's matrix file
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS embeddings (
+        model TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        row INTEGER NOT NULL,
+        PRIMARY KEY (model, hash)
+    )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_embeddings_model_row ON embeddings (model, row)')
+
+    # Library roots kept current by the filesystem watcher
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS watch_roots (
+        path TEXT PRIMARY KEY,
+        created_at REAL NOT NULL
+    )
+    ''')
+
+    create_search_index(cursor)
+    create_label_index(cursor)
+
+    conn.commit()
+    conn.close()
+
+
+# Analysis list columns are JSON arrays; the search index holds them as plain text
+def _analysis_text(column):
+    return (f"CASE WHEN json_valid(ia.{column}) THEN (SELECT group_concat(value, ', ') FROM json_each(ia.{column})) "
+            f"ELSE ia.{column} END")
+
+SEARCH_COLUMNS = ('file_name', 'file_path', 'description', 'tags', 'subjects', 'categories', 'visible_text')
+_SEARCH_ANALYSIS_SQL = (f"ia.description, {_analysis_text('tags')}, {_analysis_text('subjects')}, "
+                        f"{_analysis_text('categories')}, {_analysis_text('visible_text')}")
+
+def create_search_index(cursor):
+    # FTS5 index with one row per file (rowid = files.id) holding its names and
+    # the analysis of its content. Triggers keep it in sync with files and
+    # image_analysis, so every writer (indexer, analysis, deletes) updates it.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='files_fts'")
+    exists = cursor.fetchone()
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5 (
+        {', '.join(SEARCH_COLUMNS)},
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    ''')
+
+    insert_for_file = f'''
+        INSERT INTO files_fts (rowid, {', '.join(SEARCH_COLUMNS)})
+        SELECT new.id, new.file_name, new.file_path, {_SEARCH_ANALYSIS_SQL}
+        FROM (SELECT 1) LEFT JOIN image_analysis ia ON ia.hash = new.hash;
+    '''
+    update_for_hash = f'''
+        UPDATE files_fts SET (description, tags, subjects, categories, visible_text) =
+            (SELECT {_SEARCH_ANALYSIS_SQL} FROM (SELECT 1) LEFT JOIN image_analysis ia ON ia.hash = {{hash}})
+        WHERE rowid IN (SELECT id FROM files WHERE hash = {{hash}});
+    '''
+    cursor.executescript(f'''
+    CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+        {insert_for_file}
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF file_name, file_path, hash ON files BEGIN
+        DELETE FROM files_fts WHERE rowid = old.id;
+        {insert_for_file}
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+        DELETE FROM files_fts WHERE rowid = old.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS image_analysis_fts_insert AFTER INSERT ON image_analysis BEGIN
+        {update_for_hash.format(hash='new.hash')}
+    END;
+    CREATE TRIGGER IF NOT EXISTS image_analysis_fts_update AFTER UPDATE ON image_analysis BEGIN
+        {update_for_hash.format(hash='old.hash')}
+        {update_for_hash.format(hash='new.hash')}
+    END;
+    CREATE TRIGGER IF NOT EXISTS image_analysis_fts_delete AFTER DELETE ON image_analysis BEGIN
+        {update_for_hash.format(hash='old.hash')}
+    END;
+    ''')
+
+    if not exists:
+        # Databases from before the search index: fill it once
+        cursor.execute(f'''
+        INSERT INTO files_fts (rowid, {', '.join(SEARCH_COLUMNS)})
+        SELECT f.id, f.file_name, f.file_path, {_SEARCH_ANALYSIS_SQL}
+        FROM files f LEFT JOIN image_analysis ia ON ia.hash = f.hash
+        ''')
+
+
+
+# Filter/facet name -> image_analysis JSON list column it is normalized from
+LABEL_KINDS = {
+    'tags': 'tags',
+    'categories': 'categories',
+    'colors': 'colors',
+    'moods': 'mood',
+    'subjects': 'subjects',
+}
+
+def _label_insert_sql(kind, column, row, source=''):
+    # Labels are lower-cased and trimmed so "Sunset " and "sunset" are one label
+    values = f"json_each(CASE WHEN json_valid({row}.{column}) THEN {row}.{column} ELSE '[]' END) j"
+    label = "lower(trim(j.value))"
+    condition = f"j.type = 'text' AND {label} != ''"
+    return f'''
+        INSERT OR IGNORE INTO labels (kind, value)
+        SELECT DISTINCT '{kind}', {label} FROM {source}{values} WHERE {condition};
+        INSERT OR IGNORE INTO hash_labels (label_id, hash)
+        SELECT l.id, {row}.hash FROM {source}{values}
+        JOIN labels l ON l.kind = '{kind}' AND l.value = {label}
+        WHERE {condition};
+    '''
+
+def create_label_index(cursor):
+    # Inverted index from each analysis label to the content hashes carrying
+    # it, kept in sync with image_analysis by triggers
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='labels'")
+    exists = cursor.fetchone()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS labels (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        UNIQUE (kind, value)
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS hash_labels (
+        label_id INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (label_id, hash)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hash_labels_hash ON hash_labels (hash, label_id)')
+
+    # The triggers rely on INSERT OR IGNORE, which the conflict handling of an
+    # upsert (INSERT ... ON CONFLICT DO UPDATE) on image_analysis would
+    # override; writers update, then insert, instead
+    inserts = ''.join(_label_insert_sql(kind, column, 'new') for kind, column in LABEL_KINDS.items())
+    cursor.executescript(f'''
+    CREATE TRIGGER IF NOT EXISTS image_analysis_labels_insert AFTER INSERT ON image_analysis BEGIN
+        {inserts}
+    END;
+    CREATE TRIGGER IF NOT EXISTS image_analysis_labels_update AFTER UPDATE ON image_analysis BEGIN
+        DELETE FROM hash_labels WHERE hash = old.hash;
+        {inserts}
+    END;
+    CREATE TRIGGER IF NOT EXISTS image_analysis_labels_delete AFTER DELETE ON image_analysis BEGIN
+        DELETE FROM hash_labels WHERE hash = old.hash;
+    END;
+    ''')
+
+    if not exists:
+        # Migrate labels out of the JSON columns of existing analyses
+        cursor.executescript(''.join(_label_insert_sql(kind, column, 'ia', 'image_analysis ia, ')
+                                     for kind, column in LABEL_KINDS.items()))
+
+FILE_COLUMNS = ('file_name', 'file_path', 'file_size', 'file_format', 'date_created',
+                'date_modified', 'hash', 'thumbnail_path', 'mtime_ns', 'inode',
+                'ahash', 'dhash', 'phash', 'width', 'height', 'date_taken', 'camera_make',
+                'camera_model', 'gps_latitude', 'gps_longitude')
+# Derived from decoding the image; shared by every row with the same content
+IMAGE_PROPERTY_COLUMNS = ('width', 'height', 'date_taken', 'camera_make', 'camera_model',
+                          'gps_latitude', 'gps_longitude')
+
+class BatchWriter:
+    # Buffers index writes and flushes them with executemany, committing every
+    # WRITE_COMMIT_INTERVAL seconds so readers see progress without paying a
+    # transaction per row.
+    def __init__(self, conn, batch_size=None, commit_interval=None, on_error=None):
+        self.conn = conn
+        self.batch_size = batch_size or WRITE_BATCH_SIZE
+        self.commit_interval = commit_interval if commit_interval is not None else WRITE_COMMIT_INTERVAL
+        self.on_error = on_error
+        self.inserts = []
+        # Updates are grouped by the set of columns they touch
+        self.updates = {}
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def insert(self, meta):
+        self.inserts.append(tuple(meta.get(column) for column in FILE_COLUMNS))
+        self.added()
+
+    def update(self, row_id, meta):
+        columns = tuple(column for column in FILE_COLUMNS if column in meta)
+        self.updates.setdefault(columns, []).append([meta[column] for column in columns] + [row_id])
+        self.added()
+
+    def added(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def insert_sql(self):
+        assignments = ', '.join(f"{column} = excluded.{column}" for column in FILE_COLUMNS)
+        return f'''
+        INSERT INTO files ({', '.join(FILE_COLUMNS)})
+        VALUES ({', '.join('?' for _ in FILE_COLUMNS)})
+        ON CONFLICT (file_path) DO UPDATE SET {assignments}
+        '''
+
+    def flush(self):
+        statements = []
+        if self.inserts:
+            statements.append((self.insert_sql(), self.inserts))
+        for columns, params in self.updates.items():
+            assignments = ', '.join(f"{column} = ?" for column in columns)
+            statements.append((f'UPDATE files SET {assignments} WHERE id = ?', params))
+        self.inserts = []
+        self.updates = {}
+        self.pending = 0
+
+        for sql, params in statements:
+            self.execute_batch(sql, params)
+
+        if time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+    def execute_batch(self, sql, params):
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN')
+        # A savepoint lets a failed batch roll back without losing the rows
+        # written since the last commit
+        self.conn.execute('SAVEPOINT batch')
+        try:
+            with metrics.stage('db_write'):
+                self.conn.executemany(sql, params)
+            metrics.inc('stage_rows_total', len(params), stage='db_write')
+            self.conn.execute('RELEASE batch')
+        except sqlite3.Error as e:
+            self.conn.execute('ROLLBACK TO batch')
+            self.conn.execute('RELEASE batch')
+            # Retry row by row so one bad row doesn't drop the whole batch
+            logger.error(f"Batch write failed, retrying rows individually: {e}")
+            for row in params:
+                try:
+                    self.conn.execute(sql, row)
+                except sqlite3.Error as row_error:
+                    logger.error(f"Failed to write row {row}: {row_error}")
+                    if self.on_error:
+                        self.on_error(row, row_error)
+
+    def commit(self):
+        with metrics.stage('db_commit'):
+            self.conn.commit()
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.commit()
+
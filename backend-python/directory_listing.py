@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from image_formats import CONTAINER_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+# A cached listing is reused while its directory's mtime is unchanged and it
+# is younger than the TTL; the TTL bounds how stale file sizes can get, since
+# rewriting a file does not touch its directory
+LISTING_CACHE_TTL = float(os.environ.get('LISTING_CACHE_TTL', 10.0))
+LISTING_CACHE_ENTRIES = int(os.environ.get('LISTING_CACHE_ENTRIES', 128))
+DEFAULT_LISTING_LIMIT = 1000
+MAX_LISTING_LIMIT = 10000
+# Entries read per subdirectory when counting its images; past this the count
+# is reported as a lower bound
+COUNT_MAX_ENTRIES = int(os.environ.get('LISTING_COUNT_MAX_ENTRIES', 10000))
+
+# Pillow formats, plus the RAW and HEIF files image_formats opens
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'} | CONTAINER_EXTENSIONS
+
+
+def is_image_name(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+def is_dir_entry(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+class Listing:
+    # One scan of a directory: DirEntry objects sorted directories first, then
+    # by name. DirEntry caches its stat, so files shown once are not stat'ed again.
+    def __init__(self, path, mtime_ns, entries):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.loaded_at = time.monotonic()
+        directories, files = [], []
+        for entry in entries:
+            (directories if is_dir_entry(entry) else files).append(entry)
+        self.directories = sorted(directories, key=lambda entry: entry.name.lower())
+        self.files = sorted(files, key=lambda entry: entry.name.lower())
+        self.image_count = sum(1 for entry in self.files if is_image_name(entry.name))
+
+
+class ImageCount:
+    def __init__(self, mtime_ns, count, truncated):
+        self.mtime_ns = mtime_ns
+        self.loaded_at = time.monotonic()
+        self.count = count
+        self.truncated = truncated
+
+
+class ListingCache:
+    # LRU of directory scans and subdirectory image counts. Each lookup costs
+    # one stat of the directory to compare its mtime.
+    def __init__(self, ttl=LISTING_CACHE_TTL, max_entries=LISTING_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, mtime_ns):
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is None or cached.mtime_ns != mtime_ns or time.monotonic() - cached.loaded_at > self.ttl:
+                return None
+            self.entries.move_to_end(key)
+            return cached
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def listing(self, path):
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self.get(('listing', path), mtime_ns)
+        if cached:
+            return cached
+        with os.scandir(path) as entries:
+            listing = Listing(path, mtime_ns, list(entries))
+        logger.debug(f"Scanned {path}: {len(listing.directories)} directories, {len(listing.files)} files")
+        return self.put(('listing', path), listing)
+
+    def image_count(self, path):
+        # Names only, so no per-file stat
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self.get(('count', path), mtime_ns)
+        if cached:
+            return cached
+        count = 0
+        seen = 0
+        truncated = False
+        with os.scandir(path) as entries:
+            for entry in entries:
+                seen += 1
+                if seen > COUNT_MAX_ENTRIES:
+                    truncated = True
+                    break
+                if is_image_name(entry.name) and not is_dir_entry(entry):
+                    count += 1
+        return self.put(('count', path), ImageCount(mtime_ns, count, truncated))
+
+
+listing_cache = ListingCache()
+
+def format_file(entry, lazy):
+    item = {"name": entry.name, "path": entry.path, "isDirectory": False, "isImage": is_image_name(entry.name)}
+    if not lazy:
+        try:
+            stat = entry.stat()
+            item["size"] = stat.st_size
+            item["lastModified"] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(stat.st_mtime))
+        except OSError:
+            item["size"] = None
+            item["lastModified"] = None
+    return item
+
+def format_directory(entry, counts, cache):
+    item = {"name": entry.name, "path": entry.path}
+    if counts:
+        try:
+            image_count = cache.image_count(entry.path)
+            item["imageCount"] = image_count.count
+            item["imageCountTruncated"] = image_count.truncated
+        except OSError:
+            item["imageCount"] = None
+    return item
+
+def list_directory(path, offset=0, limit=DEFAULT_LISTING_LIMIT, lazy=False, include_files=True, counts=False,
+                   cache=listing_cache):
+    # One page of a directory, directories first. Files on the page are stat'ed
+    # unless lazy; counts adds image counts for the page's subdirectories.
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_LISTING_LIMIT))
+    listing = cache.listing(path)
+    directory_count = len(listing.directories)
+    directories = listing.directories[offset:offset + limit]
+    files = []
+    if include_files:
+        file_offset = max(0, offset - directory_count)
+        files = listing.files[file_offset:file_offset + limit - len(directories)]
+    total = directory_count + (len(listing.files) if include_files else 0)
+    return {
+        "currentPath": path,
+        "parentPath": os.path.dirname(path) if os.path.dirname(path) != path else None,
+        "directories": [format_directory(entry, counts, cache) for entry in directories],
+        "files": [format_file(entry, lazy) for entry in files],
+        "totalDirectories": directory_count,
+        "totalFiles": len(listing.files),
+        "imageCount": listing.image_count,
+        "offset": offset,
+        "nextOffset": offset + limit if offset + limit < total else None,
+    }
@@ -0,0 +1,231 @@
+import os
+import time
+import shutil
+import logging
+
+from thumbnails import remove_thumbnails
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GROUP_LIMIT = 50
+MAX_GROUP_LIMIT = 500
+# Hashes per query when loading the files of a page of groups
+FILES_QUERY_BATCH = 500
+
+# Order of the group list; every sort ends with hash so pages are stable
+GROUP_SORTS = {
+    'wasted': 'wasted_bytes DESC, hash',
+    'copies': 'copies DESC, wasted_bytes DESC, hash',
+    'size': 'file_size DESC, hash',
+}
+KEEP_POLICIES = ('oldest', 'shortest_path', 'preferred_root')
+RESOLVE_ACTIONS = ('delete', 'hardlink', 'move')
+
+# Every copy of a hash has the same size, so all but one of them is wasted,
+# except paths that are hardlinks of one another (same inode) and so take no
+# extra space. Rows indexed before inodes were stored count as distinct.
+# Both passes read only the (hash, file_size, inode) index: a plain count
+# finds the repeated hashes, and only those pay for the distinct-inode count.
+GROUPS_SQL = '''
+SELECT hash, COUNT(*) AS copies, MAX(file_size) AS file_size,
+       MAX(file_size) * (COUNT(DISTINCT COALESCE(inode, -id)) - 1) AS wasted_bytes
+FROM files
+WHERE hash IN (SELECT hash FROM files GROUP BY hash HAVING COUNT(*) > 1)
+GROUP BY hash
+'''
+
+DUPLICATE_COLUMNS = ('id', 'file_name', 'file_path', 'file_size', 'file_format', 'date_created', 'date_modified',
+                     'hash', 'thumbnail_path')
+# Resolving also needs the stat cache columns, which stay out of the report
+RESOLVE_COLUMNS = DUPLICATE_COLUMNS + ('mtime_ns', 'inode')
+
+
+def duplicate_summary(conn):
+    row = conn.execute(f'''
+    SELECT COUNT(*) AS groups, COALESCE(SUM(copies), 0) AS files,
+           COALESCE(SUM(copies - 1), 0) AS redundant_files, COALESCE(SUM(wasted_bytes), 0) AS wasted_bytes
+    FROM ({GROUPS_SQL})
+    ''').fetchone()
+    return dict(row)
+
+def files_for_hashes(conn, hashes, columns=DUPLICATE_COLUMNS):
+    files = {}
+    for start in range(0, len(hashes), FILES_QUERY_BATCH):
+        batch = hashes[start:start + FILES_QUERY_BATCH]
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM files "
+                            f"WHERE hash IN ({', '.join('?' for _ in batch)}) ORDER BY file_path", batch)
+        for row in rows:
+            files.setdefault(row['hash'], []).append(dict(row))
+    return files
+
+def duplicate_report(conn, limit=DEFAULT_GROUP_LIMIT, offset=0, sort='wasted'):
+    if sort not in GROUP_SORTS:
+        raise ValueError(f"Invalid sort {sort}; expected one of {', '.join(GROUP_SORTS)}")
+    limit = max(1, min(limit, MAX_GROUP_LIMIT))
+    offset = max(0, offset)
+    # The totals are window aggregates over every group, so the page and the
+    # summary come from one grouping pass. One extra group tells us whether
+    # there is a next page.
+    rows = conn.execute(f'''
+    SELECT *, COUNT(*) OVER () AS total_groups, SUM(copies) OVER () AS total_files,
+           SUM(wasted_bytes) OVER () AS total_wasted_bytes
+    FROM ({GROUPS_SQL})
+    ORDER BY {GROUP_SORTS[sort]}
+    LIMIT ? OFFSET ?
+    ''', (limit + 1, offset)).fetchall()
+    if rows:
+        summary = {'groups': rows[0]['total_groups'], 'files': rows[0]['total_files'],
+                   'redundant_files': rows[0]['total_files'] - rows[0]['total_groups'],
+                   'wasted_bytes': rows[0]['total_wasted_bytes']}
+    else:
+        summary = duplicate_summary(conn)
+    next_offset = offset + limit if len(rows) > limit else None
+    groups = [{key: row[key] for key in ('hash', 'copies', 'file_size', 'wasted_bytes')} for row in rows[:limit]]
+    files = files_for_hashes(conn, [group['hash'] for group in groups])
+    for group in groups:
+        group['files'] = files.get(group['hash'], [])
+    return {'summary': summary, 'groups': groups, 'next_offset': next_offset}
+
+
+def keep_key(policy, preferred_roots=()):
+    # Sort key whose smallest file in a group is the one kept. Ties fall back
+    # to the shortest, then alphabetically first, path.
+    def path_key(file):
+        return len(file['file_path']), file['file_path']
+
+    if policy == 'oldest':
+        return lambda file: (file['mtime_ns'] is None, file['mtime_ns'] or 0, *path_key(file))
+    if policy == 'shortest_path':
+        return path_key
+    if policy == 'preferred_root':
+        roots = [os.path.abspath(root).rstrip(os.sep) + os.sep for root in preferred_roots]
+
+        def root_rank(file):
+            return next((rank for rank, root in enumerate(roots) if file['file_path'].startswith(root)), len(roots))
+        return lambda file: (root_rank(file), *path_key(file))
+    raise ValueError(f"Invalid keep policy {policy}; expected one of {', '.join(KEEP_POLICIES)}")
+
+def plan_resolution(conn, policy, preferred_roots=(), hashes=None):
+    # Which file of each duplicate group stays and which are resolved
+    if policy == 'preferred_root' and not preferred_roots:
+        raise ValueError("The preferred_root policy needs preferred_roots")
+    key = keep_key(policy, preferred_roots)
+    if hashes is None:
+        hashes = [row['hash'] for row in conn.execute(f'{GROUPS_SQL} ORDER BY {GROUP_SORTS["wasted"]}')]
+    plan = []
+    for file_hash, files in files_for_hashes(conn, list(hashes), RESOLVE_COLUMNS).items():
+        if len(files) < 2:
+            continue
+        files.sort(key=key)
+        plan.append({'hash': file_hash, 'keep': files[0], 'resolve': files[1:]})
+    plan.sort(key=lambda group: -group['keep']['file_size'] * len(group['resolve']))
+    return plan
+
+def quarantine_path(move_to, file_path):
+    # Mirrors the absolute path under move_to, so names never collide and a
+    # file can be put back where it came from
+    drive, path = os.path.splitdrive(os.path.abspath(file_path))
+    return os.path.join(move_to, drive.replace(':', ''), path.lstrip(os.sep))
+
+def same_file(file_stat, other_stat):
+    # Hardlinks of one another; inode numbers are only unique per device
+    return (file_stat.st_dev, file_stat.st_ino) == (other_stat.st_dev, other_stat.st_ino)
+
+def is_linked(file, keep):
+    try:
+        return same_file(os.stat(file['file_path']), os.stat(keep['file_path']))
+    except OSError:
+        return False
+
+def is_unchanged(file, file_stat):
+    # Only files still matching their indexed row are touched; anything else
+    # may no longer be a copy
+    return file_stat.st_size == file['file_size'] and (file['mtime_ns'] is None
+                                                       or file_stat.st_mtime_ns == file['mtime_ns'])
+
+def resolve_file(action, keep, file, move_to=None):
+    # Applies action to one duplicate on disk. Returns the new stat for a
+    # hardlink (the row stays), None when the row should go.
+    file_path = file['file_path']
+    file_stat = os.stat(file_path)
+    if not is_unchanged(file, file_stat):
+        raise ValueError("changed on disk since it was indexed")
+    keep_stat = os.stat(keep['file_path'])
+    if not is_unchanged(keep, keep_stat):
+        raise ValueError(f"the kept copy {keep['file_path']} changed on disk since it was indexed")
+
+    if action == 'delete':
+        os.remove(file_path)
+        return None
+    if action == 'move':
+        destination = quarantine_path(move_to, file_path)
+        if os.path.exists(destination):
+            raise ValueError(f"{destination} already exists")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(file_path, destination)
+        return None
+    if same_file(file_stat, keep_stat):
+        raise ValueError("already a hardlink of the kept copy")
+    # Link beside the file, then rename over it, so the path never disappears
+    temp_path = f"{file_path}.{os.getpid()}.link"
+    os.link(keep['file_path'], temp_path)
+    try:
+        os.replace(temp_path, file_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+    return os.stat(file_path)
+
+def resolve_duplicates(conn, policy='oldest', action='delete', preferred_roots=(), hashes=None, move_to=None,
+                       dry_run=False):
+    # Keeps one file per duplicate group and deletes, hardlinks or moves the
+    # others. Files are handled one at a time on disk; every row change is
+    # then written in a single transaction.
+    if action not in RESOLVE_ACTIONS:
+        raise ValueError(f"Invalid action {action}; expected one of {', '.join(RESOLVE_ACTIONS)}")
+    if action == 'move' and not move_to:
+        raise ValueError("The move action needs move_to")
+    plan = plan_resolution(conn, policy, preferred_roots, hashes)
+
+    stats = {'groups': len(plan), 'files': 0, 'bytes': 0, 'skipped': 0, 'failed': 0}
+    groups = []
+    removed_rows = []
+    relinked = []
+    errors = []
+    for group in plan:
+        keep = group['keep']
+        resolved = []
+        for file in group['resolve']:
+            # Decided on disk: the indexed inode alone cannot tell devices apart
+            linked = is_linked(file, keep)
+            if action == 'hardlink' and linked:
+                stats['skipped'] += 1
+                continue
+            if not dry_run:
+                try:
+                    new_stat = resolve_file(action, keep, file, move_to)
+                except (OSError, ValueError) as exc:
+                    stats['failed'] += 1
+                    errors.append({'file_path': file['file_path'], 'error': str(exc)})
+                    continue
+                if new_stat is None:
+                    removed_rows.append(file)
+                else:
+                    relinked.append((new_stat.st_mtime_ns, new_stat.st_ino,
+                                     time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(new_stat.st_mtime)), file['id']))
+            stats['files'] += 1
+            if not linked:
+                stats['bytes'] += file['file_size']
+            resolved.append(file['file_path'])
+        groups.append({'hash': group['hash'], 'keep': keep['file_path'], action: resolved})
+
+    if not dry_run:
+        with conn:
+            # Hardlinked rows keep their path and hash; their stat changed, so
+            # the stat cache is refreshed to keep incremental runs from rehashing
+            conn.executemany('UPDATE files SET mtime_ns = ?, inode = ?, date_modified = ? WHERE id = ?', relinked)
+            conn.executemany('DELETE FROM files WHERE id = ?', [(file['id'],) for file in removed_rows])
+        # Kept copies share each hash, so this only drops thumbnails of legacy rows
+        remove_thumbnails(conn, removed_rows)
+        logger.info(f"Resolved duplicates ({action}, keep {policy}): {stats}")
+    return {'dry_run': dry_run, 'policy': policy, 'action': action, **stats, 'groups': groups, 'errors': errors}
@@ -0,0 +1,95 @@
+import os
+import logging
+import importlib.util
+import numpy as np
+
+from analysis_backends import OLLAMA_URL, HTTPBackend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'ollama')
+OLLAMA_EMBEDDING_MODEL = os.environ.get('OLLAMA_EMBEDDING_MODEL', 'nomic-embed-text')
+CLIP_MODEL = os.environ.get('CLIP_MODEL', 'clip-ViT-B-32')
+# Images are decoded at roughly this size before a CLIP model resizes them
+CLIP_DECODE_SIZE = 448
+
+
+class EmbeddingModel:
+    # Maps images and query text into one vector space. Models whose source is
+    # 'analysis' embed the stored analysis text of an image; 'image' models
+    # embed the pixels. Both return float32 arrays of shape (n, dim).
+    name = None
+    source = None
+
+    def embed_texts(self, texts):
+        raise NotImplementedError
+
+    def embed_images(self, file_paths):
+        raise NotImplementedError
+
+
+class OllamaEmbeddingModel(EmbeddingModel):
+    # Text embeddings from Ollama. An image is represented by its analysis,
+    # so only analyzed images can be embedded.
+    name = 'ollama'
+    source = 'analysis'
+
+    def __init__(self, model=OLLAMA_EMBEDDING_MODEL, base_url=OLLAMA_URL):
+        self.model = model
+        self.client = HTTPBackend(base_url)
+
+    def embed_texts(self, texts):
+        response = self.client.post('/api/embed', {"model": self.model, "input": list(texts)})
+        return np.asarray(response['embeddings'], dtype=np.float32)
+
+
+class ClipEmbeddingModel(EmbeddingModel):
+    # Joint image/text model run locally on CPU via sentence-transformers
+    name = 'clip'
+    source = 'image'
+
+    def __init__(self, model=CLIP_MODEL):
+        self.model_name = model
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name, device='cpu')
+        return self._model
+
+    def embed_texts(self, texts):
+        return np.asarray(self.model.encode(list(texts), convert_to_numpy=True), dtype=np.float32)
+
+    def embed_images(self, file_paths):
+        from image_formats import open_image
+        images = []
+        for file_path in file_paths:
+            with open_image(file_path, size=CLIP_DECODE_SIZE) as source:
+                source.image.draft('RGB', (CLIP_DECODE_SIZE, CLIP_DECODE_SIZE))
+                images.append(source.image.convert('RGB'))
+        return np.asarray(self.model.encode(images, convert_to_numpy=True), dtype=np.float32)
+
+
+_models = {}
+
+def register_model(model):
+    _models[model.name] = model
+    logger.info(f"Registered embedding model: {model.name}")
+    return model
+
+def get_model(name):
+    model = _models.get(name)
+    if model is None:
+        raise ValueError(f"Unknown embedding model {name}; expected one of {', '.join(_models)}")
+    return model
+
+def model_names():
+    return list(_models)
+
+def register_default_models():
+    register_model(OllamaEmbeddingModel())
+    # Optional dependency: CLIP is only offered when sentence-transformers is installed
+    if importlib.util.find_spec('sentence_transformers'):
+        register_model(ClipEmbeddingModel())
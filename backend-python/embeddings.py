@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock only one server process can write a store
+    fcntl = None
+
+from db import create_connection
+from file_query import FilesQuery, parse_json_field
+from embedding_models import get_model
+from batch_analysis import retry_with_backoff
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIR = os.environ.get('EMBEDDING_DIR', 'embeddings')
+# float16 halves the matrix, int8 quarters it at a small cost in ranking precision
+EMBEDDING_DTYPE = os.environ.get('EMBEDDING_DTYPE', 'float16')
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 200
+
+# Inverted-file (IVF) index: vectors are bucketed under their nearest of
+# ~sqrt(n) k-means centroids and a query scans only the IVF_PROBES buckets
+# closest to it. Below IVF_MIN_ROWS an exact scan is already fast enough.
+IVF_MIN_ROWS = int(os.environ.get('EMBEDDING_IVF_MIN_ROWS', 50000))
+IVF_PROBES = int(os.environ.get('EMBEDDING_IVF_PROBES', 16))
+IVF_TRAIN_PER_LIST = 64
+IVF_ITERATIONS = 10
+# Rebuild once this fraction of rows was appended after the last build
+REINDEX_FRACTION = 0.2
+# Rows converted to float32 at a time when scanning
+SCAN_CHUNK_ROWS = 16384
+
+INT8_SCALE = 127
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorStore:
+    # Unit vectors of one embedding model in an append-only binary matrix,
+    # read through np.memmap so resident memory is bounded by the page cache.
+    # Row numbers are mapped to content hashes in the embeddings table.
+    def __init__(self, model_name, directory=EMBEDDING_DIR):
+        self.directory = os.path.join(directory, model_name)
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.vectors_path = os.path.join(self.directory, 'vectors.bin')
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self.meta = None
+        self.load_meta()
+        self.lock = threading.Lock()
+        self._matrix = None
+        self._index = None
+        self._index_stamp = None
+
+    def load_meta(self):
+        # meta.json never changes once written, but may be written by another
+        # process after this store was created, so it is looked for until found
+        if self.meta is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        return self.meta
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta['dtype'])
+
+    def rows(self):
+        if not self.load_meta() or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.meta['dim'] * self.dtype.itemsize)
+
+    def matrix(self):
+        rows = self.rows()
+        if rows == 0:
+            return None
+        if self._matrix is None or len(self._matrix) != rows:
+            self._matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(rows, self.meta['dim']))
+        return self._matrix
+
+    def to_float(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / INT8_SCALE if self.dtype == np.int8 else vectors
+
+    def append(self, vectors):
+        # Returns the row numbers of the appended vectors. The flock on the
+        # vectors file covers meta.json, the row count and the write, so
+        # server processes appending at once get distinct rows.
+        vectors = normalize(vectors)
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, open(self.vectors_path, 'ab') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            if self.load_meta() is None:
+                self.meta = {'dim': vectors.shape[1], 'dtype': EMBEDDING_DTYPE}
+                temp_path = f'{self.meta_path}.{os.getpid()}.tmp'
+                with open(temp_path, 'w') as meta_file:
+                    json.dump(self.meta, meta_file)
+                os.replace(temp_path, self.meta_path)
+            if vectors.shape[1] != self.meta['dim']:
+                raise ValueError(f"Expected {self.meta['dim']}-dimensional vectors, got {vectors.shape[1]}")
+            if self.dtype == np.int8:
+                stored = np.clip(np.round(vectors * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+            else:
+                stored = vectors.astype(self.dtype)
+            row_bytes = self.meta['dim'] * self.dtype.itemsize
+            start = os.fstat(f.fileno()).st_size // row_bytes
+            f.write(stored.tobytes())
+            f.flush()
+        return np.arange(start, start + len(vectors))
+
+    def index(self):
+        # The current IVF index, reloaded when a rebuild replaced it
+        try:
+            stamp = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if stamp != self._index_stamp:
+            with open(self.index_path) as f:
+                info = json.load(f)
+            directory = os.path.join(self.directory, info['generation'])
+            self._index = {
+                'rows': info['rows'],
+                'centroids': np.load(os.path.join(directory, 'centroids.npy')),
+                'order': np.load(os.path.join(directory, 'order.npy'), mmap_mode='r'),
+                'offsets': np.load(os.path.join(directory, 'offsets.npy')),
+            }
+            self._index_stamp = stamp
+        return self._index
+
+    def needs_index(self):
+        rows = self.rows()
+        if rows < IVF_MIN_ROWS:
+            return False
+        index = self.index()
+        return index is None or rows - index['rows'] > REINDEX_FRACTION * index['rows']
+
+    def scan(self, query, rows=None):
+        # Scores of query against the given rows (all rows if None)
+        matrix = self.matrix()
+        if rows is None:
+            scores = np.empty(len(matrix), dtype=np.float32)
+            for start in range(0, len(matrix), SCAN_CHUNK_ROWS):
+                chunk = matrix[start:start + SCAN_CHUNK_ROWS]
+                scores[start:start + len(chunk)] = self.to_float(chunk) @ query
+            return scores
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCAN_CHUNK_ROWS):
+            chunk_rows = rows[start:start + SCAN_CHUNK_ROWS]
+            scores[start:start + len(chunk_rows)] = self.to_float(matrix[chunk_rows]) @ query
+        return scores
+
+    def search(self, query, limit, probes=IVF_PROBES):
+        # Approximate top-limit rows by cosine similarity; exact below IVF_MIN_ROWS
+        if self.matrix() is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = normalize(query)
+        index = self.index()
+        if index is None:
+            rows = None
+        else:
+            centroids, order, offsets = index['centroids'], index['order'], index['offsets']
+            probes = min(probes, len(centroids))
+            nearest = np.argpartition(centroids @ query, -probes)[-probes:]
+            parts = [order[offsets[bucket]:offsets[bucket + 1]] for bucket in nearest]
+            # Rows appended since the build are scanned exactly
+            parts.append(np.arange(index['rows'], len(self.matrix())))
+            # Sorted rows read the memmap front to back
+            rows = np.sort(np.concatenate(parts))
+        scores = self.scan(query, rows)
+        limit = min(limit, len(scores))
+        if limit == 0:
+            return np.empty(0, dtype=np.int64), scores
+        top = np.argpartition(scores, -limit)[-limit:]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return (top if rows is None else rows[top]), scores[top]
+
+    def build_index(self):
+        matrix = self.matrix()
+        count = len(matrix)
+        lists = max(1, min(int(np.sqrt(count)), 65536))
+        started = time.monotonic()
+        rng = np.random.default_rng(0)
+
+        # Spherical k-means on a sample
+        sample_rows = np.sort(rng.choice(count, size=min(count, lists * IVF_TRAIN_PER_LIST), replace=False))
+        sample = self.to_float(matrix[sample_rows])
+        centroids = sample[rng.choice(len(sample), size=lists, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            assignments = self.assign(sample, centroids)
+            members = np.argsort(assignments, kind='stable')
+            counts = np.bincount(assignments, minlength=lists)
+            # Empty lists keep their previous centroid
+            filled = counts > 0
+            starts = (np.cumsum(counts) - counts)[filled]
+            centroids[filled] = normalize(np.add.reduceat(sample[members], starts, axis=0))
+
+        assignments = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SCAN_CHUNK_ROWS):
+            chunk = self.to_float(matrix[start:start + SCAN_CHUNK_ROWS])
+            assignments[start:start + len(chunk)] = self.assign(chunk, centroids)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignments[order], np.arange(lists + 1))
+
+        # Each build gets its own directory and index.json is swapped atomically,
+        # so searches in progress keep reading the previous generation
+        generation = f'index-{count}-{int(time.time())}'
+        directory = os.path.join(self.directory, generation)
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'centroids.npy'), centroids)
+        np.save(os.path.join(directory, 'order.npy'), order)
+        np.save(os.path.join(directory, 'offsets.npy'), offsets)
+        temp_path = f'{self.index_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'generation': generation, 'rows': count, 'lists': lists}, f)
+        os.replace(temp_path, self.index_path)
+        for name in os.listdir(self.directory):
+            if name.startswith('index-') and name != generation:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        logger.info(f"Built IVF index over {count} vectors with {lists} lists "
+                    f"in {time.monotonic() - started:.1f}s")
+
+    @staticmethod
+    def assign(vectors, centroids):
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(model_name):
+    with _stores_lock:
+        if model_name not in _stores:
+            _stores[model_name] = VectorStore(model_name)
+        return _stores[model_name]
+
+
+def analysis_text(row):
+    # What an analysis-based model embeds for an image
+    parts = [row['description'] or '']
+    for field in ('tags', 'subjects', 'categories', 'visible_text'):
+        values = parse_json_field(row[field])
+        if isinstance(values, list):
+            parts.append(', '.join(str(value) for value in values))
+    return '. '.join(part for part in parts if part)
+
+def select_pending_embeddings(conn, model, options):
+    # One file per content hash without a vector from this model yet
+    conditions = ['f.thumbnail_path IS NOT NULL', 'e.hash IS NULL']
+    params = [model.name]
+    join = ''
+    columns = 'f.hash, MIN(f.id) AS id, f.file_path'
+    if model.source == 'analysis':
+        join = 'JOIN image_analysis ia ON ia.hash = f.hash'
+        columns += ', ia.description, ia.tags, ia.subjects, ia.categories, ia.visible_text'
+    if options.get('ids'):
+        ids = [int(image_id) for image_id in options['ids']]
+        conditions.append(f"f.id IN ({', '.join('?' for _ in ids)})")
+        params.extend(ids)
+    if options.get('filter'):
+        query = FilesQuery(options['filter'])
+        conditions.extend(query.conditions)
+        params.extend(query.params)
+    return conn.execute(f'''
+    SELECT {columns}
+    FROM files f
+    {join}
+    LEFT JOIN embeddings e ON e.model = ? AND e.hash = f.hash
+    WHERE {' AND '.join(conditions)}
+    GROUP BY f.hash
+    ORDER BY MIN(f.id)
+    ''', params).fetchall()
+
+def embed_batch(model, rows):
+    with metrics.stage('embedding_call', model=model.name):
+        if model.source == 'analysis':
+            return model.embed_texts([analysis_text(row) for row in rows])
+        return model.embed_images([row['file_path'] for row in rows])
+
+def run_embedding_job(job, is_retryable):
+    model = get_model(job.options['model'])
+    store = get_store(model.name)
+    batch_size = int(job.options.get('batch_size') or EMBEDDING_BATCH_SIZE)
+
+    conn = create_connection()
+    try:
+        pending = select_pending_embeddings(conn, model, job.options)
+        progress = {'done': 0, 'total': len(pending), 'embedded': 0, 'failed': 0}
+        job.report(dict(progress))
+
+        for start in range(0, len(pending), batch_size):
+            if job.is_cancelled():
+                break
+            batch = pending[start:start + batch_size]
+            try:
+                vectors, _ = retry_with_backoff(lambda: embed_batch(model, batch), is_retryable,
+                                                cancel_event=job.cancel_event)
+            except Exception as e:
+                if job.is_cancelled():
+                    break
+                logger.error(f"Embedding batch failed: {e}")
+                for row in batch:
+                    job.record_item(row['hash'], 'failed', error=str(e))
+                progress['failed'] += len(batch)
+            else:
+                rows = store.append(vectors)
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO embeddings (model, hash, row) VALUES (?, ?, ?)',
+                                     [(model.name, row['hash'], int(vector_row))
+                                      for row, vector_row in zip(batch, rows)])
+                progress['embedded'] += len(batch)
+            progress['done'] += len(batch)
+            job.report(dict(progress))
+    finally:
+        conn.close()
+
+    if not job.is_cancelled() and store.needs_index():
+        job.report({**progress, 'indexing': True})
+        store.build_index()
+    job.report(dict(progress))
+
+
+def search_embeddings(conn, model_name, text=None, file_hash=None, limit=DEFAULT_SEARCH_LIMIT, probes=IVF_PROBES):
+    # Text-to-image when text is given, image-to-image for file_hash.
+    # Returns [(hash, score)], best first.
+    store = get_store(model_name)
+    if file_hash:
+        row = conn.execute('SELECT row FROM embeddings WHERE model = ? AND hash = ?',
+                           (model_name, file_hash)).fetchone()
+        if not row:
+            raise LookupError(f"No {model_name} embedding for this image yet")
+        matrix = store.matrix()
+        if matrix is None or row['row'] >= len(matrix):
+            raise LookupError(f"No {model_name} vector stored for this image")
+        query = store.to_float(matrix[row['row']])
+    else:
+        query = get_model(model_name).embed_texts([text])[0]
+
+    # Over-fetch a little: the query image itself and replaced rows are dropped
+    rows, scores = store.search(query, limit + 8, max(1, int(probes)))
+    score_by_row = dict(zip(rows.tolist(), scores.tolist()))
+    mapped = {}
+    row_list = list(score_by_row)
+    for start in range(0, len(row_list), 500):
+        chunk = row_list[start:start + 500]
+        for row in conn.execute(f"SELECT hash, row FROM embeddings WHERE model = ? AND row IN "
+                                f"({', '.join('?' for _ in chunk)})", [model_name] + chunk):
+            mapped[row['row']] = row['hash']
+    results = [(mapped[row], score) for row, score in score_by_row.items()
+               if row in mapped and mapped[row] != file_hash]
+    return results[:limit]
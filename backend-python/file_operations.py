@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import logging
+import concurrent.futures
+
+from file_query import FilesQuery
+from thumbnails import remove_thumbnails
+
+logger = logging.getLogger(__name__)
+
+# Filesystem calls are I/O bound, so a thread pool overlaps them
+FILE_OPERATION_WORKERS = int(os.environ.get('FILE_OPERATION_WORKERS', 16))
+# Rows per transaction while applying results
+FILE_OPERATION_BATCH_SIZE = 500
+MAX_SELECTION = int(os.environ.get('FILE_OPERATION_MAX_SELECTION', 100000))
+
+OPERATIONS = ('delete', 'move', 'tag')
+# Analysis lists a tag operation can edit
+TAG_KINDS = ('tags', 'categories')
+
+
+def select_files(conn, options):
+    # The files named by ids and/or matching filter. One of the two is
+    # required so an empty request never means "every file".
+    if not options.get('ids') and not options.get('filter'):
+        raise ValueError("Select files with ids or filter")
+    conditions = []
+    params = []
+    if options.get('ids'):
+        ids = [int(file_id) for file_id in options['ids']]
+        conditions.append("f.id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(ids))
+    if options.get('filter'):
+        query = FilesQuery(options['filter'])
+        conditions.extend(query.conditions)
+        params.extend(query.params)
+    rows = conn.execute(f'''
+    SELECT f.id, f.file_name, f.file_path, f.hash, f.thumbnail_path
+    FROM files f
+    WHERE {' AND '.join(conditions) or '1'}
+    ORDER BY f.id
+    LIMIT ?
+    ''', params + [MAX_SELECTION + 1]).fetchall()
+    if len(rows) > MAX_SELECTION:
+        raise ValueError(f"Selection exceeds {MAX_SELECTION} files; narrow the filter")
+    return [dict(row) for row in rows]
+
+def run_pool(fn, files, workers=FILE_OPERATION_WORKERS):
+    # Yields (file, result, error) as each filesystem call finishes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(files)))) as pool:
+        futures = {pool.submit(fn, file): file for file in files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as exc:
+                yield futures[future], None, exc
+
+def batches(items, size=FILE_OPERATION_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def delete_file_from_disk(file):
+    try:
+        os.remove(file['file_path'])
+        return 'deleted'
+    except FileNotFoundError:
+        # Already gone; the row is stale either way
+        return 'missing'
+
+def delete_files(conn, files):
+    items = []
+    removed = []
+    for file, status, error in run_pool(delete_file_from_disk, files):
+        if error:
+            items.append({'id': file['id'], 'file_path': file['file_path'], 'status': 'failed', 'error': str(error)})
+            continue
+        items.append({'id': file['id'], 'file_path': file['file_path'], 'status': status})
+        removed.append(file)
+    for batch in batches(removed):
+        with conn:
+            conn.executemany('DELETE FROM files WHERE id = ?', [(file['id'],) for file in batch])
+    # Content-named thumbnails go with the last row of their hash
+    remove_thumbnails(conn, removed)
+    return items
+
+def move_file_on_disk(file):
+    # No-clobber: a file already at the destination is an error, not a replacement
+    destination = file['destination']
+    if os.path.lexists(destination):
+        raise FileExistsError(f"{destination} already exists")
+    shutil.move(file['file_path'], destination)
+    return os.stat(destination)
+
+def move_files(conn, files, destination):
+    if not destination:
+        raise ValueError("The move operation needs destination")
+    if not os.path.isdir(destination):
+        raise ValueError(f"Destination {destination} is not a directory")
+    destination = os.path.abspath(destination)
+
+    items = []
+    pending = []
+    taken = set()
+    for file in files:
+        target = os.path.join(destination, file['file_name'])
+        if target == file['file_path']:
+            items.append({'id': file['id'], 'file_path': file['file_path'], 'status': 'unchanged'})
+        elif target in taken:
+            items.append({'id': file['id'], 'file_path': file['file_path'], 'status': 'failed',
+                          'error': f"Another selected file is also named {file['file_name']}"})
+        else:
+            taken.add(target)
+            pending.append({**file, 'destination': target})
+
+    moved = []
+    for file, file_stat, error in run_pool(move_file_on_disk, pending):
+        if error:
+            items.append({'id': file['id'], 'file_path': file['file_path'], 'status': 'failed', 'error': str(error)})
+            continue
+        items.append({'id': file['id'], 'file_path': file['file_path'], 'new_path': file['destination'],
+                      'status': 'moved'})
+        # A move across filesystems is a copy with a new inode and mtime; the
+        # stat cache gets them so the next index run does not rehash the file
+        moved.append((file['destination'], os.path.basename(file['destination']),
+                      file_stat.st_mtime_ns, file_stat.st_ino, file['id']))
+    for batch in batches(moved):
+        with conn:
+            # Rows left at a destination point at files that were not on disk
+            conn.executemany('DELETE FROM files WHERE file_path = ?', [(row[0],) for row in batch])
+            conn.executemany('UPDATE files SET file_path = ?, file_name = ?, mtime_ns = ?, inode = ? WHERE id = ?',
+                             batch)
+    return items
+
+def tag_files(conn, files, add=(), remove=(), kind='tags'):
+    # Edits an analysis list of every selected file's content. Labels compare
+    # case-insensitively, like the label index; triggers keep it and the
+    # search index in sync.
+    if kind not in TAG_KINDS:
+        raise ValueError(f"Invalid kind {kind}; expected one of {', '.join(TAG_KINDS)}")
+    add = [str(label).strip() for label in add or () if str(label).strip()]
+    remove = {str(label).strip().lower() for label in remove or ()}
+    if not add and not remove:
+        raise ValueError("The tag operation needs add or remove")
+
+    hashes = list(dict.fromkeys(file['hash'] for file in files))
+    current = {}
+    for batch in batches(hashes):
+        rows = conn.execute(f"SELECT hash, {kind} FROM image_analysis WHERE hash IN ({', '.join('?' for _ in batch)})",
+                            batch)
+        for row in rows:
+            try:
+                labels = json.loads(row[kind]) if row[kind] else []
+            except ValueError:
+                labels = []
+            current[row['hash']] = labels if isinstance(labels, list) else []
+
+    updates = []
+    for file_hash in hashes:
+        labels = [label for label in current.get(file_hash, []) if str(label).strip().lower() not in remove]
+        seen = {str(label).strip().lower() for label in labels}
+        for label in add:
+            if label.lower() not in seen:
+                seen.add(label.lower())
+                labels.append(label)
+        if labels != current.get(file_hash, []):
+            updates.append((file_hash, json.dumps(labels)))
+    for batch in batches(updates):
+        with conn:
+            # Content never analyzed gets an analysis row holding just the
+            # labels (update, then insert; see create_label_index)
+            conn.executemany(f'UPDATE image_analysis SET {kind} = ? WHERE hash = ?',
+                             [(labels, file_hash) for file_hash, labels in batch if file_hash in current])
+            conn.executemany(f'INSERT INTO image_analysis (hash, {kind}) VALUES (?, ?)',
+                             [(file_hash, labels) for file_hash, labels in batch if file_hash not in current])
+
+    changed = {file_hash for file_hash, _ in updates}
+    return [{'id': file['id'], 'file_path': file['file_path'],
+             'status': 'tagged' if file['hash'] in changed else 'unchanged'} for file in files]
+
+
+def run_file_operation(conn, options):
+    operation = options.get('operation')
+    if operation not in OPERATIONS:
+        raise ValueError(f"Invalid operation {operation}; expected one of {', '.join(OPERATIONS)}")
+    files = select_files(conn, options)
+    if operation == 'delete':
+        items = delete_files(conn, files)
+    elif operation == 'move':
+        items = move_files(conn, files, options.get('destination'))
+    else:
+        items = tag_files(conn, files, options.get('add'), options.get('remove'), options.get('kind', 'tags'))
+
+    failed = sum(1 for item in items if item['status'] == 'failed')
+    logger.info(f"Bulk {operation} of {len(files)} files: {failed} failed")
+    return {'operation': operation, 'total': len(files), 'succeeded': len(items) - failed, 'failed': failed,
+            'items': sorted(items, key=lambda item: item['id'])}
@@ -0,0 +1,223 @@
+import json
+import base64
+
+from db import LABEL_KINDS
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Columns of `files` that can be selected, sorted on and filtered on
+FILE_FIELDS = ('id', 'file_name', 'file_path', 'file_size', 'file_format',
+               'date_created', 'date_modified', 'hash', 'thumbnail_path',
+               'width', 'height', 'date_taken', 'camera_make', 'camera_model',
+               'gps_latitude', 'gps_longitude')
+SORT_FIELDS = ('id', 'file_name', 'file_path', 'file_size', 'file_format',
+               'date_created', 'date_modified', 'width', 'height', 'date_taken',
+               'camera_make', 'camera_model')
+# Sort fields that are NULL for non-images or images without EXIF
+NULLABLE_SORT_FIELDS = ('width', 'height', 'date_taken', 'camera_make', 'camera_model')
+ANALYSIS_FIELDS = ('description', 'subjects', 'colors', 'mood', 'composition', 'visible_text',
+                   'tags', 'categories', 'quality', 'unique_features')
+ANALYSIS_JSON_FIELDS = ('subjects', 'colors', 'mood', 'visible_text', 'tags', 'categories', 'unique_features')
+# SQLite assembles the analysis object, so rows are never JSON-decoded in
+# Python just to be encoded again; invalid stored JSON becomes null. A row
+# holding only labels added by hand has no description and is not an analysis.
+ANALYSIS_SQL = "CASE WHEN ia.description IS NOT NULL THEN json_object({}) END AS analysis_json".format(', '.join(
+    f"'{field}', CASE WHEN json_valid(ia.{field}) THEN json(ia.{field}) END" if field in ANALYSIS_JSON_FIELDS
+    else f"'{field}', ia.{field}"
+    for field in ANALYSIS_FIELDS))
+# Labels that can be edited by hand, analysed or not; an empty list when there are none
+LABEL_FIELDS = ('tags', 'categories')
+LABELS_SQL = "json_object({}) AS labels_json".format(', '.join(
+    f"'{field}', CASE WHEN json_valid(ia.{field}) THEN json(ia.{field}) ELSE json('[]') END"
+    for field in LABEL_FIELDS))
+# Fields computed from image_analysis rather than read from files
+JOINED_FIELDS = ('analysis', 'labels')
+DEFAULT_FACET_LIMIT = 20
+MAX_FACET_LIMIT = 200
+
+# query parameter -> (SQL condition, value converter)
+RANGE_FILTERS = {
+    'min_size': ('f.file_size >= ?', int),
+    'max_size': ('f.file_size <= ?', int),
+    'created_after': ('f.date_created >= ?', str),
+    'created_before': ('f.date_created <= ?', str),
+    'modified_after': ('f.date_modified >= ?', str),
+    'modified_before': ('f.date_modified <= ?', str),
+    'hash': ('f.hash = ?', str),
+    'min_width': ('f.width >= ?', int),
+    'max_width': ('f.width <= ?', int),
+    'min_height': ('f.height >= ?', int),
+    'max_height': ('f.height <= ?', int),
+    'taken_after': ('f.date_taken >= ?', str),
+    'taken_before': ('f.date_taken <= ?', str),
+    'camera_make': ('f.camera_make = ?', str),
+    'camera_model': ('f.camera_model = ?', str),
+}
+
+
+def encode_cursor(sort_value, row_id):
+    raw = json.dumps([sort_value, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(row_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+def parse_json_field(field):
+    if field:
+        try:
+            return json.loads(field)
+        except json.JSONDecodeError:
+            return None
+    return None
+
+
+class FilesQuery:
+    # Turns /api/v1/files query parameters into a single keyset-paginated SELECT
+    def __init__(self, args):
+        self.sort = args.get('sort', 'id')
+        if self.sort not in SORT_FIELDS:
+            raise ValueError(f"Cannot sort by {self.sort}; expected one of {', '.join(SORT_FIELDS)}")
+        self.descending = args.get('order', 'asc').lower() == 'desc'
+
+        # Pages of DEFAULT_PAGE_SIZE unless limit says otherwise. ?all=1 streams
+        # the whole library in the legacy array shape, for clients that need it.
+        self.paginated = str(args.get('all', '')).lower() not in ('1', 'true', 'yes')
+        self.limit = None
+        if self.paginated:
+            self.limit = max(1, min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+        self.cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+
+        fields = parse_list(args.get('fields'))
+        unknown = [field for field in fields if field not in FILE_FIELDS and field not in JOINED_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        self.fields = [field for field in FILE_FIELDS if not fields or field in fields]
+        self.joined_fields = [field for field in JOINED_FIELDS if not fields or field in fields]
+
+        self.conditions = []
+        self.params = []
+        self.add_filters(args)
+
+    def add_filters(self, args):
+        formats = parse_list(args.get('format'))
+        if formats:
+            normalized = [fmt.lower() if fmt.startswith('.') else f".{fmt.lower()}" for fmt in formats]
+            self.conditions.append(f"LOWER(f.file_format) IN ({', '.join('?' for _ in normalized)})")
+            self.params.extend(normalized)
+
+        for name, (condition, convert) in RANGE_FILTERS.items():
+            if args.get(name):
+                self.conditions.append(condition)
+                self.params.append(convert(args[name]))
+
+        # Every listed label must be present: tags=a,b&categories=c means a AND b AND c
+        for kind in LABEL_KINDS:
+            for value in parse_list(args.get(kind)):
+                self.conditions.append('f.hash IN (SELECT hl.hash FROM hash_labels hl '
+                                       'JOIN labels l ON l.id = hl.label_id WHERE l.kind = ? AND l.value = ?)')
+                self.params.extend([kind, value.lower()])
+
+        if args.get('has_gps'):
+            has_gps = args['has_gps'].lower() in ('1', 'true', 'yes')
+            self.conditions.append(f"f.gps_latitude IS {'NOT NULL' if has_gps else 'NULL'}")
+
+    def sql(self):
+        # id is always selected; it is the keyset tiebreaker
+        columns = [f"f.{field}" for field in dict.fromkeys(['id', self.sort] + self.fields)]
+        columns += self.joined_columns()
+
+        conditions = list(self.conditions)
+        params = list(self.params)
+        if self.cursor:
+            condition, cursor_params = self.cursor_condition()
+            conditions.append(condition)
+            params.extend(cursor_params)
+
+        direction = 'DESC' if self.descending else 'ASC'
+        sql = f"SELECT {', '.join(columns)} FROM files f {self.join()}"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        sql += f" ORDER BY f.{self.sort} {direction}, f.id {direction}"
+        if self.limit:
+            # One extra row tells us whether there is a next page
+            sql += ' LIMIT ?'
+            params.append(self.limit + 1)
+        return sql, params
+
+    def cursor_condition(self):
+        # Rows after the cursor in (sort, id) order
+        value, row_id = self.cursor
+        operator = '<' if self.descending else '>'
+        column = f"f.{self.sort}"
+        if self.sort not in NULLABLE_SORT_FIELDS:
+            return f"({column}, f.id) {operator} (?, ?)", [value, row_id]
+        # SQLite orders NULLs first ascending and last descending, and a row
+        # value comparison against NULL is never true, so NULLs need their own terms
+        if value is None:
+            if self.descending:
+                return f"({column} IS NULL AND f.id < ?)", [row_id]
+            return f"(({column} IS NULL AND f.id > ?) OR {column} IS NOT NULL)", [row_id]
+        if self.descending:
+            return f"(({column}, f.id) < (?, ?) OR {column} IS NULL)", [value, row_id]
+        return f"({column}, f.id) > (?, ?)", [value, row_id]
+
+    def joined_columns(self):
+        return [{'analysis': ANALYSIS_SQL, 'labels': LABELS_SQL}[field] for field in self.joined_fields]
+
+    def join(self):
+        return 'LEFT JOIN image_analysis ia ON f.hash = ia.hash' if self.joined_fields else ''
+
+    def serialize(self, row):
+        item = {field: row[field] for field in self.fields}
+        for field in self.joined_fields:
+            item[field] = parse_json_field(row[f'{field}_json'])
+        return item
+
+    def serialize_json(self, row):
+        # Same as json.dumps(self.serialize(row)), splicing in the JSON text SQLite built as is
+        parts = [f'"{field}": {row[f"{field}_json"] or "null"}' for field in self.joined_fields]
+        if not parts:
+            return json.dumps({field: row[field] for field in self.fields})
+        if not self.fields:
+            return f'{{{", ".join(parts)}}}'
+        return f'{json.dumps({field: row[field] for field in self.fields})[:-1]}, {", ".join(parts)}}}'
+
+    def next_cursor(self, row):
+        return encode_cursor(row[self.sort], row['id'])
+
+
+def facet_counts(conn, query, kinds=None, limit=DEFAULT_FACET_LIMIT):
+    # Files per label among those matching query's filters, the most common
+    # limit labels of each kind first
+    kinds = kinds or list(LABEL_KINDS)
+    unknown = [kind for kind in kinds if kind not in LABEL_KINDS]
+    if unknown:
+        raise ValueError(f"Unknown facets: {', '.join(unknown)}; expected any of {', '.join(LABEL_KINDS)}")
+    conditions = [f"l.kind IN ({', '.join('?' for _ in kinds)})"] + query.conditions
+    rows = conn.execute(f'''
+    SELECT kind, value, count FROM (
+        SELECT l.kind, l.value, COUNT(*) AS count,
+               ROW_NUMBER() OVER (PARTITION BY l.kind ORDER BY COUNT(*) DESC, l.value) AS position
+        FROM files f
+        JOIN hash_labels hl ON hl.hash = f.hash
+        JOIN labels l ON l.id = hl.label_id
+        WHERE {' AND '.join(conditions)}
+        GROUP BY l.id
+    )
+    WHERE position <= ?
+    ORDER BY kind, count DESC, value
+    ''', kinds + query.params + [limit]).fetchall()
+
+    facets = {kind: [] for kind in kinds}
+    for row in rows:
+        facets[row['kind']].append({'value': row['value'], 'count': row['count']})
+    total_sql = f"SELECT COUNT(*) FROM files f{' WHERE ' + ' AND '.join(query.conditions) if query.conditions else ''}"
+    return {'total': conn.execute(total_sql, query.params).fetchone()[0], 'facets': facets}
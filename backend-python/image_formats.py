@@ -0,0 +1,580 @@
+import io
+import os
+import struct
+import logging
+import threading
+import importlib.util
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Camera RAW formats. Most are TIFF containers holding one or more JPEG
+# previews next to the sensor data; RAF and CR3 have containers of their own.
+RAW_EXTENSIONS = {'.arw', '.srf', '.sr2', '.crw', '.cr2', '.cr3', '.nef', '.nrw', '.raf', '.orf', '.rw2', '.pef',
+                  '.rwl', '.iiq', '.x3f', '.dng'}
+HEIF_EXTENSIONS = {'.heic', '.heif', '.hif'}
+CONTAINER_EXTENSIONS = RAW_EXTENSIONS | HEIF_EXTENSIONS
+
+# Tags and IFDs past these sizes are not worth reading for metadata, and guard
+# against loops and garbage in damaged files
+MAX_IFDS = 64
+MAX_IFD_ENTRIES = 1000
+MAX_TAG_VALUE_BYTES = 64 * 1024
+MAX_BOXES = 10000
+
+# TIFF tag ids
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_SUB_IFDS = 330
+TAG_JPEG_OFFSET = 513
+TAG_JPEG_LENGTH = 514
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_PIXEL_X_DIMENSION = 0xA002
+TAG_PIXEL_Y_DIMENSION = 0xA003
+# Panasonic RW2 keeps its full-size JPEG in this IFD0 tag
+TAG_RW2_JPEG = 0x002E
+# Compression values of JPEG-coded strips, and the photometric
+# interpretations of sensor data (CFA and DNG LinearRaw)
+JPEG_COMPRESSIONS = (6, 7)
+SENSOR_PHOTOMETRICS = (32803, 34892)
+
+# (struct format, size) of each TIFF field type
+TIFF_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('L', 4), 5: ('LL', 8), 6: ('b', 1), 7: ('B', 1),
+              8: ('h', 2), 9: ('l', 4), 10: ('ll', 8), 11: ('f', 4), 12: ('d', 8), 13: ('L', 4)}
+TIFF_UNDEFINED = 7
+
+# UUID boxes of CR3 files: the one in moov holds the EXIF as TIFF structures,
+# the top-level one the preview JPEG
+CR3_METADATA_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+CR3_PREVIEW_UUID = bytes.fromhex('eaf42b5e1c984b88b9fbb7dc406e4d16')
+
+# JPEG start-of-frame markers Pillow decodes: baseline, extended and
+# progressive. Lossless JPEG (SOF3) is how many RAWs store sensor data.
+DECODABLE_SOF = (0xC0, 0xC1, 0xC2)
+
+
+class ContainerExif(dict):
+    # IFD0 tags plus the EXIF and GPS IFDs, read by the same get and get_ifd
+    # calls as PIL's Exif
+    def __init__(self, tags=None, ifds=None):
+        super().__init__(tags or {})
+        self.ifds = ifds or {}
+
+    def get_ifd(self, tag):
+        return self.ifds.get(tag, {})
+
+
+class Ifd(dict):
+    # Decoded tag values of one IFD. Values too large to decode are left out;
+    # locations has the (offset, size) of every value.
+    def __init__(self):
+        super().__init__()
+        self.locations = {}
+        self.next = 0
+
+
+class TiffReader:
+    # Reads IFDs by seeking, so only the directories and the values asked for
+    # are read. Offsets in the structure are relative to base, the TIFF header.
+    def __init__(self, f, base=0):
+        self.f = f
+        self.base = base
+        f.seek(base)
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("Not a TIFF structure")
+        if header[:2] == b'II':
+            self.endian = '<'
+        elif header[:2] == b'MM':
+            self.endian = '>'
+        else:
+            raise ValueError("Not a TIFF structure")
+        # The magic number is 42 in TIFF, but ORF and RW2 use their own
+        self.first = struct.unpack(f'{self.endian}L', header[4:8])[0]
+
+    def unpack(self, fmt, data):
+        return struct.unpack(f'{self.endian}{fmt}', data)
+
+    def ifd(self, offset):
+        ifd = Ifd()
+        self.f.seek(self.base + offset)
+        count_data = self.f.read(2)
+        if len(count_data) < 2:
+            return ifd
+        count = min(self.unpack('H', count_data)[0], MAX_IFD_ENTRIES)
+        entries = self.f.read(count * 12)
+        next_data = self.f.read(4)
+        ifd.next = self.unpack('L', next_data)[0] if len(next_data) == 4 else 0
+        for start in range(0, len(entries) - 11, 12):
+            tag, field_type, value_count = self.unpack('HHL', entries[start:start + 8])
+            if field_type not in TIFF_TYPES:
+                continue
+            fmt, field_size = TIFF_TYPES[field_type]
+            size = field_size * value_count
+            if size <= 4:
+                value_offset = self.base + offset + 2 + start + 8
+                raw = entries[start + 8:start + 8 + size]
+            else:
+                value_offset = self.base + self.unpack('L', entries[start + 8:start + 12])[0]
+                raw = None
+            ifd.locations[tag] = (value_offset, size)
+            if size > MAX_TAG_VALUE_BYTES or (field_type == TIFF_UNDEFINED and size > 4):
+                continue
+            if raw is None:
+                position = self.f.tell()
+                self.f.seek(value_offset)
+                raw = self.f.read(size)
+                self.f.seek(position)
+            if len(raw) == size:
+                ifd[tag] = self.decode(field_type, fmt, value_count, raw)
+        return ifd
+
+    def decode(self, field_type, fmt, count, raw):
+        if field_type == 2:
+            return raw.split(b'\x00', 1)[0].decode('utf-8', 'replace')
+        values = self.unpack(fmt * count, raw)
+        if field_type in (5, 10):
+            values = tuple(numerator / denominator if denominator else 0.0
+                           for numerator, denominator in zip(values[::2], values[1::2]))
+        return values[0] if len(values) == 1 else values
+
+    def chain(self):
+        # IFD0 and the IFDs chained after it, then every SubIFD below them
+        ifds = []
+        pending = [self.first]
+        seen = set()
+        while pending and len(ifds) < MAX_IFDS:
+            offset = pending.pop(0)
+            if not offset or offset in seen:
+                continue
+            seen.add(offset)
+            ifd = self.ifd(offset)
+            ifds.append(ifd)
+            pending.append(ifd.next)
+            sub_ifds = ifd.get(TAG_SUB_IFDS, ())
+            pending.extend(sub_ifds if isinstance(sub_ifds, tuple) else (sub_ifds,))
+        return ifds
+
+    def exif(self, ifd0):
+        ifds = {}
+        for tag in (TAG_EXIF_IFD, TAG_GPS_IFD):
+            if ifd0.get(tag):
+                ifds[tag] = self.ifd(ifd0[tag])
+        return ContainerExif(ifd0, ifds)
+
+
+def jpeg_dimensions(f, offset, length):
+    # (width, height) from the frame header of the JPEG at offset, or None if
+    # it is not a JPEG Pillow can decode
+    end = offset + length
+    f.seek(offset)
+    if f.read(2) != b'\xff\xd8':
+        return None
+    position = offset + 2
+    while position + 4 <= end:
+        f.seek(position)
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            # Fill byte before a marker
+            position += 1
+            continue
+        if marker[1] in DECODABLE_SOF:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return (width, height) if width and height else None
+        if 0xC3 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC) or marker[1] in (0xD9, 0xDA):
+            # Another kind of frame, or image data before any frame header
+            return None
+        position += 2 + struct.unpack('>H', marker[2:4])[0]
+    return None
+
+
+class Preview:
+    def __init__(self, offset, length, size):
+        self.offset = offset
+        self.length = length
+        self.size = size
+
+
+def find_preview(f, candidates, size=None):
+    # The smallest decodable preview covering size on its long edge, else the largest
+    previews = []
+    end = file_end(f)
+    for offset, length in dict.fromkeys(candidates):
+        # Corrupt tags can hold several values; previews cut off by a
+        # truncated file are passed over
+        if not isinstance(offset, int) or not isinstance(length, int):
+            continue
+        if offset <= 0 or length <= 0 or offset + length > end:
+            continue
+        dimensions = jpeg_dimensions(f, offset, length)
+        if dimensions:
+            previews.append(Preview(offset, length, dimensions))
+    if not previews:
+        return None
+    previews.sort(key=lambda preview: preview.size[0] * preview.size[1])
+    if size:
+        for preview in previews:
+            if max(preview.size) >= size:
+                return preview
+    return previews[-1]
+
+def read_preview(f, preview):
+    f.seek(preview.offset)
+    return Image.open(io.BytesIO(f.read(preview.length)))
+
+
+def tiff_raw(f, size):
+    # CR2, NEF, ARW, DNG, ORF, PEF, RW2 and the other TIFF-based RAWs: JPEGs
+    # are referenced by JPEGInterchangeFormat, by single JPEG strips, or in
+    # RW2 by a tag of their own
+    reader = TiffReader(f)
+    ifds = reader.chain()
+    if not ifds:
+        return None, None, None
+    candidates = []
+    sensor_size = None
+    for ifd in ifds:
+        if TAG_JPEG_OFFSET in ifd and TAG_JPEG_LENGTH in ifd:
+            candidates.append((ifd[TAG_JPEG_OFFSET], ifd[TAG_JPEG_LENGTH]))
+        if TAG_RW2_JPEG in ifd.locations:
+            candidates.append(ifd.locations[TAG_RW2_JPEG])
+        strips = ifd.get(TAG_STRIP_OFFSETS)
+        if ifd.get(TAG_COMPRESSION) in JPEG_COMPRESSIONS and isinstance(strips, int):
+            candidates.append((strips, ifd.get(TAG_STRIP_BYTE_COUNTS, 0)))
+        if ifd.get(TAG_PHOTOMETRIC) in SENSOR_PHOTOMETRICS and ifd.get(TAG_NEW_SUBFILE_TYPE, 0) == 0:
+            if ifd.get(TAG_IMAGE_WIDTH) and ifd.get(TAG_IMAGE_LENGTH):
+                sensor_size = (ifd[TAG_IMAGE_WIDTH], ifd[TAG_IMAGE_LENGTH])
+    exif = reader.exif(ifds[0])
+    details = exif.get_ifd(TAG_EXIF_IFD)
+    if sensor_size is None and details.get(TAG_PIXEL_X_DIMENSION) and details.get(TAG_PIXEL_Y_DIMENSION):
+        sensor_size = (details[TAG_PIXEL_X_DIMENSION], details[TAG_PIXEL_Y_DIMENSION])
+    return find_preview(f, candidates, size), exif, sensor_size
+
+def raf_raw(f, size):
+    # Fujifilm: a fixed header pointing at the preview JPEG, which carries the EXIF
+    f.seek(84)
+    header = f.read(8)
+    if len(header) < 8:
+        return None, None, None
+    return find_preview(f, [struct.unpack('>LL', header)], size), None, None
+
+
+def iter_boxes(f, start, end):
+    # (type, payload offset, payload end) of the ISO BMFF boxes in start..end
+    position = start
+    count = 0
+    while position + 8 <= end and count < MAX_BOXES:
+        count += 1
+        f.seek(position)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        box_size, box_type = struct.unpack('>L4s', header)
+        payload = position + 8
+        if box_size == 1:
+            large_size = f.read(8)
+            if len(large_size) < 8:
+                return
+            box_size = struct.unpack('>Q', large_size)[0]
+            payload += 8
+        elif box_size == 0:
+            box_size = end - position
+        if box_size < payload - position:
+            return
+        box_end = min(position + box_size, end)
+        if box_type == b'uuid':
+            yield box_type + f.read(16), payload + 16, box_end
+        else:
+            yield box_type, payload, box_end
+        position = position + box_size
+
+def file_end(f):
+    return f.seek(0, os.SEEK_END)
+
+def tiff_box_ifd(f, start):
+    try:
+        reader = TiffReader(f, start)
+        return reader.ifd(reader.first)
+    except (ValueError, struct.error):
+        return Ifd()
+
+def cr3_raw(f, size):
+    # Canon CR3 (ISO BMFF): EXIF in the CMT boxes of the metadata UUID box,
+    # a ~160 px THMB there and a ~1620 px PRVW in the preview UUID box
+    end = file_end(f)
+    exif = None
+    candidates = []
+    for box_type, start, box_end in iter_boxes(f, 0, end):
+        if box_type == b'moov':
+            for child_type, child_start, child_end in iter_boxes(f, start, box_end):
+                if child_type != b'uuid' + CR3_METADATA_UUID:
+                    continue
+                tags = {}
+                for item_type, item_start, item_end in iter_boxes(f, child_start, child_end):
+                    if item_type == b'CMT1':
+                        tags['ifd0'] = tiff_box_ifd(f, item_start)
+                    elif item_type == b'CMT2':
+                        tags[TAG_EXIF_IFD] = tiff_box_ifd(f, item_start)
+                    elif item_type == b'CMT4':
+                        tags[TAG_GPS_IFD] = tiff_box_ifd(f, item_start)
+                    elif item_type == b'THMB':
+                        candidates.append(soi_range(f, item_start, item_end))
+                if tags:
+                    exif = ContainerExif(tags.pop('ifd0', {}), tags)
+        elif box_type == b'uuid' + CR3_PREVIEW_UUID:
+            for child_type, child_start, child_end in iter_boxes(f, start + 8, box_end):
+                if child_type == b'PRVW':
+                    candidates.append(soi_range(f, child_start, child_end))
+    details = exif.get_ifd(TAG_EXIF_IFD) if exif else {}
+    sensor_size = None
+    if details.get(TAG_PIXEL_X_DIMENSION) and details.get(TAG_PIXEL_Y_DIMENSION):
+        sensor_size = (details[TAG_PIXEL_X_DIMENSION], details[TAG_PIXEL_Y_DIMENSION])
+    return find_preview(f, [candidate for candidate in candidates if candidate], size), exif, sensor_size
+
+def soi_range(f, start, end):
+    # The JPEG in a box whose few header fields come before it
+    f.seek(start)
+    offset = f.read(min(64, end - start)).find(b'\xff\xd8\xff')
+    return (start + offset, end - start - offset) if offset >= 0 else None
+
+
+def heif_metadata(f):
+    # EXIF and the primary image's dimensions from the meta box of a HEIF
+    # file. The images themselves are HEVC coded, previews included.
+    end = file_end(f)
+    meta = next(((start, box_end) for box_type, start, box_end in iter_boxes(f, 0, end) if box_type == b'meta'),
+                None)
+    if meta is None:
+        return None, None
+    primary = None
+    exif_items = []
+    locations = {}
+    properties = []
+    associations = {}
+    # meta is a full box: version and flags come first
+    for box_type, start, box_end in iter_boxes(f, meta[0] + 4, meta[1]):
+        f.seek(start)
+        data = f.read(min(box_end - start, MAX_TAG_VALUE_BYTES * 16))
+        if len(data) < 6:
+            # Shorter than any full box these are read from
+            continue
+        if box_type == b'pitm':
+            primary = int.from_bytes(data[4:6] if data[0] == 0 else data[4:8], 'big')
+        elif box_type == b'iinf':
+            entry_start = start + (6 if data[0] == 0 else 8)
+            for entry_type, infe_start, infe_end in iter_boxes(f, entry_start, box_end):
+                f.seek(infe_start)
+                infe = f.read(min(infe_end - infe_start, 64))
+                if entry_type != b'infe' or len(infe) < 12 or infe[0] < 2:
+                    continue
+                if infe[0] == 2:
+                    item_id, item_type = struct.unpack('>H', infe[4:6])[0], infe[8:12]
+                else:
+                    item_id, item_type = struct.unpack('>L', infe[4:8])[0], infe[10:14]
+                if item_type == b'Exif':
+                    exif_items.append(item_id)
+        elif box_type == b'iloc':
+            locations = parse_iloc(data)
+        elif box_type == b'iprp':
+            for child_type, child_start, child_end in iter_boxes(f, start, box_end):
+                if child_type == b'ipco':
+                    for property_type, property_start, property_end in iter_boxes(f, child_start, child_end):
+                        f.seek(property_start)
+                        properties.append((property_type, f.read(min(property_end - property_start, 64))))
+                elif child_type == b'ipma':
+                    f.seek(child_start)
+                    associations = parse_ipma(f.read(child_end - child_start))
+
+    size = None
+    for index in associations.get(primary, ()):
+        if 0 < index <= len(properties) and properties[index - 1][0] == b'ispe':
+            ispe = properties[index - 1][1]
+            if len(ispe) >= 12:
+                size = struct.unpack('>LL', ispe[4:12])
+    exif = None
+    for item_id in exif_items:
+        extents = locations.get(item_id)
+        if not extents:
+            continue
+        offset, length = extents[0]
+        f.seek(offset)
+        try:
+            # The item starts with the offset of the TIFF header within what follows
+            header_offset = struct.unpack('>L', f.read(4))[0]
+            reader = TiffReader(f, offset + 4 + header_offset)
+            exif = reader.exif(reader.ifd(reader.first))
+        except (ValueError, struct.error):
+            continue
+        break
+    return exif, size
+
+def parse_iloc(data):
+    # item_ID -> [(offset, length)] of items stored in the file itself
+    version = data[0]
+    offset_size, length_size = data[4] >> 4, data[4] & 0x0F
+    base_offset_size, index_size = data[5] >> 4, (data[5] & 0x0F if version in (1, 2) else 0)
+    position = 6
+
+    def read(size):
+        nonlocal position
+        value = int.from_bytes(data[position:position + size], 'big') if size else 0
+        position += size
+        return value
+
+    item_count = read(2 if version < 2 else 4)
+    locations = {}
+    for _ in range(item_count):
+        if position >= len(data):
+            break
+        item_id = read(2 if version < 2 else 4)
+        construction_method = read(2) & 0x0F if version in (1, 2) else 0
+        read(2)
+        base_offset = read(base_offset_size)
+        extents = []
+        for _ in range(read(2)):
+            read(index_size)
+            extents.append((base_offset + read(offset_size), read(length_size)))
+        if construction_method == 0:
+            locations[item_id] = extents
+    return locations
+
+def parse_ipma(data):
+    # item_ID -> 1-based indexes of its properties in ipco
+    if len(data) < 8:
+        return {}
+    version, flags = data[0], int.from_bytes(data[1:4], 'big')
+    position = 8
+    associations = {}
+    for _ in range(struct.unpack('>L', data[4:8])[0]):
+        id_size = 2 if version == 0 else 4
+        if position + id_size + 1 > len(data):
+            break
+        item_id = int.from_bytes(data[position:position + id_size], 'big')
+        count = data[position + id_size]
+        position += id_size + 1
+        indexes = []
+        for _ in range(count):
+            if flags & 1:
+                indexes.append(int.from_bytes(data[position:position + 2], 'big') & 0x7FFF)
+                position += 2
+            else:
+                indexes.append(int.from_bytes(data[position:position + 1], 'big') & 0x7F)
+                position += 1
+        associations[item_id] = indexes
+    return associations
+
+
+_heif_lock = threading.Lock()
+_heif_registered = False
+
+def heif_available():
+    # HEVC decoding comes from the optional pillow-heif plugin
+    global _heif_registered
+    with _heif_lock:
+        if not _heif_registered and importlib.util.find_spec('pillow_heif') is not None:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+            _heif_registered = True
+    return _heif_registered
+
+def source_file(file_path, data=None):
+    return io.BytesIO(data) if data is not None else open(file_path, 'rb')
+
+def decode_heif(file_path, data, extension):
+    if not heif_available():
+        raise ValueError(f"Decoding {extension} files needs pillow-heif")
+    return Image.open(source_file(file_path, data))
+
+def decode_raw(file_path, data, extension):
+    # Full decode of a RAW without a usable preview, at half size, which skips
+    # demosaicing interpolation and is still larger than any thumbnail
+    if importlib.util.find_spec('rawpy') is None:
+        raise ValueError(f"{extension} file has no embedded preview; decoding it needs rawpy")
+    import rawpy
+    with source_file(file_path, data) as f, rawpy.imread(f) as raw:
+        return Image.fromarray(raw.postprocess(half_size=True, use_camera_wb=True))
+
+def raw_container(f):
+    # The reader of the RAW container in f, by its signature
+    f.seek(0)
+    magic = f.read(16)
+    if magic.startswith(b'FUJIFILMCCD-RAW'):
+        return raf_raw
+    if magic[4:12] == b'ftypcrx ':
+        return cr3_raw
+    if magic[:2] in (b'II', b'MM'):
+        return tiff_raw
+    return None
+
+
+class ImageSource:
+    # What indexing, thumbnails and analysis read from an image file: a PIL
+    # image to decode, and the dimensions and EXIF of the original. For RAW
+    # and HEIF files those two come from the container, and the image is an
+    # embedded preview, or a full decode done only once image is read.
+    def __init__(self, image=None, size=None, exif=None, decode=None):
+        self._image = image
+        self._size = size
+        self._exif = exif
+        self._decode = decode
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = self._decode()
+        return self._image
+
+    @property
+    def size(self):
+        return self._size or self.image.size
+
+    @property
+    def exif(self):
+        if self._exif is None:
+            self._exif = self.image.getexif()
+        return self._exif
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_image(file_path, data=None, size=None):
+    # An ImageSource for file_path, reading data instead when its bytes are at
+    # hand. A RAW file opens its smallest embedded JPEG preview at least size
+    # pixels on the long edge (the largest with no size): a few KB of
+    # directories and one preview read instead of decoding the sensor data.
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in CONTAINER_EXTENSIONS:
+        return ImageSource(Image.open(io.BytesIO(data) if data is not None else file_path))
+    if extension in HEIF_EXTENSIONS:
+        with source_file(file_path, data) as f:
+            exif, dimensions = heif_metadata(f)
+        return ImageSource(None, dimensions, exif or ContainerExif(),
+                           decode=lambda: decode_heif(file_path, data, extension))
+    with source_file(file_path, data) as f:
+        reader = raw_container(f)
+        preview, exif, dimensions = reader(f, size) if reader else (None, None, None)
+        if preview:
+            # RAF keeps its EXIF in the preview
+            return ImageSource(read_preview(f, preview), dimensions, exif)
+    logger.debug(f"No decodable preview in {file_path}; decoding it in full")
+    return ImageSource(None, dimensions, exif or ContainerExif(),
+                       decode=lambda: decode_raw(file_path, data, extension))
@@ -0,0 +1,569 @@
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+import contextlib
+import collections
+import multiprocessing
+import concurrent.futures
+
+from db import IMAGE_PROPERTY_COLUMNS, BatchWriter, create_connection
+from metrics import StageTimings, metrics
+from image_formats import open_image
+from similarity import compute_perceptual_hashes
+from thumbnails import THUMBNAIL_SIZES, reduce_decode, remove_thumbnails, save_thumbnails
+
+logger = logging.getLogger(__name__)
+
+# Pipeline sizing. Hashing is I/O bound so it gets threads; thumbnail and EXIF
+# decoding is CPU bound so it gets processes. Every queue is bounded so a slow
+# stage pushes back on the walker instead of buffering the whole tree in memory.
+HASH_WORKERS = int(os.environ.get('INDEX_HASH_WORKERS', min(32, (os.cpu_count() or 1) * 2)))
+IMAGE_WORKERS = int(os.environ.get('INDEX_IMAGE_WORKERS', os.cpu_count() or 1))
+PATH_QUEUE_SIZE = int(os.environ.get('INDEX_PATH_QUEUE_SIZE', 1024))
+IMAGE_QUEUE_SIZE = int(os.environ.get('INDEX_IMAGE_QUEUE_SIZE', 256))
+WRITE_QUEUE_SIZE = int(os.environ.get('INDEX_WRITE_QUEUE_SIZE', 1024))
+# Image workers start from a fresh interpreter rather than a fork of this
+# process: forking a threaded server (job and gthread worker threads) copies
+# whatever locks other threads held at that moment into the child
+IMAGE_POOL_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Each file is read once: files up to BUFFER_MAX_BYTES are read into memory,
+# hashed, and the same bytes are handed to the image stage. Bytes held this way
+# are capped at BUFFER_BUDGET_BYTES; past either limit a file is hashed as a
+# stream and reopened by the image stage instead.
+READ_CHUNK_SIZE = int(os.environ.get('INDEX_READ_CHUNK_SIZE', 1024 * 1024))
+BUFFER_MAX_BYTES = int(os.environ.get('INDEX_BUFFER_MAX_BYTES', 64 * 1024 * 1024))
+BUFFER_BUDGET_BYTES = int(os.environ.get('INDEX_BUFFER_BUDGET_BYTES', 512 * 1024 * 1024))
+
+# Most recent error messages kept for progress reporting
+MAX_RECORDED_ERRORS = 100
+PROGRESS_INTERVAL = 0.5
+
+# Paths per query when a paths run loads its stat cache
+STAT_CACHE_LOOKUP_BATCH = 500
+
+_DONE = object()
+
+
+def create_image_hash(file_path, chunk_size=READ_CHUNK_SIZE):
+    # Streams files too large to buffer through one reused chunk_size buffer.
+    # hashlib.file_digest does the same with a fixed 256 KiB buffer, so it is
+    # not used: INDEX_READ_CHUNK_SIZE applies here as in read_file.
+    hasher = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            hasher.update(view[:count])
+    view.release()
+    return hasher.hexdigest()
+
+def read_file(file_path, size, chunk_size=READ_CHUNK_SIZE):
+    # Reads straight into one preallocated buffer, without per-chunk copies
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    read = 0
+    with open(file_path, 'rb', buffering=0) as f:
+        while read < size:
+            count = f.readinto(view[read:read + chunk_size])
+            if not count:
+                break
+            read += count
+    view.release()
+    # The file shrank since it was stat'ed
+    del buffer[read:]
+    return buffer
+
+# EXIF tag ids
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+TAG_MAKE = 271
+TAG_MODEL = 272
+TAG_ORIENTATION = 274
+TAG_DATETIME = 306
+TAG_DATETIME_ORIGINAL = 36867
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+
+def exif_text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    value = str(value).strip('\x00 ') if value is not None else ''
+    return value or None
+
+def exif_datetime(value):
+    # EXIF stores local time as 'YYYY:MM:DD HH:MM:SS' with no zone; keep it
+    # local and ISO formatted so string order is date order
+    value = exif_text(value)
+    try:
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.strptime(value[:19], '%Y:%m:%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+def gps_degrees(value, ref):
+    try:
+        degrees, minutes, seconds = (float(part) for part in value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if exif_text(ref) in ('S', 'W') else result
+
+def get_image_properties(source):
+    # Read from the header and EXIF, or the RAW or HEIF container, so call
+    # before a reduced decode changes the image's size
+    width, height = source.size
+    exif = source.exif
+    if exif.get(TAG_ORIENTATION) in (5, 6, 7, 8):
+        # Rotated 90 degrees on display
+        width, height = height, width
+    details = exif.get_ifd(EXIF_IFD)
+    gps = exif.get_ifd(GPS_IFD)
+    return {
+        'width': width,
+        'height': height,
+        'date_taken': exif_datetime(details.get(TAG_DATETIME_ORIGINAL)) or exif_datetime(exif.get(TAG_DATETIME)),
+        'camera_make': exif_text(exif.get(TAG_MAKE)),
+        'camera_model': exif_text(exif.get(TAG_MODEL)),
+        'gps_latitude': gps_degrees(gps.get(GPS_LATITUDE), gps.get(GPS_LATITUDE_REF)),
+        'gps_longitude': gps_degrees(gps.get(GPS_LONGITUDE), gps.get(GPS_LONGITUDE_REF)),
+    }
+
+
+def process_image(file_path, file_hash=None, thumbnail=True, data=None):
+    # Runs in a worker process: everything derived from one reduced-scale decode,
+    # of the bytes the hash was computed from when the hash stage passes them on.
+    # RAW files decode an embedded preview instead (see image_formats).
+    # Stage timings come back under 'timings' for the parent to record.
+    timings = StageTimings()
+    derived = {'thumbnail_path': None, **dict.fromkeys(IMAGE_PROPERTY_COLUMNS)} if thumbnail else {}
+    try:
+        with open_image(file_path, data, size=max(THUMBNAIL_SIZES)) as source:
+            with timings.stage('exif'):
+                derived.update(get_image_properties(source))
+            with timings.stage('decode'):
+                img = reduce_decode(source.image)
+                img.load()
+            with timings.stage('perceptual_hash'):
+                derived.update(compute_perceptual_hashes(img))
+            if thumbnail:
+                with timings.stage('thumbnail'):
+                    derived['thumbnail_path'] = save_thumbnails(img, file_hash)
+    except Exception as e:
+        # If file is not an image or there's an error, log it and continue
+        logger.info(f"Could not process image {file_path}: {e}")
+    derived['timings'] = timings.timings
+    return derived
+
+
+class IndexPipeline:
+    # walker -> path queue -> hash threads -> image processes -> write queue -> DB writer
+    # With paths, only those files are indexed instead of walking path, and
+    # rows are looked up as needed rather than all loaded up front. An
+    # image_pool passed in is used as is and left running for its owner.
+    def __init__(self, path, incremental=True, hash_workers=None, image_workers=None,
+                 path_queue_size=None, image_queue_size=None, write_queue_size=None,
+                 write_batch_size=None, cancel_event=None, on_progress=None, paths=None, image_pool=None):
+        self.path = path
+        self.image_pool = image_pool
+        self.paths = paths
+        self.incremental = incremental
+        self.hash_workers = hash_workers or HASH_WORKERS
+        self.image_workers = image_workers or IMAGE_WORKERS
+        self.write_batch_size = write_batch_size
+        self.path_queue = queue.Queue(maxsize=path_queue_size or PATH_QUEUE_SIZE)
+        self.write_queue = queue.Queue(maxsize=write_queue_size or WRITE_QUEUE_SIZE)
+        # Caps the number of files submitted to the image pool but not yet written
+        self.image_slots = threading.BoundedSemaphore(image_queue_size or IMAGE_QUEUE_SIZE)
+        # Files submitted to the image pool whose rows are not queued for writing yet
+        self.pending_images = 0
+        self.images_done = threading.Condition()
+
+        self.cancel_event = cancel_event or threading.Event()
+        self.on_progress = on_progress
+
+        self.stats = {'discovered': 0, 'scanned': 0, 'skipped': 0, 'rehashed': 0, 'new': 0, 'moved': 0,
+                      'bytes_hashed': 0, 'errors': 0}
+        self.walk_done = False
+        self.recorded_errors = collections.deque(maxlen=MAX_RECORDED_ERRORS)
+        self.stats_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.stat_cache = {}
+        self.paths_by_hash = {}
+        self.claimed_paths = set()
+        self.looked_up_hashes = set()
+        self.buffer_lock = threading.Lock()
+        self.buffered_bytes = 0
+
+    def count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def record_error(self, message):
+        logger.error(message)
+        self.count('errors')
+        self.recorded_errors.append(message)
+
+    def report_progress(self):
+        if self.on_progress:
+            with self.stats_lock:
+                stats = dict(self.stats)
+            self.on_progress(stats, self.walk_done, list(self.recorded_errors))
+
+    def load_stat_cache(self, cursor):
+        # Stat cache of already indexed files, keyed on path. A file whose size,
+        # mtime_ns and inode all match its cached row is skipped without being opened.
+        if self.paths is not None:
+            for start in range(0, len(self.paths), STAT_CACHE_LOOKUP_BATCH):
+                batch = self.paths[start:start + STAT_CACHE_LOOKUP_BATCH]
+                self.cache_rows(cursor, f"file_path IN ({', '.join('?' for _ in batch)})", batch)
+            return
+        self.cache_rows(cursor)
+
+    def cache_rows(self, cursor, condition=None, params=()):
+        cursor.execute(f"SELECT id, file_path, file_size, mtime_ns, inode, hash, thumbnail_path, ahash, dhash, phash, "
+                       f"{', '.join(IMAGE_PROPERTY_COLUMNS)} FROM files"
+                       f"{f' WHERE {condition}' if condition else ''}", params)
+        for row in cursor.fetchall():
+            self.stat_cache[row['file_path']] = dict(row)
+            self.paths_by_hash.setdefault(row['hash'], set()).add(row['file_path'])
+
+    def paths_for_hash(self, file_hash):
+        # Caller holds cache_lock. A full run has every row cached; a paths run
+        # loads the rows sharing a hash the first time it sees the hash.
+        if self.paths is not None and file_hash not in self.looked_up_hashes:
+            self.looked_up_hashes.add(file_hash)
+            conn = create_connection()
+            try:
+                self.cache_rows(conn.cursor(), 'hash = ?', (file_hash,))
+            finally:
+                conn.close()
+        return self.paths_by_hash.get(file_hash, ())
+
+    def run(self):
+        logger.info(f"Indexing directory: {self.path} (incremental={self.incremental})")
+
+        conn = create_connection()
+        try:
+            cursor = conn.cursor()
+            self.load_stat_cache(cursor)
+
+            with contextlib.ExitStack() as stack:
+                if self.image_pool is None:
+                    self.image_pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.image_workers, mp_context=IMAGE_POOL_CONTEXT))
+                feeder = threading.Thread(target=self.feed, name='index-feeder', daemon=True)
+                feeder.start()
+                # The single DB writer runs on the calling thread
+                writer = BatchWriter(conn, batch_size=self.write_batch_size, on_error=self.write_error)
+                try:
+                    self.write_rows(writer)
+                finally:
+                    writer.close()
+                feeder.join()
+        finally:
+            conn.close()
+
+        self.report_progress()
+        logger.info(f"Indexing finished for {self.path}: {self.stats}")
+        return self.stats
+
+    def feed(self):
+        hashers = [threading.Thread(target=self.hash_files, name=f'index-hash-{i}', daemon=True)
+                   for i in range(self.hash_workers)]
+        for hasher in hashers:
+            hasher.start()
+        try:
+            self.walk()
+        finally:
+            for _ in hashers:
+                self.path_queue.put(_DONE)
+            for hasher in hashers:
+                hasher.join()
+            # Every image future has to land in the write queue before the writer stops
+            with self.images_done:
+                self.images_done.wait_for(lambda: self.pending_images == 0)
+            self.write_queue.put(_DONE)
+
+    def walk(self):
+        if self.paths is not None:
+            for file_path in self.paths:
+                if self.cancel_event.is_set():
+                    return
+                # Files can be gone again by the time a watcher batch is indexed
+                if os.path.isfile(file_path):
+                    self.count('discovered')
+                    self.path_queue.put(os.path.split(file_path))
+            self.walk_done = True
+            return
+        for root, _, files in os.walk(self.path, onerror=self.walk_error):
+            for file in files:
+                if self.cancel_event.is_set():
+                    return
+                self.count('discovered')
+                self.path_queue.put((root, file))
+        self.walk_done = True
+
+    def walk_error(self, error):
+        self.record_error(f"Could not read directory {error.filename}: {error}")
+
+    def hash_files(self):
+        while True:
+            item = self.path_queue.get()
+            if item is _DONE:
+                return
+            if self.cancel_event.is_set():
+                # Keep draining so the walker never blocks on a full queue
+                continue
+            root, file = item
+            try:
+                self.hash_file(root, file)
+            except Exception as exc:
+                self.record_error(f"Failed to index {os.path.join(root, file)}: {exc}")
+
+    def read_contents(self, file_path, size):
+        # Returns the file's bytes if they fit the buffer budget, else None
+        with self.buffer_lock:
+            if size > BUFFER_MAX_BYTES or self.buffered_bytes + size > BUFFER_BUDGET_BYTES:
+                return None
+            self.buffered_bytes += size
+        try:
+            return read_file(file_path, size)
+        except Exception:
+            self.release_buffer(size)
+            raise
+
+    def release_buffer(self, size):
+        with self.buffer_lock:
+            self.buffered_bytes -= size
+
+    def is_unchanged(self, cached, file_stat):
+        return (cached['file_size'] == file_stat.st_size
+                and cached['mtime_ns'] == file_stat.st_mtime_ns
+                and cached['inode'] == file_stat.st_ino)
+
+    def claim_moved_from(self, file_hash, file_path):
+        # A row with the same content whose path is gone from disk is a rename or move
+        with self.cache_lock:
+            for old_path in self.paths_for_hash(file_hash):
+                if old_path != file_path and old_path not in self.claimed_paths and not os.path.exists(old_path):
+                    self.claimed_paths.add(old_path)
+                    return old_path
+        return None
+
+    def hash_file(self, root, file):
+        file_path = os.path.join(root, file)
+        file_stat = os.stat(file_path)
+        self.count('scanned')
+
+        cached = self.stat_cache.get(file_path)
+        if self.incremental and cached and self.is_unchanged(cached, file_stat):
+            self.count('skipped')
+            if cached['thumbnail_path'] and (cached['phash'] is None or cached['width'] is None):
+                # Indexed before perceptual hashes or image properties were
+                # stored: backfill without rehashing
+                self.submit_image('update', {'id': cached['id'], 'file_path': file_path}, file_path,
+                                  thumbnail=False)
+            return
+
+        data = self.read_contents(file_path, file_stat.st_size)
+        try:
+            with metrics.stage('hash'):
+                file_hash = hashlib.sha256(data).hexdigest() if data is not None else create_image_hash(file_path)
+            metrics.inc('stage_bytes_total', file_stat.st_size, stage='hash')
+            self.count('bytes_hashed', file_stat.st_size)
+            # Ownership of data passes to the image stage if the file goes there
+            if self.index_file(file, file_path, file_stat, cached, file_hash, data):
+                data = None
+        finally:
+            if data is not None:
+                self.release_buffer(file_stat.st_size)
+
+    def index_file(self, file, file_path, file_stat, cached, file_hash, data):
+        # Returns True if data was handed to the image stage
+        meta = {
+            'file_name': file,
+            'file_path': file_path,
+            'file_size': file_stat.st_size,
+            'file_format': os.path.splitext(file)[1],
+            'date_created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(file_stat.st_ctime)),
+            'date_modified': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(file_stat.st_mtime)),
+            'hash': file_hash,
+            'mtime_ns': file_stat.st_mtime_ns,
+            'inode': file_stat.st_ino,
+        }
+
+        if cached:
+            logger.info(f"File changed on disk; rehashed: {file_path}")
+            self.count('rehashed')
+            meta['id'] = cached['id']
+            if cached['hash'] != file_hash:
+                return self.submit_image('update', meta, file_path, data=data)
+            self.write_queue.put(('update', meta, file_path))
+            return False
+
+        old_path = self.claim_moved_from(file_hash, file_path)
+        if old_path:
+            logger.info(f"File moved from {old_path}; updating path: {file_path}")
+            self.count('moved')
+            meta['id'] = self.stat_cache[old_path]['id']
+            self.write_queue.put(('update', meta, old_path))
+            return False
+
+        logger.info(f"Adding new file to database: {file_path}")
+        self.count('new')
+        derived = self.derived_for_hash(file_hash)
+        if derived:
+            # A copy of content already indexed shares its thumbnail and hashes
+            meta.update(derived)
+            self.write_queue.put(('insert', meta, None))
+            return False
+        return self.submit_image('insert', meta, None, data=data)
+
+    def derived_for_hash(self, file_hash):
+        with self.cache_lock:
+            rows = [self.stat_cache[path] for path in self.paths_for_hash(file_hash)]
+        for cached in rows:
+            if (cached['thumbnail_path'] and cached['phash'] is not None and cached['width'] is not None
+                    and os.path.exists(cached['thumbnail_path'])):
+                return {key: cached[key] for key in ('thumbnail_path', 'ahash', 'dhash', 'phash', *IMAGE_PROPERTY_COLUMNS)}
+        return None
+
+    def submit_image(self, action, meta, old_path, thumbnail=True, data=None):
+        # Blocks while the image stage is saturated. Takes ownership of data,
+        # whose buffer budget is released once the worker is done with it.
+        self.image_slots.acquire()
+        with self.images_done:
+            self.pending_images += 1
+        try:
+            future = self.image_pool.submit(process_image, meta['file_path'], meta.get('hash'), thumbnail, data)
+        except Exception:
+            self.image_done()
+            raise
+
+        def on_done(done):
+            if data is not None:
+                self.release_buffer(meta['file_size'])
+            try:
+                derived = done.result()
+                metrics.record_stages(derived.pop('timings'))
+                meta.update(derived)
+            except Exception as exc:
+                self.record_error(f"Image processing failed for {meta['file_path']}: {exc}")
+                if thumbnail:
+                    meta['thumbnail_path'] = None
+            self.write_queue.put((action, meta, old_path))
+            self.image_done()
+
+        future.add_done_callback(on_done)
+        return data is not None
+
+    def image_done(self):
+        self.image_slots.release()
+        with self.images_done:
+            self.pending_images -= 1
+            self.images_done.notify_all()
+
+    def write_rows(self, writer):
+        last_progress = 0
+        while True:
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                self.report_progress()
+                last_progress = time.monotonic()
+            try:
+                item = self.write_queue.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            action, meta, old_path = item
+            try:
+                if action == 'insert':
+                    writer.insert(meta)
+                else:
+                    writer.update(meta['id'], meta)
+            except Exception as exc:
+                self.record_error(f"Failed to write {meta['file_path']}: {exc}")
+
+    def write_error(self, row, error):
+        self.record_error(f"Failed to write row for {row}: {error}")
+
+def index_directory(path, incremental=True, **pipeline_options):
+    return IndexPipeline(path, incremental=incremental, **pipeline_options).run()
+
+def index_paths(root, paths, **pipeline_options):
+    # Indexes (or reindexes, if changed) the given files under root
+    paths = list(dict.fromkeys(paths))
+    workers = max(1, min(len(paths), HASH_WORKERS))
+    pipeline_options.setdefault('hash_workers', workers)
+    pipeline_options.setdefault('image_workers', max(1, min(len(paths), IMAGE_WORKERS)))
+    return IndexPipeline(root, paths=paths, **pipeline_options).run()
+
+
+def _prefix_range(path):
+    # Bounds of every path under directory path, so the file_path index
+    # serves subtree queries: the separator's successor sorts after all of them
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+def _subtree_condition(path):
+    low, high = _prefix_range(path)
+    return '(file_path = ? OR (file_path >= ? AND file_path < ?))', (path, low, high)
+
+def remove_indexed(conn, paths):
+    # Deletes the rows of each path, or of every file under it for a directory,
+    # along with thumbnails no remaining row shares. Returns the rows removed.
+    removed = []
+    with conn:
+        for path in paths:
+            condition, params = _subtree_condition(path)
+            removed += conn.execute(f'SELECT hash, thumbnail_path FROM files WHERE {condition}', params).fetchall()
+            conn.execute(f'DELETE FROM files WHERE {condition}', params)
+    if removed:
+        remove_thumbnails(conn, removed)
+    return len(removed)
+
+def rename_indexed(conn, old_path, new_path):
+    # Points rows at a file's or directory's new location without rehashing.
+    # Like a rename on disk, it replaces whatever was indexed at new_path.
+    remove_indexed(conn, [new_path])
+    low, high = _prefix_range(old_path)
+    with conn:
+        name = os.path.basename(new_path)
+        moved = conn.execute('UPDATE files SET file_path = ?, file_name = ?, file_format = ? WHERE file_path = ?',
+                             (new_path, name, os.path.splitext(name)[1], old_path)).rowcount
+        moved += conn.execute('UPDATE files SET file_path = ? || substr(file_path, ?) '
+                              'WHERE file_path >= ? AND file_path < ?',
+                              (new_path, len(old_path) + 1, low, high)).rowcount
+    return moved
+
+def remove_missing(conn, root):
+    # Drops rows under root whose files no longer exist, e.g. deleted while
+    # nothing was watching
+    condition, params = _subtree_condition(root)
+    missing = [row['file_path'] for row in conn.execute(f'SELECT file_path FROM files WHERE {condition}', params)
+               if not os.path.exists(row['file_path'])]
+    return remove_indexed(conn, missing) if missing else 0
+
+
+def run_index_job(job):
+    options = job.options
+
+    def on_progress(stats, walk_done, errors):
+        job.report({
+            **stats,
+            'done': stats['scanned'],
+            'total': stats['discovered'] if walk_done else None,
+            'bytes': stats['bytes_hashed'],
+        }, errors)
+
+    # A resumed job always runs incrementally: rows committed before the
+    # interruption match the stat cache and are skipped without being reopened
+    incremental = options.get('incremental', True) or options.get('resumed', False)
+    IndexPipeline(options['path'], incremental=incremental, cancel_event=job.cancel_event,
+                  on_progress=on_progress, **options.get('pipeline', {})).run()
+
@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+
+from db import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Enough workers that a long analysis batch doesn't hold up an index run
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Minimum seconds between progress writes to the jobs table
+PROGRESS_SAVE_INTERVAL = 1.0
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp)) if timestamp else None
+
+_owner = (None, None)
+
+def process_owner():
+    # Identifies the process running a job: pid plus start time, so a reused
+    # pid is not mistaken for the process that queued the job
+    global _owner
+    pid = os.getpid()
+    if _owner[0] != pid:
+        import psutil
+        _owner = (pid, f"{pid}:{psutil.Process(pid).create_time():.2f}")
+    return _owner[1]
+
+def owner_alive(owner):
+    if not owner:
+        return False
+    import psutil
+    pid, _, started = owner.partition(':')
+    try:
+        return f"{psutil.Process(int(pid)).create_time():.2f}" == started
+    except (ValueError, psutil.Error):
+        return False
+
+
+class Job:
+    def __init__(self, job_id, kind, options, status='queued', progress=None, errors=None,
+                 created_at=None, started_at=None, finished_at=None, owner=None):
+        self.id = job_id
+        self.kind = kind
+        self.options = options
+        self.status = status
+        # Runners report `done`, optionally `total` and `bytes`, plus any counters of their own
+        self.progress = progress or {}
+        self.errors = errors or []
+        self.created_at = created_at or time.time()
+        self.started_at = started_at
+        self.finished_at = finished_at
+        # process_owner() of the process running the job; with several server
+        # processes only that one has it in memory
+        self.owner = owner
+        self.cancel_event = threading.Event()
+        self.last_saved = 0
+        self.save_lock = threading.Lock()
+        # Per-item statuses waiting to be flushed to job_items on the next save
+        self.pending_items = {}
+        self.items_lock = threading.Lock()
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['kind'], json.loads(row['options']), row['status'],
+                   json.loads(row['progress']) if row['progress'] else None,
+                   json.loads(row['errors']) if row['errors'] else None,
+                   row['created_at'], row['started_at'], row['finished_at'], row['owner'])
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def record_item(self, key, status, attempts=0, error=None):
+        with self.items_lock:
+            self.pending_items[key] = (status, attempts, error, time.time())
+
+    def report(self, progress, errors=None):
+        self.progress = progress
+        if errors is not None:
+            self.errors = errors
+        if time.monotonic() - self.last_saved >= PROGRESS_SAVE_INTERVAL:
+            self.save()
+
+    def rates(self):
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0
+        done = self.progress.get('done', 0)
+        total = self.progress.get('total')
+        files_per_sec = done / elapsed if elapsed > 0 else 0
+        eta = None
+        if self.status == 'running' and total is not None and files_per_sec > 0:
+            eta = max(total - done, 0) / files_per_sec
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'files_per_sec': round(files_per_sec, 2),
+            'bytes_per_sec': round(self.progress.get('bytes', 0) / elapsed, 2) if elapsed > 0 else 0,
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'options': self.options,
+            'progress': self.progress,
+            **self.rates(),
+            'errors': self.errors,
+            'created_at': format_time(self.created_at),
+            'started_at': format_time(self.started_at),
+            'finished_at': format_time(self.finished_at),
+        }
+
+    def save(self):
+        with self.save_lock:
+            self.last_saved = time.monotonic()
+            with self.items_lock:
+                items, self.pending_items = self.pending_items, {}
+            conn = create_connection()
+            try:
+                self.write(conn, items)
+            finally:
+                conn.close()
+
+    def write(self, conn, items):
+        with conn:
+            # A row cancelled by another process stays cancelled, and tells the
+            # runner here to stop
+            cursor = conn.execute('''
+            INSERT INTO jobs (id, kind, status, options, progress, errors, created_at, started_at, finished_at,
+                              updated_at, owner)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET status = excluded.status, options = excluded.options,
+                progress = excluded.progress, errors = excluded.errors, started_at = excluded.started_at,
+                finished_at = excluded.finished_at, updated_at = excluded.updated_at, owner = excluded.owner
+            WHERE jobs.status != 'cancelled' OR excluded.status = 'cancelled'
+            ''', (self.id, self.kind, self.status, json.dumps(self.options), json.dumps(self.progress),
+                  json.dumps(self.errors), self.created_at, self.started_at, self.finished_at, time.time(),
+                  self.owner))
+            if cursor.rowcount == 0:
+                self.cancel_event.set()
+            if items:
+                conn.executemany('''
+                INSERT INTO job_items (job_id, item_key, status, attempts, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (job_id, item_key) DO UPDATE SET status = excluded.status,
+                    attempts = excluded.attempts, error = excluded.error, updated_at = excluded.updated_at
+                ''', [(self.id, key, *item) for key, item in items.items()])
+
+
+class JobManager:
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self.runners = {}
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.threads = []
+
+    def register(self, kind, runner):
+        # runner(job) does the work, calling job.report() and checking job.is_cancelled()
+        self.runners[kind] = runner
+
+    def start(self):
+        if self.threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, kind, options):
+        if kind not in self.runners:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = Job(uuid.uuid4().hex, kind, options, owner=process_owner())
+        job.save()
+        self.enqueue(job)
+        return job
+
+    def enqueue(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+        self.start()
+        self.pending.put(job.id)
+
+    def resume(self):
+        # Jobs left queued or running by a process that has since exited are
+        # picked up again; those of other live server processes are left alone
+        conn = create_connection()
+        try:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE status IN ({', '.join('?' for _ in ACTIVE_STATUSES)}) ORDER BY created_at",
+                ACTIVE_STATUSES).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            job = Job.from_row(row)
+            with self.lock:
+                if job.id in self.jobs:
+                    continue
+            if job.owner != process_owner() and owner_alive(job.owner):
+                continue
+            if job.kind not in self.runners:
+                logger.error(f"Cannot resume job {job.id}: unknown kind {job.kind}")
+                continue
+            logger.info(f"Resuming interrupted {job.kind} job {job.id}")
+            job.status = 'queued'
+            job.options['resumed'] = True
+            # Rates restart with the new run rather than counting the downtime
+            job.started_at = None
+            job.progress = {}
+            job.owner = process_owner()
+            job.save()
+            self.enqueue(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job:
+            return job
+        conn = create_connection()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return Job.from_row(row) if row else None
+
+    def active(self, kind):
+        # Queued and running jobs of kind, from every server process
+        conn = create_connection()
+        try:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE kind = ? AND status IN ({', '.join('?' for _ in ACTIVE_STATUSES)})",
+                (kind, *ACTIVE_STATUSES)).fetchall()
+        finally:
+            conn.close()
+        return [Job.from_row(row) for row in rows]
+
+    def list(self, status=None, limit=50):
+        conn = create_connection()
+        try:
+            if status:
+                rows = conn.execute('SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?',
+                                    (status, limit)).fetchall()
+            else:
+                rows = conn.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        finally:
+            conn.close()
+        # Prefer in-memory state for live jobs; the table lags by up to PROGRESS_SAVE_INTERVAL
+        with self.lock:
+            return [self.jobs.get(row['id']) or Job.from_row(row) for row in rows]
+
+    def items(self, job_id, status=None, after=None, limit=100):
+        # Keyset-paginated per-item statuses for jobs that track them
+        conditions = ['job_id = ?']
+        params = [job_id]
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if after:
+            conditions.append('item_key > ?')
+            params.append(after)
+        conn = create_connection()
+        try:
+            rows = conn.execute(f'''
+            SELECT item_key, status, attempts, error, updated_at FROM job_items
+            WHERE {' AND '.join(conditions)}
+            ORDER BY item_key
+            LIMIT ?
+            ''', params + [limit]).fetchall()
+        finally:
+            conn.close()
+        return [{**dict(row), 'updated_at': format_time(row['updated_at'])} for row in rows]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if not job:
+            return None
+        if job.status in FINAL_STATUSES:
+            return job
+        job.cancel_event.set()
+        with self.lock:
+            live = job_id in self.jobs
+        # Queued jobs and rows orphaned by a previous process never reach a
+        # runner. A job running in another server process sees the cancelled
+        # row on its next save.
+        if job.status == 'queued' or not live:
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+            job.save()
+            with self.lock:
+                self.jobs.pop(job_id, None)
+        return job
+
+    def work(self):
+        while True:
+            job_id = self.pending.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job and job.status != 'queued':
+                    # Cancelled while it waited
+                    del self.jobs[job_id]
+                    job = None
+            if job:
+                self.run(job)
+
+    def run(self, job):
+        # A cancel can land between work() taking the job and here; the
+        # runner is then never started
+        if job.is_cancelled():
+            job.status = 'cancelled'
+        else:
+            job.status = 'running'
+            job.started_at = job.started_at or time.time()
+            job.save()
+            try:
+                self.runners[job.kind](job)
+                job.status = 'cancelled' if job.is_cancelled() else 'completed'
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {e}", exc_info=True)
+                job.status = 'failed'
+                job.errors = job.errors + [str(e)]
+        job.finished_at = time.time()
+        job.save()
+        with self.lock:
+            self.jobs.pop(job.id, None)
+        logger.info(f"Job {job.id} finished with status {job.status}")
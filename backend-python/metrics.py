@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import uuid
+import bisect
+import random
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = 'revue'
+# Upper bounds in seconds of the latency histogram buckets, plus +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Request profiling is off unless one of these is set. A PROFILE_SAMPLE_RATE
+# share of requests is profiled, and with PROFILE_ON_DEMAND so is any request
+# with ?profile=1. Profiles are written to PROFILE_DIR as collapsed stacks.
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_ON_DEMAND = os.environ.get('PROFILE_ON_DEMAND', '').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+MAX_PROFILE_DEPTH = 128
+
+HELP = {
+    'stage_seconds': 'Time spent in each pipeline stage',
+    'stage_errors_total': 'Stage runs that raised',
+    'stage_bytes_total': 'Bytes processed by each pipeline stage',
+    'stage_rows_total': 'Rows processed by each pipeline stage',
+    'http_request_seconds': 'Time from the start of a request until its response was sent',
+    'profiles_total': 'Requests profiled',
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    # Counters and latency histograms keyed on name and labels. Recording one
+    # is a dict lookup and a few additions under a lock. Every number is for
+    # this process only: under gunicorn each worker keeps its own, and a scrape
+    # reaches whichever worker takes it. Each series carries a pid label so
+    # workers stay separate series instead of one that keeps resetting; sum
+    # them over pid, e.g. sum without (pid) (rate(...)), for the whole server.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        # Times the block as stage name; a block that raises is also counted
+        # as an error of the stage
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc('stage_errors_total', stage=name, **labels)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=name, **labels)
+
+    def record_stages(self, timings):
+        # Stage durations measured where the registry is out of reach, such as
+        # an image worker process; see StageTimings
+        for name, seconds in timings.items():
+            self.observe('stage_seconds', seconds, stage=name)
+
+    def stage_totals(self):
+        # Runs and seconds of each stage, summed over its other labels
+        totals = {}
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name == 'stage_seconds':
+                    total = totals.setdefault(dict(labels)['stage'], {'count': 0, 'seconds': 0.0})
+                    total['count'] += histogram.count
+                    total['seconds'] += histogram.sum
+        return totals
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                           'sum': histogram.sum,
+                           'buckets': {bucket_label(bound): total for bound, total in histogram.cumulative()}}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms,
+                'process': process_stats(self.started)}
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(histogram.cumulative()), histogram.sum, histogram.count)
+                          for key, histogram in sorted(self.histograms.items())]
+
+        described = set()
+        pid = (('pid', os.getpid()),)
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {METRICS_PREFIX}_{name} {HELP[name]}")
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f"{METRICS_PREFIX}_{name}{format_labels(pid + labels)} {value}")
+        for (name, labels), buckets, total, count in histograms:
+            describe(name, 'histogram')
+            for bound, cumulative in buckets:
+                lines.append(f"{METRICS_PREFIX}_{name}_bucket{format_labels(pid + labels + (('le', bucket_label(bound)),))} "
+                             f"{cumulative}")
+            lines.append(f"{METRICS_PREFIX}_{name}_sum{format_labels(pid + labels)} {total}")
+            lines.append(f"{METRICS_PREFIX}_{name}_count{format_labels(pid + labels)} {count}")
+        for name, value in process_stats(self.started).items():
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.append(f"{METRICS_PREFIX}_{name}{format_labels(pid)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class StageTimings:
+    # Collects stage durations in a worker process; they travel back with the
+    # result and the parent passes them to Metrics.record_stages
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - started
+
+
+def bucket_label(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def process_stats(started):
+    # psutil is only needed once metrics are read, so it is not imported at startup
+    import psutil
+    process = psutil.Process()
+    cpu = process.cpu_times()
+    return {
+        'process_resident_memory_bytes': process.memory_info().rss,
+        'process_cpu_seconds_total': round(cpu.user + cpu.system, 3),
+        'process_threads': process.num_threads(),
+        'process_uptime_seconds': round(time.time() - started, 3),
+    }
+
+
+metrics = Metrics()
+
+
+class RequestProfiler:
+    # Samples the stack of one thread every PROFILE_INTERVAL seconds from a
+    # side thread, and writes the sample counts as collapsed stacks, the input
+    # of flamegraph.pl and speedscope
+    def __init__(self, name, thread_id=None, interval=PROFILE_INTERVAL, directory=PROFILE_DIR):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}"
+        self.path = os.path.join(directory, f"{self.id}.folded")
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None and len(stack) < MAX_PROFILE_DEPTH:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'profiler-{self.id}', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        metrics.inc('profiles_total')
+        logger.info(f"Wrote profile of {sum(self.stacks.values())} samples to {self.path}")
+        return self.path
+
+
+# Builds the profiler for a request: factory(name) returns an object with
+# start() and stop(). Swap in another sampler with set_request_profiler.
+_profiler_factory = RequestProfiler
+
+def set_request_profiler(factory):
+    global _profiler_factory
+    _profiler_factory = factory
+
+def start_request_profiler(name, requested=False):
+    # The started profiler if this request is to be profiled, else None
+    if not ((PROFILE_ON_DEMAND and requested) or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE)):
+        return None
+    return _profiler_factory(name).start()
@@ -0,0 +1,111 @@
+import os
+import sys
+import logging
+import threading
+
+# Production serving: several worker processes of several threads each, pooled
+# database connections and INFO logging. `python production.py` runs gunicorn,
+# or waitress where gunicorn is not installed; any other WSGI server can be
+# pointed at production:app.
+os.environ.setdefault('LOG_LEVEL', 'INFO')
+
+import db
+from server import app, job_manager, watch_manager
+
+try:
+    import fcntl
+except ImportError:
+    # No other process to coordinate with; waitress serves from one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+WEB_HOST = os.environ.get('WEB_HOST', '127.0.0.1')
+WEB_PORT = int(os.environ.get('WEB_PORT', 8080))
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', min(4, os.cpu_count() or 1)))
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+
+
+def lock_file(path):
+    # An exclusive lock held until the returned file is closed or the process exits
+    f = open(path, 'a')
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+def setup_schema():
+    # Schema setup and migrations, once before serving. Workers that each run
+    # it on import take turns instead of migrating at the same time.
+    with lock_file(f"{db.DB_NAME}.lock"):
+        db.create_table()
+
+
+_started_pid = None
+_background_lock = None
+
+def start_worker():
+    # Once in each serving process, after any fork: pooled connections, and a
+    # place in line to run the background services
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    db.enable_connection_pool()
+    threading.Thread(target=run_background_services, name='background-services', daemon=True).start()
+
+def run_background_services():
+    # One serving process resumes interrupted jobs and runs the watcher; the
+    # others wait on the lock, and one of them takes over if it exits. Jobs
+    # submitted to any process run in that process.
+    global _background_lock
+    _background_lock = lock_file(f"{db.DB_NAME}.background.lock")
+    logger.info(f"Process {os.getpid()} runs background services")
+    try:
+        job_manager.resume()
+        watch_manager.start()
+    except Exception as e:
+        logger.error(f"Starting background services failed: {e}", exc_info=True)
+
+# Servers that import production:app start each worker on its first request,
+# as that is the first point known to be after any fork
+app.before_request(start_worker)
+
+
+def run_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{WEB_HOST}:{WEB_PORT}")
+            self.cfg.set('workers', WEB_WORKERS)
+            self.cfg.set('threads', WEB_THREADS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('post_fork', lambda server, worker: start_worker())
+
+        def load(self):
+            return app
+
+    logger.info(f"Serving on {WEB_HOST}:{WEB_PORT} with gunicorn, {WEB_WORKERS} workers of {WEB_THREADS} threads")
+    Application().run()
+
+def run_waitress():
+    import waitress
+    logger.warning("gunicorn is not installed; serving from one process with waitress")
+    start_worker()
+    waitress.serve(app, host=WEB_HOST, port=WEB_PORT, threads=WEB_THREADS)
+
+def main():
+    setup_schema()
+    for name, run in (('gunicorn', run_gunicorn), ('waitress', run_waitress)):
+        try:
+            __import__(name)
+        except ImportError:
+            continue
+        return run()
+    sys.exit("Production serving needs gunicorn or waitress; install one with pip")
+
+
+if __name__ == '__main__':
+    main()
+else:
+    setup_schema()
@@ -0,0 +1,100 @@
+import re
+import html
+
+from db import SEARCH_COLUMNS
+from file_query import FilesQuery
+
+DEFAULT_SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 200
+SNIPPET_TOKENS = 12
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_END = '</mark>'
+# snippet() marks matches with these; the indexed text is HTML-escaped before
+# they become HIGHLIGHT_START/END, so file names and descriptions cannot inject markup
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+# bm25 weight per SEARCH_COLUMNS entry: tags and names say more about an image
+# than a word deep in its description or folder path
+COLUMN_WEIGHTS = {
+    'file_name': 3.0,
+    'file_path': 0.5,
+    'description': 1.0,
+    'tags': 3.0,
+    'subjects': 2.0,
+    'categories': 2.0,
+    'visible_text': 1.0,
+}
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match(text, prefix=True, columns=None):
+    # User input becomes a conjunction of quoted terms, so FTS5 operators and
+    # punctuation in it are never interpreted. With prefix, every term also
+    # matches words it starts (served by the table's prefix indexes).
+    terms = _TERM.findall(text)
+    if not terms:
+        raise ValueError("Search query has no searchable terms")
+    match = ' AND '.join(f'"{term}"{"*" if prefix else ""}' for term in terms)
+    if columns:
+        unknown = [column for column in columns if column not in SEARCH_COLUMNS]
+        if unknown:
+            raise ValueError(f"Cannot search {', '.join(unknown)}; expected any of {', '.join(SEARCH_COLUMNS)}")
+        match = f"{{{' '.join(columns)}}} : ({match})"
+    return match
+
+
+def highlight(snippet):
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MATCH_START, HIGHLIGHT_START).replace(_MATCH_END, HIGHLIGHT_END)
+
+
+class SearchQuery:
+    # Ranked full-text search over files_fts; the /api/v1/files filters and
+    # fields parameters apply to the matching files
+    def __init__(self, args):
+        self.text = args.get('q', '')
+        prefix = args.get('prefix', 'true').lower() not in ('0', 'false', 'no')
+        columns = [column.strip() for column in args.get('in', '').split(',') if column.strip()]
+        self.match = build_match(self.text, prefix, columns)
+        self.limit = max(1, min(int(args.get('limit', DEFAULT_SEARCH_LIMIT)), MAX_SEARCH_LIMIT))
+        self.offset = max(0, int(args.get('offset', 0)))
+        self.files = FilesQuery({key: value for key, value in args.items()
+                                 if key not in ('sort', 'order', 'limit', 'cursor')})
+
+    def sql(self):
+        columns = [f"f.{field}" for field in dict.fromkeys(['id'] + self.files.fields)]
+        columns += self.files.joined_columns()
+        weights = ', '.join(str(COLUMN_WEIGHTS[column]) for column in SEARCH_COLUMNS)
+        columns += [
+            f"snippet(files_fts, -1, char(2), char(3), '…', {SNIPPET_TOKENS}) AS snippet",
+            f"bm25(files_fts, {weights}) AS score",
+        ]
+        conditions = ['files_fts MATCH ?'] + self.files.conditions
+        sql = f'''
+        SELECT {', '.join(columns)}
+        FROM files_fts
+        JOIN files f ON f.id = files_fts.rowid
+        {self.files.join()}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY score, f.id
+        LIMIT ? OFFSET ?
+        '''
+        # One extra row tells us whether there is a next page
+        return sql, [self.match] + self.files.params + [self.limit + 1, self.offset]
+
+    def run(self, conn):
+        sql, params = self.sql()
+        rows = conn.execute(sql, params).fetchall()
+        items = []
+        for row in rows[:self.limit]:
+            item = self.files.serialize(row)
+            item['snippet'] = highlight(row['snippet'])
+            # bm25 is lower-is-better; flip it so larger scores rank higher
+            item['score'] = round(-row['score'], 4)
+            items.append(item)
+        next_offset = self.offset + self.limit if len(rows) > self.limit else None
+        return {'items': items, 'next_offset': next_offset}
+
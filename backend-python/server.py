@@ -1,218 +1,91 @@
 import os
 import json
 import time
-import hashlib
 import sqlite3
-from flask import Flask, request, jsonify, send_from_directory
-from PIL import Image
-from PIL.ExifTags import TAGS
-import secrets
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory, stream_with_context
 import logging
-import concurrent.futures
 from functools import partial
-import psutil
 from flask_cors import CORS
 from dotenv import load_dotenv
-import requests  
-import base64
-from anthropic import Anthropic
-import io
 import re
 
+from db import create_connection, create_table
+from file_query import DEFAULT_FACET_LIMIT, DEFAULT_PAGE_SIZE, MAX_FACET_LIMIT, FilesQuery, facet_counts, parse_list
+from search import SearchQuery
+from indexer import index_directory, remove_indexed, run_index_job
+from jobs import JobManager
+from analysis_backends import ClaudeBackend, OllamaBackend, backend_names, get_backend, is_retryable_error, register_backend
+from analysis_cache import prepare_image_for_analysis
+from batch_analysis import run_batch_analysis
+from file_operations import run_file_operation
+from metrics import metrics, start_request_profiler
+from directory_listing import DEFAULT_LISTING_LIMIT, list_directory
+from duplicates import DEFAULT_GROUP_LIMIT, duplicate_report, resolve_duplicates
+from embedding_models import DEFAULT_EMBEDDING_MODEL, model_names, register_default_models
+from embeddings import DEFAULT_SEARCH_LIMIT as DEFAULT_SEMANTIC_LIMIT, MAX_SEARCH_LIMIT as MAX_SEMANTIC_LIMIT, \
+    run_embedding_job, search_embeddings
+from similarity import DEFAULT_THRESHOLD, MAX_THRESHOLD, from_signed64, load_hash_index
+from thumbnails import DEFAULT_SPRITE_COLUMNS, DEFAULT_SPRITE_TILE_SIZE, FORMAT_EXTENSIONS, GC_MIN_AGE, \
+    MAX_SPRITE_TILES, MIMETYPES, THUMBNAIL_DIR, THUMBNAIL_FORMAT, THUMBNAIL_MAX_AGE, THUMBNAIL_SIZE, THUMBNAIL_SIZES, \
+    build_sprite, collect_garbage, find_thumbnail, is_content_hash, is_content_thumbnail, sprite_etag, \
+    thumbnail_etag, thumbnail_generator, thumbnail_path
+from watcher import WatchManager
+
 
 app = Flask(__name__, static_folder='static', static_url_path='/')
 # configure proper cors 
 # all localhost:3000 request in development 
 # if os.environ.get('FLASK_ENV') == 'development':
-CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}})
+CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}},
+     expose_headers=['X-Sprite-Columns', 'X-Sprite-Tile-Size', 'X-Sprite-Count', 'X-Sprite-Missing', 'X-Next-Cursor'])
 
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
 load_dotenv()
+# Analysis payloads are only serialized for the log at DEBUG; LOG_LEVEL=INFO
+# or above makes that logging free
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
+logger = logging.getLogger(__name__)
 
+# Without a key the server still starts; only requests for the claude service fail
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 if not ANTHROPIC_API_KEY:
-    raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+    logger.warning("ANTHROPIC_API_KEY environment variable is not set; the claude service is unavailable")
 
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+register_backend(ClaudeBackend(api_key=ANTHROPIC_API_KEY))
+register_backend(OllamaBackend())
+register_default_models()
 
+# Rows serialized per chunk when streaming large JSON responses
+STREAM_CHUNK_ROWS = 500
 
-# Constants
-THUMBNAIL_SIZE = (300, 300)
-DB_NAME = 'imagedb.db'
-THUMBNAIL_DIR = 'thumbnails'
+job_manager = JobManager()
+job_manager.register('index', run_index_job)
+watch_manager = WatchManager()
 
-def create_connection():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
 
-def create_table():
-    conn = create_connection()
-    cursor = conn.cursor()
-    
-    # Create files table (unchanged)
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS files (
-        id INTEGER PRIMARY KEY,
-        file_name TEXT NOT NULL,
-        file_path TEXT NOT NULL,
-        file_size INTEGER NOT NULL,
-        file_format TEXT NOT NULL,
-        date_created TEXT NOT NULL,
-        date_modified TEXT NOT NULL,
-        hash TEXT NOT NULL,
-        thumbnail_path TEXT
-    )
-    ''')
-
-    # Check if image_analysis table exists
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='image_analysis'")
-    table_exists = cursor.fetchone()
-
-    if table_exists:
-        # Alter existing table
-        try:
-            cursor.execute('ALTER TABLE image_analysis RENAME COLUMN category TO categories')
-        except sqlite3.OperationalError:
-            # Column might already be renamed, ignore the error
-            pass
-    else:
-        # Create new table with updated schema
-        cursor.execute('''
-        CREATE TABLE image_analysis (
-            hash TEXT PRIMARY KEY,
-            description TEXT,
-            subjects TEXT,
-            colors TEXT,
-            mood TEXT,
-            composition TEXT,
-            visible_text TEXT,
-            tags TEXT,
-            categories TEXT,
-            quality TEXT,
-            unique_features TEXT
-        )
-        ''')
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.profiler = start_request_profiler(request.endpoint or 'unmatched',
+                                        requested=request.args.get('profile') == '1')
 
+@app.after_request
+def record_request_metrics(response):
+    # Recorded when the response is closed, so streamed bodies are included
+    started = g.get('request_started', time.perf_counter())
+    profiler = g.get('profiler')
+    labels = {'method': request.method, 'endpoint': request.url_rule.rule if request.url_rule else 'unmatched',
+              'status': str(response.status_code)}
+    if getattr(profiler, 'path', None):
+        response.headers['X-Profile'] = profiler.path
 
-    conn.commit()
-    conn.close()
-
-def generate_thumbnail(file_path):
-    with Image.open(file_path) as img:
-        img.thumbnail(THUMBNAIL_SIZE)
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new(img.mode[:-1], img.size, (255, 255, 255))
-            background.paste(img, img.split()[-1])
-            img = background.convert('RGB')
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        unique_id = secrets.token_hex(8)
-        thumbnail_filename = f"{unique_id}_{os.path.splitext(os.path.basename(file_path))[0]}.jpg"
-        thumbnail_path = os.path.join(THUMBNAIL_DIR, thumbnail_filename)
-        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
-        img.save(thumbnail_path, "JPEG")
-    return thumbnail_path
-    
-def create_image_hash(file_path):
-    hasher = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        # Read and update in chunks of 4K
-        for chunk in iter(lambda: f.read(4096), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
-
-def get_exif_data(image_path):
-    with Image.open(image_path) as img:
-        exif_data = {}
-        if hasattr(img, '_getexif'):
-            exif = img._getexif()
-            if exif:
-                for tag_id, value in exif.items():
-                    tag = TAGS.get(tag_id, tag_id)
-                    exif_data[tag] = str(value)  # Convert all values to strings for JSON serialization
-    return exif_data
-
-
-def index_directory(path):
-    conn = create_connection()
-    cursor = conn.cursor()
+    def finish():
+        metrics.observe('http_request_seconds', time.perf_counter() - started, **labels)
+        if profiler:
+            profiler.stop()
 
-    logger.info(f"Indexing directory: {path}")
-
-    # Create a set of existing file hashes for faster lookup
-    cursor.execute("SELECT hash FROM files")
-    existing_hashes = set(row[0] for row in cursor.fetchall())
-
-    def process_files(files, root):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_hash = create_image_hash(file_path)
-
-            if file_hash in existing_hashes:
-                logger.info(f"File with same hash already exists; skipping: {file_path}")
-                continue
-
-            logger.info(f"Adding new file to database: {file_path}")
-
-            thumbnail_path = None
-            try:
-                # Attempt to open the file as an image
-                with Image.open(file_path) as img:
-                    # If successful, generate thumbnail
-                    thumbnail_path = generate_thumbnail(file_path)
-            except Exception as e:
-                # If file is not an image or there's an error, log it and continue
-                logger.info(f"Could not generate thumbnail for {file_path}: {e}")
-
-            file_stat = os.stat(file_path)
-            yield {
-                'file_name': file,
-                'file_path': file_path,
-                'file_size': file_stat.st_size,
-                'file_format': os.path.splitext(file)[1],
-                'date_created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(file_stat.st_ctime)),
-                'date_modified': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(file_stat.st_mtime)),
-                'hash': file_hash,
-                'thumbnail_path': thumbnail_path,
-            }
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for root, _, files in os.walk(path):
-            future_to_files = {executor.submit(process_files, files, root): files}
-            for future in concurrent.futures.as_completed(future_to_files):
-                try:
-                    for meta in future.result():
-                        cursor.execute('''
-                        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash, thumbnail_path)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        ''', (meta['file_name'], meta['file_path'], meta['file_size'], meta['file_format'],
-                              meta['date_created'], meta['date_modified'], meta['hash'], meta['thumbnail_path']))
-                except Exception as exc:
-                    logger.error(f'Generated an exception: {exc}')
-
-    conn.commit()
-    conn.close()
+    response.call_on_close(finish)
+    return response
 
-def prepare_image_for_analysis(file_path):
-    with Image.open(file_path) as img:
-        # Convert image to RGB if it's not
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Resize image if it's too large
-        max_size = 1024
-        if max(img.size) > max_size:
-            img.thumbnail((max_size, max_size))
-        
-        # Convert image to base64
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG")
-        base64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-    return base64_image
 
 def get_image_analysis(image_id):
     conn = create_connection()
@@ -231,7 +104,7 @@ def get_image_analysis(image_id):
     cursor.execute('''
     SELECT description, subjects, colors, mood, composition, visible_text, tags, categories, quality, unique_features
     FROM image_analysis 
-    WHERE hash = ?
+    WHERE hash = ? AND description IS NOT NULL
     ''', (image_hash,))
     existing_analysis = cursor.fetchone()
     
@@ -249,7 +122,7 @@ def get_image_analysis(image_id):
             'categories': json.loads(existing_analysis['categories']) if existing_analysis['categories'] else None,
             'quality': existing_analysis['quality'],
             'unique_features': json.loads(existing_analysis['unique_features']) if existing_analysis['unique_features'] else None
-        }
+        }, image_hash, file_path
     
     return None, image_hash, file_path
 
@@ -261,25 +134,42 @@ def store_image_analysis(image_hash, analysis):
         
         # Log the incoming data
         logging.info(f"Attempting to store analysis for image hash: {image_hash}")
-        logging.info(f"Analysis data: {json.dumps(analysis, indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Analysis data: {json.dumps(analysis, indent=2)}")
         
-        cursor.execute('''
-            INSERT INTO image_analysis 
-            (hash, description, subjects, colors, mood, composition, visible_text, tags, categories, quality, unique_features)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                image_hash,
-                analysis.get('description', ''),
-                json.dumps(analysis.get('subjects', [])),
-                json.dumps(analysis.get('colors', [])),
-                json.dumps(analysis.get('mood', [])),
-                analysis.get('composition', ''),
-                json.dumps(analysis.get('text', [])),
-                json.dumps(analysis.get('tags', [])),
-                json.dumps(analysis.get('categories', [])),
-                analysis.get('quality', ''),
-                json.dumps(analysis.get('unique_features', []))
-          ))
+        values = {
+            'hash': image_hash,
+            'description': analysis.get('description', ''),
+            'subjects': json.dumps(analysis.get('subjects', [])),
+            'colors': json.dumps(analysis.get('colors', [])),
+            'mood': json.dumps(analysis.get('mood', [])),
+            'composition': analysis.get('composition', ''),
+            'visible_text': json.dumps(analysis.get('text', [])),
+            'tags': json.dumps(analysis.get('tags', [])),
+            'categories': json.dumps(analysis.get('categories', [])),
+            'quality': analysis.get('quality', ''),
+            'unique_features': json.dumps(analysis.get('unique_features', [])),
+        }
+        # A row may already hold tags or categories added by hand through
+        # /api/v1/files/bulk; the analysis fills it in and keeps those labels.
+        # No upsert here; see create_label_index.
+        merged = {column: f"""(SELECT json_group_array(value) FROM (
+                SELECT value FROM json_each(:{column}) UNION
+                SELECT value FROM json_each(CASE WHEN json_valid({column}) THEN {column} ELSE '[]' END)))"""
+                  for column in ('tags', 'categories')}
+        cursor.execute(f'''
+            UPDATE image_analysis SET description = :description, subjects = :subjects, colors = :colors,
+                mood = :mood, composition = :composition, visible_text = :visible_text, quality = :quality,
+                unique_features = :unique_features, tags = {merged['tags']}, categories = {merged['categories']}
+            WHERE hash = :hash
+            ''', values)
+        if cursor.rowcount == 0:
+            cursor.execute('''
+                INSERT INTO image_analysis 
+                (hash, description, subjects, colors, mood, composition, visible_text, tags, categories, quality, unique_features)
+                VALUES (:hash, :description, :subjects, :colors, :mood, :composition, :visible_text, :tags, :categories,
+                        :quality, :unique_features)
+                ''', values)
 
         conn.commit()
         logging.info(f"Successfully stored analysis for image hash: {image_hash}")
@@ -331,12 +221,46 @@ def extract_json_from_markdown(text):
         return json_match.group(1)
     return text  # Return original text if no JSON block found
 
+def analyze_and_store(image_hash, file_path, service, model):
+    with metrics.stage('analysis_prepare'):
+        base64_image = prepare_image_for_analysis(file_path, image_hash)
+    with metrics.stage('analysis_call', service=service):
+        analysis_text = get_backend(service).analyze(model, analyze_image_prompt, base64_image)
+    logger.debug(f"Raw analysis text: {analysis_text}")
+
+    # Extract JSON from markdown if necessary
+    json_text = extract_json_from_markdown(analysis_text)
+    logger.debug(f"Extracted JSON text: {json_text}")
+
+    try:
+        structured_analysis = json.loads(json_text)
+    except json.JSONDecodeError as e:
+        logging.error(f"Failed to parse JSON: {str(e)}")
+        logging.error(f"Invalid JSON: {json_text}")
+        raise
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Analysis data before storage for {image_hash}: {json.dumps(structured_analysis, indent=2)}")
+
+    with metrics.stage('analysis_store'):
+        success, message = store_image_analysis(image_hash, structured_analysis)
+    if not success:
+        # Raised so a batch counts the image as failed rather than analyzed
+        raise RuntimeError(f"Failed to store image analysis: {message}")
+
+    return structured_analysis
+
 @app.route('/api/v1/analyze-image/<int:image_id>', methods=['POST'])
 def analyze_image(image_id):
     try:
         data = request.json
         service = data.get('service', 'claude').lower()
-        model = data.get('model', 'claude-3-5-sonnet-20240620' if service == 'claude' else 'llava')
+
+        if service not in backend_names():
+            return jsonify({"error": "Invalid service specified"}), 400
+        if get_backend(service).configuration_error():
+            return jsonify({"error": get_backend(service).configuration_error()}), 503
+        model = data.get('model', get_backend(service).default_model)
 
         logging.info(f"Analyzing image with ID: {image_id}")
         logging.info(f"Service: {service}")
@@ -346,75 +270,55 @@ def analyze_image(image_id):
         
         if existing_analysis:
             return jsonify({"analysis": existing_analysis}), 200
-        
-        base64_image = prepare_image_for_analysis(file_path)
-        
-        if service == 'claude':
-            response = anthropic_client.messages.create(
-                model=model,
-                max_tokens=1024,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/jpeg",
-                                    "data": base64_image
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": analyze_image_prompt
-                            }
-                        ]
-                    }
-                ]
-            )
-            analysis_text = response.content[0].text
-        elif service == 'ollama':
-            ollama_url = "http://localhost:11434/api/generate"
-            headers = {"Content-Type": "application/json"}
-            payload = {
-                "model": model,
-                "stream": False,
-                "prompt": analyze_image_prompt,
-                "images": [base64_image]
-            }
-            response = requests.post(ollama_url, json=payload)
-            response.raise_for_status()
-            analysis_text = response.json()['response']
-        else:
-            return jsonify({"error": "Invalid service specified"}), 400
-
-        logging.info(f"Raw analysis text: {analysis_text}")
-
-        # Extract JSON from markdown if necessary
-        json_text = extract_json_from_markdown(analysis_text)
-        logging.info(f"Extracted JSON text: {json_text}")
 
         try:
-            structured_analysis = json.loads(json_text)
-        except json.JSONDecodeError as e:
-            logging.error(f"Failed to parse JSON: {str(e)}")
-            logging.error(f"Invalid JSON: {json_text}")
+            structured_analysis = analyze_and_store(image_hash, file_path, service, model)
+        except json.JSONDecodeError:
             return jsonify({"error": "Failed to parse analysis result"}), 500
 
-        logging.info(f"Image hash: {image_hash}")
-        logging.info(f"Analysis data before storage: {json.dumps(structured_analysis, indent=2)}")
-
-        success, message = store_image_analysis(image_hash, structured_analysis)
-        if not success:
-            logging.error(f"Failed to store image analysis: {message}")
-
         return jsonify({"analysis": structured_analysis}), 200
 
     except Exception as e:
         logging.error(f"Error analyzing image: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/v1/analyze-images', methods=['POST'])
+def analyze_images_handler():
+    # Batch analysis of the given ids and/or files matching a /api/v1/files
+    # filter, run as a background job
+    data = request.json or {}
+    service = data.get('service', 'claude').lower()
+    if service not in backend_names():
+        return jsonify({"error": "Invalid service specified"}), 400
+    if get_backend(service).configuration_error():
+        return jsonify({"error": get_backend(service).configuration_error()}), 503
+    if not data.get('ids') and not data.get('filter'):
+        return jsonify({"error": "Provide ids or a filter"}), 400
+    if data.get('filter'):
+        # Checked now rather than when the job starts selecting images
+        if not isinstance(data['filter'], dict):
+            return jsonify({"error": "filter must be an object of /api/v1/files parameters"}), 400
+        try:
+            FilesQuery(data['filter'])
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": f"Invalid filter: {e}"}), 400
+
+    options = {
+        'service': service,
+        'model': data.get('model', get_backend(service).default_model),
+        'ids': data.get('ids'),
+        'filter': data.get('filter'),
+    }
+    for key in ('concurrency', 'requests_per_minute', 'burst', 'max_retries'):
+        if data.get(key) is not None:
+            options[key] = data[key]
+
+    try:
+        job = job_manager.submit('analyze', options)
+        return jsonify({"message": "Analysis started", "job_id": job.id, "job": job.to_dict()}), 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/v1/index-files', methods=['POST'])
 def index_files_handler():
     data = request.json
@@ -422,60 +326,194 @@ def index_files_handler():
 
     if not path:
         return jsonify({"error": "No path provided"}), 400
+    if not os.path.isdir(path):
+        return jsonify({"error": "Invalid directory path"}), 400
+
+    # Incremental by default; pass "incremental": false to force a full rehash
+    incremental = data.get('incremental', True)
+    # Optional pipeline sizing overrides, e.g. {"hash_workers": 8, "path_queue_size": 4096}
+    pipeline_options = {key: int(data[key]) for key in (
+        'hash_workers', 'image_workers', 'path_queue_size', 'image_queue_size', 'write_queue_size',
+        'write_batch_size'
+    ) if data.get(key)}
+
+    try:
+        if data.get('wait'):
+            # Synchronous indexing for scripts that want the stats in the response
+            stats = index_directory(path, incremental=incremental, **pipeline_options)
+            return jsonify({"message": "Indexing complete", **stats}), 200
+
+        job = job_manager.submit('index', {
+            'path': path,
+            'incremental': incremental,
+            'pipeline': pipeline_options,
+        })
+        return jsonify({"message": "Indexing started", "job_id": job.id, "job": job.to_dict()}), 202
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/watch-roots', methods=['GET'])
+def list_watch_roots_handler():
+    return jsonify(watch_manager.status()), 200
+
+@app.route('/api/v1/watch-roots', methods=['POST'])
+def add_watch_root_handler():
+    # Keeps a library root indexed as files are added, changed, moved or deleted
+    data = request.json or {}
+    path = data.get('path')
+
+    if not path:
+        return jsonify({"error": "No path provided"}), 400
+    if not os.path.isdir(path):
+        return jsonify({"error": "Invalid directory path"}), 400
 
     try:
-        index_directory(path)
-        return jsonify({"message": "Indexing complete"}), 200
+        root = watch_manager.add(path)
+        return jsonify(root.to_dict()), 201
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/v1/watch-roots', methods=['DELETE'])
+def remove_watch_root_handler():
+    # Stops watching; rows already indexed under the root are kept
+    path = request.args.get('path') or (request.get_json(silent=True) or {}).get('path')
+    if not path:
+        return jsonify({"error": "No path provided"}), 400
+    if not watch_manager.remove(path):
+        return jsonify({"error": "Path is not watched"}), 404
+    return jsonify({"message": "Stopped watching", "path": path}), 200
+
+def limit_arg(default, maximum):
+    # ?limit= clamped to 1..maximum; None when it is not an integer
+    if request.args.get('limit') is None:
+        return default
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return None
+    return max(1, min(limit, maximum))
+
+@app.route('/api/v1/jobs', methods=['GET'])
+def list_jobs_handler():
+    status = request.args.get('status')
+    limit = limit_arg(50, 500)
+    if limit is None:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify([job.to_dict() for job in job_manager.list(status=status, limit=limit)]), 200
+
+@app.route('/api/v1/jobs/<job_id>', methods=['GET'])
+def get_job_handler(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route('/api/v1/jobs/<job_id>/items', methods=['GET'])
+def get_job_items_handler(job_id):
+    if not job_manager.get(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    limit = limit_arg(100, 1000)
+    if limit is None:
+        return jsonify({"error": "limit must be an integer"}), 400
+    items = job_manager.items(job_id, status=request.args.get('status'),
+                              after=request.args.get('after'), limit=limit)
+    return jsonify({"items": items, "next_after": items[-1]['item_key'] if len(items) == limit else None}), 200
+
+@app.route('/api/v1/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job_handler(job_id):
+    job = job_manager.cancel(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
+
 @app.route('/api/v1/files', methods=['GET'])
 def get_files_handler():
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT f.id, f.file_name, f.file_path, f.file_size, f.file_format, f.date_created, f.date_modified, f.hash, f.thumbnail_path,
-           ia.description, ia.subjects, ia.colors, ia.mood, ia.composition, ia.visible_text, ia.tags, ia.categories, ia.quality, ia.unique_features
-    FROM files f
-    LEFT JOIN image_analysis ia ON f.hash = ia.hash
-    ''')
-    
-    rows = cursor.fetchall()
-    
-    def parse_json_field(field):
-        if field:
-            try:
-                return json.loads(field)
-            except json.JSONDecodeError:
-                return None
-        return None
+    try:
+        query = FilesQuery(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    sql, params = query.sql()
 
+    def generate():
+        conn = create_connection()
+        try:
+            cursor = conn.execute(sql, params)
+            yield '{"items": [' if query.paginated else '['
+
+            written = 0
+            last_row = None
+            has_more = False
+            while True:
+                rows = cursor.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                if query.limit and written + len(rows) > query.limit:
+                    rows = rows[:query.limit - written]
+                    has_more = True
+                chunk = ', '.join(query.serialize_json(row) for row in rows)
+                yield (', ' if written else '') + chunk
+                written += len(rows)
+                last_row = rows[-1]
+                if has_more:
+                    break
+
+            if query.paginated:
+                next_cursor = query.next_cursor(last_row) if has_more else None
+                yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+            else:
+                yield ']'
+            logger.debug(f"Streamed {written} files")
+        finally:
+            conn.close()
 
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
-    files = [{
-        **dict(row),
-        'analysis': {
-            'description': row['description'],
-            'subjects': parse_json_field(row['subjects']),
-            'colors': parse_json_field(row['colors']),
-            'mood': parse_json_field(row['mood']),
-            'composition': row['composition'],
-            'visible_text': parse_json_field(row['visible_text']),
-            'tags': parse_json_field(row['tags']),
-            'categories': parse_json_field(row['categories']),
-            'quality': row['quality'],
-            'unique_features': parse_json_field(row['unique_features'])
-        } if row['description'] is not None else None
-    } for row in rows]
-    conn.close()
-    
-    print(f"Number of files processed: {len(files)}")  # Debug print
-    return jsonify(files)
 
+@app.route('/api/v1/facets', methods=['GET'])
+def get_facets_handler():
+    # Label counts over the files matching the /api/v1/files filters, e.g.
+    # /api/v1/facets?tags=beach&facets=categories,colors
+    try:
+        query = FilesQuery(request.args)
+        kinds = parse_list(request.args.get('facets'))
+        limit = max(1, min(int(request.args.get('limit', DEFAULT_FACET_LIMIT)), MAX_FACET_LIMIT))
+        conn = create_connection()
+        try:
+            return jsonify(facet_counts(conn, query, kinds, limit)), 200
+        finally:
+            conn.close()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error counting facets: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/search', methods=['GET'])
+def search_handler():
+    # Ranked full-text search over file names, paths and image analysis.
+    # Accepts the /api/v1/files filters and fields alongside q.
+    try:
+        query = SearchQuery(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = create_connection()
+    try:
+        return jsonify(query.run(conn)), 200
+    except sqlite3.OperationalError as e:
+        logger.error(f"Search failed for {query.match}: {str(e)}")
+        return jsonify({"error": f"Search failed: {str(e)}"}), 400
+    except Exception as e:
+        logger.error(f"Search failed: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
 
 @app.route('/api/v1/list-directory', methods=['POST'])
 def list_directory_handler():
-    data = request.json
+    data = request.json or {}
     path = data.get('path', '/')  # Default to root if no path is provided
 
     # Clean up the path
@@ -486,40 +524,26 @@ def list_directory_handler():
     if not os.path.isdir(path):
         return jsonify({"error": "Invalid directory path"}), 400
 
+    # Paged with offset/limit. "lazy": true skips the per-file stat (no size or
+    # lastModified), "files": false lists directories only, and "counts": true
+    # adds an image count to each directory on the page.
     try:
-        directories = []
-        files = []
-        with os.scandir(path) as entries:
-            for entry in entries:
-                if entry.is_dir():
-                    directories.append({
-                        "name": entry.name,
-                        "path": entry.path
-                    })
-                else:
-                    stat = entry.stat()
-                    files.append({
-                        "name": entry.name,
-                        "path": entry.path,
-                        "size": stat.st_size,
-                        "lastModified": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(stat.st_mtime)),
-                        "isDirectory": False
-                    })
-        
-        return jsonify({
-            "currentPath": path,
-            "parentPath": os.path.dirname(path) if path != '/' else None,
-            "directories": sorted(directories, key=lambda x: x['name'].lower()),
-            "files": sorted(files, key=lambda x: x['name'].lower())
-        }), 200
+        listing = list_directory(path, offset=int(data.get('offset', 0)),
+                                 limit=int(data.get('limit', DEFAULT_LISTING_LIMIT)),
+                                 lazy=bool(data.get('lazy')), include_files=data.get('files', True) is not False,
+                                 counts=bool(data.get('counts')))
+        return jsonify(listing), 200
     except PermissionError:
         return jsonify({"error": "Permission denied"}), 403
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Failed to list directory contents: {str(e)}"}), 500
 
 @app.route('/api/v1/list-drives', methods=['GET'])
 def list_drives():
     try:
+        import psutil
         drives = []
         partitions = psutil.disk_partitions(all=False)
         for partition in partitions:
@@ -582,6 +606,184 @@ def get_duplicate_files():
     except Exception as e:
         return jsonify({"error": f"Failed to retrieve duplicate images: {str(e)}"}), 500
 
+@app.route('/api/v1/duplicates', methods=['GET'])
+def duplicates_report_handler():
+    # Duplicate groups with the bytes each wastes, biggest savings first
+    conn = create_connection()
+    try:
+        report = duplicate_report(conn, limit=request.args.get('limit', DEFAULT_GROUP_LIMIT, type=int),
+                                  offset=request.args.get('offset', 0, type=int),
+                                  sort=request.args.get('sort', 'wasted'))
+        return jsonify(report), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Duplicate report failed: {str(e)}")
+        return jsonify({"error": f"Failed to build duplicate report: {str(e)}"}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/v1/duplicates/resolve', methods=['POST'])
+def resolve_duplicates_handler():
+    # Keeps one file per group by policy and deletes, hardlinks or moves the
+    # rest; "dry_run": true returns the plan without touching anything
+    data = request.json or {}
+    conn = create_connection()
+    try:
+        result = resolve_duplicates(conn, policy=data.get('policy', 'oldest'), action=data.get('action', 'delete'),
+                                    preferred_roots=data.get('preferred_roots') or (), hashes=data.get('hashes'),
+                                    move_to=data.get('move_to'), dry_run=bool(data.get('dry_run')))
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Resolving duplicates failed: {str(e)}")
+        return jsonify({"error": f"Failed to resolve duplicates: {str(e)}"}), 500
+    finally:
+        conn.close()
+
+def fetch_files_by_id(cursor, ids):
+    files = {}
+    ids = list(ids)
+    # Stay well under SQLite's bound parameter limit
+    for start in range(0, len(ids), 500):
+        batch = ids[start:start + 500]
+        cursor.execute(f'''
+        SELECT id, file_name, file_path, file_size, file_format, date_created, date_modified, hash, thumbnail_path
+        FROM files
+        WHERE id IN ({', '.join('?' for _ in batch)})
+        ''', batch)
+        files.update((row['id'], dict(row)) for row in cursor.fetchall())
+    return files
+
+@app.route('/api/v1/get-similar-files', methods=['GET'])
+def get_similar_files():
+    try:
+        threshold = int(request.args.get('threshold', DEFAULT_THRESHOLD))
+        if not 0 <= threshold <= MAX_THRESHOLD:
+            return jsonify({"error": f"threshold must be between 0 and {MAX_THRESHOLD}"}), 400
+        algorithm = request.args.get('algorithm', 'phash')
+        image_id = request.args.get('id', type=int)
+        limit = request.args.get('limit', type=int)
+
+        conn = create_connection()
+        try:
+            cursor = conn.cursor()
+            index = load_hash_index(conn, algorithm, threshold)
+
+            if image_id is not None:
+                # Everything within threshold of one image, nearest first
+                cursor.execute(f'SELECT {algorithm} FROM files WHERE id = ?', (image_id,))
+                row = cursor.fetchone()
+                if not row:
+                    return jsonify({"error": f"No image found with id {image_id}"}), 404
+                if row[0] is None:
+                    return jsonify({"error": f"Image {image_id} has no {algorithm}"}), 400
+                matches = [match for match in index.search(from_signed64(row[0]), threshold)
+                           if match[0] != image_id][:limit]
+                files = fetch_files_by_id(cursor, [row_id for row_id, _ in matches])
+                return jsonify([{**files[row_id], 'distance': distance}
+                                for row_id, distance in matches if row_id in files]), 200
+
+            # Clusters of near-duplicates across the whole library, largest first
+            clusters = sorted(index.clusters(threshold), key=len, reverse=True)[:limit]
+            files = fetch_files_by_id(cursor, [row_id for cluster in clusters for row_id in cluster])
+        finally:
+            conn.close()
+
+        result = [[files[row_id] for row_id in sorted(cluster) if row_id in files] for cluster in clusters]
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to retrieve similar images: {str(e)}"}), 500
+
+@app.route('/api/v1/embeddings', methods=['POST'])
+def embed_images_handler():
+    # Computes vectors for images that lack one from the model, as a
+    # background job; ids and filter narrow the set like /api/v1/analyze-images
+    data = request.json or {}
+    model = data.get('model', DEFAULT_EMBEDDING_MODEL)
+    if model not in model_names():
+        return jsonify({"error": f"Unknown embedding model {model}; expected one of {', '.join(model_names())}"}), 400
+    options = {'model': model, 'ids': data.get('ids'), 'filter': data.get('filter')}
+    if data.get('batch_size') is not None:
+        options['batch_size'] = data['batch_size']
+    try:
+        job = job_manager.submit('embed', options)
+        return jsonify({"message": "Embedding started", "job_id": job.id, "job": job.to_dict()}), 202
+    except sqlite3.IntegrityError:
+        # Two jobs for one model would embed the same pending images twice;
+        # the jobs table allows only one active per model
+        running = [job.id for job in job_manager.active('embed') if job.options.get('model') == model]
+        return jsonify({"error": f"An embedding job for {model} is already active",
+                        "job_id": running[0] if running else None}), 409
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/semantic-search', methods=['GET'])
+def semantic_search_handler():
+    # ?q=text for text-to-image, ?id=<file id> for images like that one
+    model = request.args.get('model', DEFAULT_EMBEDDING_MODEL)
+    text = request.args.get('q', '').strip()
+    image_id = request.args.get('id', type=int)
+    limit = max(1, min(request.args.get('limit', DEFAULT_SEMANTIC_LIMIT, type=int), MAX_SEMANTIC_LIMIT))
+    if model not in model_names():
+        return jsonify({"error": f"Unknown embedding model {model}; expected one of {', '.join(model_names())}"}), 400
+    if not text and image_id is None:
+        return jsonify({"error": "Provide q or id"}), 400
+    kwargs = {}
+    if request.args.get('probes') is not None:
+        kwargs['probes'] = request.args.get('probes', type=int)
+        if kwargs['probes'] is None or kwargs['probes'] < 1:
+            return jsonify({"error": "probes must be a positive integer"}), 400
+
+    conn = create_connection()
+    try:
+        cursor = conn.cursor()
+        file_hash = None
+        if image_id is not None:
+            row = cursor.execute('SELECT hash FROM files WHERE id = ?', (image_id,)).fetchone()
+            if not row:
+                return jsonify({"error": f"No image found with id {image_id}"}), 404
+            file_hash = row['hash']
+        matches = search_embeddings(conn, model, text=text, file_hash=file_hash, limit=limit, **kwargs)
+
+        # One file per matching content hash
+        ids_by_hash = {}
+        hashes = [match_hash for match_hash, _ in matches]
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            cursor.execute(f"SELECT hash, MIN(id) AS id FROM files WHERE hash IN ({', '.join('?' for _ in batch)}) "
+                           f"GROUP BY hash", batch)
+            ids_by_hash.update((row['hash'], row['id']) for row in cursor.fetchall())
+        files = fetch_files_by_id(cursor, ids_by_hash.values())
+        return jsonify([{**files[ids_by_hash[match_hash]], 'score': round(score, 4)}
+                        for match_hash, score in matches if match_hash in ids_by_hash]), 200
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        logger.error(f"Semantic search failed: {str(e)}")
+        return jsonify({"error": f"Semantic search failed: {str(e)}"}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/v1/files/bulk', methods=['POST'])
+def bulk_file_operation_handler():
+    # {"operation": "delete" | "move" | "tag", "ids": [...] or "filter": {...}, ...}
+    # move takes "destination"; tag takes "add", "remove" and "kind" (tags or categories)
+    data = request.json or {}
+    conn = create_connection()
+    try:
+        return jsonify(run_file_operation(conn, data)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Bulk file operation failed: {str(e)}")
+        return jsonify({"error": f"Bulk file operation failed: {str(e)}"}), 500
+    finally:
+        conn.close()
+
 @app.route('/api/v1/delete-file', methods=['POST'])
 def delete_file():
     try:
@@ -598,27 +800,164 @@ def delete_file():
         # Delete the file
         os.remove(file_path)
 
-        # Remove the file entry from the database
+        # Remove the file entry from the database, and its thumbnail unless
+        # another copy of the same content still uses it
         conn = create_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM files WHERE file_path = ?', (file_path,))
-        conn.commit()
-        conn.close()
-
-        # If there's an associated thumbnail, delete it too
-        thumbnail_path = os.path.join(THUMBNAIL_DIR, os.path.basename(file_path))
-        if os.path.exists(thumbnail_path):
-            os.remove(thumbnail_path)
+        try:
+            remove_indexed(conn, [file_path])
+        finally:
+            conn.close()
 
         return jsonify({"message": "File deleted successfully"}), 200
     except Exception as e:
         logger.error(f"Error deleting file: {str(e)}")
         return jsonify({"error": f"Failed to delete file: {str(e)}"}), 500
 
+@app.route('/api/v1/thumbnails/gc', methods=['POST'])
+def collect_thumbnail_garbage():
+    # Deletes thumbnails no longer referenced by any row in files
+    data = request.json or {}
+    try:
+        conn = create_connection()
+        try:
+            stats = collect_garbage(conn, dry_run=bool(data.get('dry_run')),
+                                    min_age=int(data.get('min_age', GC_MIN_AGE)))
+        finally:
+            conn.close()
+        return jsonify(stats), 200
+    except Exception as e:
+        logger.error(f"Error collecting thumbnails: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/v1/metrics', methods=['GET'])
+def metrics_handler():
+    # Prometheus text format; ?format=json for the same numbers as JSON. The
+    # numbers are those of the worker process that serves the request.
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.snapshot()), 200
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def cache_forever(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/v1/thumbnails/<file_hash>', methods=['GET'])
+def thumbnail_handler(file_hash):
+    # The thumbnail of one content hash (?size= one of THUMBNAIL_SIZES). The
+    # URL names the content, so browsers keep it for good. A thumbnail not
+    # rendered yet is rendered on this request.
+    size = request.args.get('size', THUMBNAIL_SIZE, type=int)
+    if not is_content_hash(file_hash):
+        return jsonify({"error": "Invalid content hash"}), 400
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({"error": f"Invalid size {size}; expected one of {', '.join(map(str, THUMBNAIL_SIZES))}"}), 400
+
+    # Revalidation is answered without touching the disk
+    etag = thumbnail_etag(file_hash, size, thumbnail_path(file_hash, size))
+    if request.if_none_match.contains(etag):
+        metrics.inc('thumbnail_requests_total', result='not_modified')
+        return cache_forever(Response(status=304, headers={'ETag': f'"{etag}"'}))
+
+    path = find_thumbnail(file_hash, size)
+    result = 'hit'
+    if path is None:
+        path = thumbnail_generator.thumbnail(file_hash, size)
+        result = 'rendered'
+    if path is None:
+        metrics.inc('thumbnail_requests_total', result='missing')
+        return jsonify({"error": "No thumbnail for this content"}), 404
+    metrics.inc('thumbnail_requests_total', result=result)
+    return cache_forever(send_file(os.path.abspath(path), mimetype=MIMETYPES[path.rsplit('.', 1)[-1]],
+                                   etag=thumbnail_etag(file_hash, size, path), conditional=True,
+                                   max_age=THUMBNAIL_MAX_AGE))
+
+def sprite_response(file_hashes, tile_size, columns, headers=None):
+    headers = headers or {}
+    if not file_hashes:
+        return Response(status=204, headers=headers)
+    try:
+        etag = sprite_etag(file_hashes, tile_size, columns)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"', **headers})
+        with metrics.stage('sprite'):
+            data, columns, missing = build_sprite(file_hashes, tile_size, columns)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = Response(data, mimetype=MIMETYPES[FORMAT_EXTENSIONS[THUMBNAIL_FORMAT]], headers={
+        'X-Sprite-Columns': str(columns),
+        'X-Sprite-Tile-Size': str(tile_size),
+        'X-Sprite-Count': str(len(file_hashes)),
+        'X-Sprite-Missing': ','.join(map(str, missing)),
+        **headers,
+    })
+    # Rendering may have filled in tiles since the first ETag
+    response.set_etag(sprite_etag(file_hashes, tile_size, columns))
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/v1/thumbnails/sprite', methods=['GET'])
+def page_sprite_handler():
+    # One image holding the thumbnails of a page of /api/v1/files, which takes
+    # the same filters, sort, limit and cursor. Tile i is the page's file i,
+    # at column i % X-Sprite-Columns and row i // X-Sprite-Columns, each tile
+    # a tile_size square; X-Next-Cursor continues the page.
+    try:
+        args = {**request.args.to_dict(), 'fields': 'hash'}
+        args.pop('all', None)
+        args['limit'] = min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_SPRITE_TILES)
+        query = FilesQuery(args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    sql, params = query.sql()
+    conn = create_connection()
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    has_more = len(rows) > query.limit
+    rows = rows[:query.limit]
+    return sprite_response([row['hash'] for row in rows],
+                           request.args.get('tile_size', DEFAULT_SPRITE_TILE_SIZE, type=int),
+                           request.args.get('columns', DEFAULT_SPRITE_COLUMNS, type=int),
+                           {'X-Next-Cursor': query.next_cursor(rows[-1]) if has_more else ''})
+
+@app.route('/api/v1/thumbnails/sprite', methods=['POST'])
+def sprite_handler():
+    # The same sprite for an explicit list of content hashes, in order
+    data = request.json or {}
+    file_hashes = data.get('hashes') or []
+    if not isinstance(file_hashes, list) or not all(isinstance(value, str) and is_content_hash(value)
+                                                    for value in file_hashes):
+        return jsonify({"error": "hashes must be a list of content hashes"}), 400
+    try:
+        tile_size = int(data.get('tile_size', DEFAULT_SPRITE_TILE_SIZE))
+        columns = int(data.get('columns', DEFAULT_SPRITE_COLUMNS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "tile_size and columns must be integers"}), 400
+    return sprite_response(file_hashes, tile_size, columns)
+
 @app.route('/thumbnails/<path:filename>')
 def serve_thumbnail(filename):
-    return send_from_directory(THUMBNAIL_DIR, filename)
+    # Content-named thumbnails never change; older randomly named ones are
+    # revalidated by their ETag
+    if is_content_thumbnail(filename):
+        return cache_forever(send_from_directory(os.path.abspath(THUMBNAIL_DIR), filename,
+                                                 max_age=THUMBNAIL_MAX_AGE))
+    return send_from_directory(os.path.abspath(THUMBNAIL_DIR), filename)
+
+job_manager.register('analyze', partial(run_batch_analysis, analyze=analyze_and_store,
+                                        is_retryable=is_retryable_error))
+job_manager.register('embed', partial(run_embedding_job, is_retryable=is_retryable_error))
 
 if __name__ == '__main__':
+    # Development server; production.py serves with several worker processes
     create_table()
+    # Under the reloader only the serving child process should run jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        job_manager.resume()
+        watch_manager.start()
     app.run(port=8080, debug=True)
\ No newline at end of file
@@ -0,0 +1,227 @@
+import math
+import logging
+import threading
+import itertools
+import imagehash
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+HASH_ALGORITHMS = ('ahash', 'dhash', 'phash')
+DEFAULT_THRESHOLD = 8
+MAX_THRESHOLD = 20
+# Hashes per vectorized probe block when clustering the whole library
+CLUSTER_BLOCK_SIZE = 4096
+# Substrings up to this many bits use a flat bucket-offset table when clustering
+DIRECT_TABLE_BITS = 24
+
+_SIGN_BIT = 1 << (HASH_BITS - 1)
+_HASH_RANGE = 1 << HASH_BITS
+
+
+# SQLite integers are signed 64-bit, so hashes are stored in two's complement
+def to_signed64(value):
+    return value - _HASH_RANGE if value >= _SIGN_BIT else value
+
+def from_signed64(value):
+    return value + _HASH_RANGE if value < 0 else value
+
+def popcount64(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy < 2.0: count bits a byte at a time
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+_BYTE_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def compute_perceptual_hashes(img):
+    # One grayscale conversion shared by all three hashes
+    gray = img.convert('L')
+    return {
+        'ahash': to_signed64(int(str(imagehash.average_hash(gray)), 16)),
+        'dhash': to_signed64(int(str(imagehash.dhash(gray)), 16)),
+        'phash': to_signed64(int(str(imagehash.phash(gray)), 16)),
+    }
+
+
+def choose_substrings(count, radius):
+    # Estimated work per query: table probes plus candidates to verify. More
+    # substrings mean fewer probes each but fuller buckets.
+    def cost(substrings):
+        width = HASH_BITS // substrings
+        probes = substrings * sum(math.comb(width, bits) for bits in range(radius // substrings + 1))
+        return probes + probes * count / (1 << width)
+    return min(range(1, 17), key=cost)
+
+
+class MultiIndexHash:
+    # Multi-index hashing (Norouzi et al.): the hash is split into m substrings,
+    # each with its own table. Two hashes within distance r must agree to within
+    # floor(r / m) bits on at least one substring, so a query only probes those
+    # small neighbourhoods instead of comparing against every stored hash.
+    def __init__(self, items, radius=DEFAULT_THRESHOLD, substrings=None):
+        # Identical hashes are collapsed so exact duplicates cost one entry
+        self.ids_by_hash = {}
+        for row_id, value in items:
+            self.ids_by_hash.setdefault(value, []).append(row_id)
+        self.hashes = list(self.ids_by_hash)
+
+        self.substrings = substrings or choose_substrings(len(self.hashes), radius)
+        widths = [HASH_BITS // self.substrings + (1 if i < HASH_BITS % self.substrings else 0)
+                  for i in range(self.substrings)]
+        self.slices = []
+        shift = 0
+        for width in widths:
+            self.slices.append((shift, (1 << width) - 1, width))
+            shift += width
+
+        self.flip_masks = {}
+        self._tables = None
+        self._clusters = {}
+        self._clusters_lock = threading.Lock()
+
+    @property
+    def tables(self):
+        # Per-substring lookup tables for single queries, built on first use;
+        # clustering works from sorted arrays instead
+        if self._tables is None:
+            tables = [{} for _ in self.slices]
+            for index, value in enumerate(self.hashes):
+                for table, (shift, mask, _) in zip(tables, self.slices):
+                    table.setdefault((value >> shift) & mask, []).append(index)
+            self._tables = tables
+        return self._tables
+
+    def masks(self, width, radius):
+        key = (width, radius)
+        if key not in self.flip_masks:
+            masks = []
+            for bits in range(radius + 1):
+                for positions in itertools.combinations(range(width), bits):
+                    masks.append(sum(1 << position for position in positions))
+            self.flip_masks[key] = masks
+        return self.flip_masks[key]
+
+    def candidates(self, query, radius):
+        sub_radius = radius // self.substrings
+        found = set()
+        for table, (shift, mask, width) in zip(self.tables, self.slices):
+            value = (query >> shift) & mask
+            for flip in self.masks(width, sub_radius):
+                bucket = table.get(value ^ flip)
+                if bucket:
+                    found.update(bucket)
+        return found
+
+    def search(self, query, radius):
+        # Returns (row_id, distance) for every stored hash within radius of query
+        matches = []
+        for index in self.candidates(query, radius):
+            value = self.hashes[index]
+            distance = (value ^ query).bit_count()
+            if distance <= radius:
+                matches.extend((row_id, distance) for row_id in self.ids_by_hash[value])
+        return sorted(matches, key=lambda match: match[1])
+
+    def candidate_pairs(self, radius):
+        # Vectorized self-join for clustering: each block of hashes probes every
+        # substring table at once, so memory stays bounded by CLUSTER_BLOCK_SIZE
+        # rather than by the number of candidate pairs.
+        hashes = np.array(self.hashes, dtype=np.uint64)
+        sub_radius = radius // self.substrings
+        for shift, mask, width in self.slices:
+            values = (hashes >> np.uint64(shift)) & np.uint64(mask)
+            order = np.argsort(values, kind='stable')
+            flips = np.array(self.masks(width, sub_radius), dtype=np.uint64)
+            # Narrow substrings get a direct-address table: bucket sizes in the
+            # smallest dtype that holds them, so the probe lookups mostly hit
+            # cache, and offsets read only for the probes that found something.
+            # Wide ones fall back to binary search.
+            if width <= DIRECT_TABLE_BITS:
+                values, flips = values.astype(np.int64), flips.astype(np.int64)
+                sizes = np.bincount(values, minlength=1 << width)
+                bucket_starts = np.cumsum(sizes) - sizes
+                largest = sizes.max()
+                bucket_sizes = sizes.astype(np.uint8 if largest < 1 << 8 else np.uint16 if largest < 1 << 16 else np.int64)
+            else:
+                sorted_values = values[order]
+
+            for start in range(0, len(hashes), CLUSTER_BLOCK_SIZE):
+                keys = (values[start:start + CLUSTER_BLOCK_SIZE, None] ^ flips[None, :]).ravel()
+                if width <= DIRECT_TABLE_BITS:
+                    counts = bucket_sizes[keys]
+                    hits = np.flatnonzero(counts)
+                    low = bucket_starts[keys[hits]]
+                else:
+                    low = np.searchsorted(sorted_values, keys, side='left')
+                    counts = np.searchsorted(sorted_values, keys, side='right') - low
+                    hits = np.flatnonzero(counts)
+                    low = low[hits]
+                counts = counts[hits].astype(np.int64)
+                owners = start + hits // len(flips)
+
+                # Expand each matching [low, low + count) range into candidate pairs
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                others = order[np.repeat(low, counts) + offsets]
+                left = np.repeat(owners, counts)
+                keep = left < others
+                left, others = left[keep], others[keep]
+                within = popcount64(hashes[left] ^ hashes[others]) <= radius
+                yield left[within], others[within]
+
+    def clusters(self, radius):
+        # The self-join takes seconds on large libraries, so its result is kept
+        # per radius; load_hash_index builds a new index when the hashes change.
+        # Concurrent requests for one radius wait for a single computation.
+        with self._clusters_lock:
+            if radius not in self._clusters:
+                self._clusters[radius] = self.find_clusters(radius)
+            return self._clusters[radius]
+
+    def find_clusters(self, radius):
+        # Union-find over unique hashes; every pair within radius joins a cluster
+        parent = list(range(len(self.hashes)))
+
+        def find(index):
+            while parent[index] != index:
+                parent[index] = parent[parent[index]]
+                index = parent[index]
+            return index
+
+        for left, right in self.candidate_pairs(radius):
+            for index, other in zip(left.tolist(), right.tolist()):
+                root, other_root = find(index), find(other)
+                if root != other_root:
+                    parent[other_root] = root
+
+        groups = {}
+        for index, value in enumerate(self.hashes):
+            groups.setdefault(find(index), []).extend(self.ids_by_hash[value])
+        return [ids for ids in groups.values() if len(ids) > 1]
+
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+def load_hash_index(conn, algorithm, radius=DEFAULT_THRESHOLD):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm {algorithm}; expected one of {', '.join(HASH_ALGORITHMS)}")
+
+    # Rebuild only when the stored hashes change
+    fingerprint = tuple(conn.execute(
+        f'SELECT COUNT({algorithm}), MAX(id), TOTAL({algorithm}) FROM files').fetchone())
+    # The best substring count depends on the radius, so cache one index per count
+    substrings = choose_substrings(fingerprint[0], radius)
+    key = (algorithm, substrings)
+    with _index_lock:
+        cached = _index_cache.get(key)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+        rows = conn.execute(f'SELECT id, {algorithm} FROM files WHERE {algorithm} IS NOT NULL')
+        index = MultiIndexHash(((row[0], from_signed64(row[1])) for row in rows), substrings=substrings)
+        logger.info(f"Built {algorithm} index over {len(index.hashes)} unique hashes "
+                    f"with {index.substrings} substrings")
+        _index_cache[key] = (fingerprint, index)
+        return index
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The database, thumbnails and caches live relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    import db
+    db.create_table()
+    return tmp_path
+
+
+@pytest.fixture
+def client(workdir):
+    from server import app
+    return app.test_client()
@@ -0,0 +1,113 @@
+import json
+import time
+import socket
+import importlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import analysis_backends
+from analysis_backends import OllamaBackend, get_backend, is_retryable_error, register_backend
+
+
+class StubOllama(BaseHTTPRequestHandler):
+    # Answers /api/generate with the next scripted status, recording the client
+    # port of each request so connection reuse shows up
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append((self.client_address[1], body))
+        time.sleep(self.server.delay)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        payload = json.dumps({'response': f"described by {body['model']}"}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOllama)
+    server.daemon_threads = True
+    server.requests = []
+    server.statuses = []
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # A registry of our own, so the server's backends are left alone
+    monkeypatch.setattr(analysis_backends, '_backends', {})
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_ollama_through_registry_reuses_one_session(registry, stub):
+    register_backend(OllamaBackend(base_url=stub.url))
+    backend = get_backend('ollama')
+
+    results = [backend.analyze('llava', 'Describe', 'aW1hZ2U=') for _ in range(3)]
+
+    assert results == ['described by llava'] * 3
+    assert stub.requests[0][1] == {'model': 'llava', 'stream': False, 'prompt': 'Describe', 'images': ['aW1hZ2U=']}
+    # Every request went over the same keep-alive connection
+    assert len({port for port, _ in stub.requests}) == 1
+    assert get_backend('ollama').session is backend.session
+
+
+def test_timeouts_come_from_the_environment(registry, stub, monkeypatch):
+    monkeypatch.setenv('ANALYSIS_CONNECT_TIMEOUT', '1.5')
+    monkeypatch.setenv('ANALYSIS_READ_TIMEOUT', '0.2')
+    module = importlib.reload(analysis_backends)
+    try:
+        backend = module.register_backend(module.OllamaBackend(base_url=stub.url))
+        assert backend.timeout == (1.5, 0.2)
+
+        stub.delay = 1
+        with pytest.raises(requests.Timeout) as error:
+            module.get_backend('ollama').analyze('llava', 'Describe', '')
+        assert module.is_retryable_error(error.value)
+    finally:
+        monkeypatch.delenv('ANALYSIS_CONNECT_TIMEOUT')
+        monkeypatch.delenv('ANALYSIS_READ_TIMEOUT')
+        importlib.reload(analysis_backends)
+
+
+@pytest.mark.parametrize('status, retryable', [(429, True), (500, True), (503, True), (400, False), (404, False)])
+def test_http_errors_are_classified(registry, stub, status, retryable):
+    register_backend(OllamaBackend(base_url=stub.url))
+    stub.statuses = [status]
+    with pytest.raises(requests.HTTPError) as error:
+        get_backend('ollama').analyze('llava', 'Describe', '')
+    assert error.value.response.status_code == status
+    assert is_retryable_error(error.value) is retryable
+
+
+def test_connection_errors_are_retryable(registry):
+    register_backend(OllamaBackend(base_url=f"http://127.0.0.1:{unused_port()}"))
+    with pytest.raises(requests.ConnectionError) as error:
+        get_backend('ollama').analyze('llava', 'Describe', '')
+    assert is_retryable_error(error.value)
+
+
+def test_other_errors_are_not_retryable(registry):
+    register_backend(OllamaBackend(base_url='http://127.0.0.1:1'))
+    assert not is_retryable_error(ValueError('bad response'))
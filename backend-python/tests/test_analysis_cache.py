@@ -0,0 +1,44 @@
+import os
+
+from analysis_cache import PayloadCache
+
+
+def age(cache, key, seconds_ago):
+    path = cache.path(key)
+    mtime = os.stat(path).st_mtime - seconds_ago
+    os.utime(path, (mtime, mtime))
+
+
+def test_limit_holds_across_processes_sharing_the_directory(tmp_path):
+    # Two instances stand in for two server processes
+    first, second = PayloadCache(str(tmp_path), max_bytes=250), PayloadCache(str(tmp_path), max_bytes=250)
+    first.put('aa1', b'x' * 100)
+    age(first, 'aa1', 30)
+    second.put('bb1', b'x' * 100)
+    age(second, 'bb1', 20)
+    first.put('cc1', b'x' * 100)
+
+    assert first.get('aa1') is None
+    assert second.get('bb1') and second.get('cc1')
+    assert sum(size for _, _, size in first.scan()) == 200
+
+
+def test_reads_keep_an_entry_from_eviction(tmp_path):
+    cache = PayloadCache(str(tmp_path), max_bytes=250)
+    cache.put('aa1', b'x' * 100)
+    age(cache, 'aa1', 30)
+    cache.put('bb1', b'x' * 100)
+    age(cache, 'bb1', 20)
+    assert cache.get('aa1') == b'x' * 100
+    cache.put('cc1', b'x' * 100)
+
+    assert cache.get('aa1') and cache.get('cc1')
+    assert cache.get('bb1') is None
+
+
+def test_replacing_an_entry_counts_it_once(tmp_path):
+    cache = PayloadCache(str(tmp_path), max_bytes=250)
+    for _ in range(5):
+        cache.put('aa1', b'x' * 100)
+    cache.put('bb1', b'x' * 100)
+    assert cache.get('aa1') and cache.get('bb1')
@@ -0,0 +1,53 @@
+import pytest
+
+import db
+import server
+from analysis_backends import AnalysisBackend
+from batch_analysis import run_batch_analysis
+from jobs import Job
+
+
+class StubBackend(AnalysisBackend):
+    def analyze(self, model, prompt, base64_image):
+        return '{"description": "A red square", "tags": ["red"]}'
+
+
+@pytest.fixture
+def image(workdir, monkeypatch):
+    monkeypatch.setattr(server, 'prepare_image_for_analysis', lambda file_path, image_hash: 'aW1hZ2U=')
+    monkeypatch.setattr(server, 'get_backend', lambda name: StubBackend())
+    conn = db.create_connection()
+    with conn:
+        conn.execute('''
+        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash,
+                           thumbnail_path)
+        VALUES ('a.jpg', '/photos/a.jpg', 1, '.jpg', '', '', 'h1', 'thumbnails/h1.jpg')
+        ''')
+    conn.close()
+
+
+def run():
+    job = Job('job1', 'analyze', {'service': 'stub', 'model': 'm', 'ids': [1], 'max_retries': 0})
+    run_batch_analysis(job, analyze=server.analyze_and_store, is_retryable=lambda error: False)
+    return job
+
+
+def test_stored_analysis_counts_as_succeeded(image, monkeypatch):
+    job = run()
+    assert (job.progress['succeeded'], job.progress['failed']) == (1, 0)
+    conn = db.create_connection()
+    assert conn.execute('SELECT description FROM image_analysis WHERE hash = ?', ('h1',)).fetchone()[0] == 'A red square'
+    conn.close()
+
+def test_failed_store_counts_as_failed(image, monkeypatch):
+    monkeypatch.setattr(server, 'store_image_analysis', lambda image_hash, analysis: (False, 'Database error: locked'))
+    job = run()
+    assert (job.progress['succeeded'], job.progress['failed']) == (0, 1)
+    assert job.pending_items['h1'][0] == 'failed'
+    assert 'locked' in job.pending_items['h1'][2]
+
+
+@pytest.mark.parametrize('bad_filter', [{'sort': 'nonsense'}, {'min_width': 'wide'}, ['format=jpg']])
+def test_bad_filter_is_rejected_at_submit(client, bad_filter):
+    response = client.post('/api/v1/analyze-images', json={'service': 'ollama', 'filter': bad_filter})
+    assert response.status_code == 400
@@ -0,0 +1,66 @@
+import db
+from db import FILE_COLUMNS, BatchWriter
+
+
+def meta(i, **overrides):
+    row = {column: None for column in FILE_COLUMNS}
+    row.update(file_name=f'{i}.jpg', file_path=f'/photos/{i}.jpg', file_size=i, file_format='.jpg',
+               date_created='', date_modified='', hash=f'h{i}')
+    row.update(overrides)
+    return row
+
+
+def count_files(conn):
+    return conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+
+def test_connections_use_wal(workdir):
+    conn = db.create_connection()
+    try:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    finally:
+        conn.close()
+
+
+def test_batches_commit_on_close_and_readers_are_not_blocked(workdir):
+    writer_conn, reader = db.create_connection(), db.create_connection()
+    try:
+        writer = BatchWriter(writer_conn, batch_size=3, commit_interval=3600)
+        for i in range(7):
+            writer.insert(meta(i))
+        # Two batches are written in an open transaction; a reader still gets
+        # the last committed state instead of waiting on the writer
+        assert writer_conn.in_transaction
+        assert count_files(reader) == 0
+        writer.close()
+        assert count_files(reader) == 7
+    finally:
+        writer_conn.close()
+        reader.close()
+
+
+def test_bad_row_fails_alone(workdir):
+    conn = db.create_connection()
+    errors = []
+    try:
+        writer = BatchWriter(conn, batch_size=10, on_error=lambda row, error: errors.append(row))
+        writer.insert(meta(1))
+        writer.insert(meta(2, file_name=None))
+        writer.insert(meta(3))
+        writer.close()
+        assert [row[FILE_COLUMNS.index('file_path')] for row in errors] == ['/photos/2.jpg']
+        assert count_files(conn) == 2
+    finally:
+        conn.close()
+
+
+def test_paths_are_unique_and_reinserts_update(workdir):
+    conn = db.create_connection()
+    try:
+        writer = BatchWriter(conn, batch_size=10)
+        writer.insert(meta(1))
+        writer.insert(meta(1, hash='changed'))
+        writer.close()
+        assert [tuple(row) for row in conn.execute('SELECT file_path, hash FROM files')] == [('/photos/1.jpg', 'changed')]
+    finally:
+        conn.close()
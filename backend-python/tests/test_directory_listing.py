@@ -0,0 +1,56 @@
+import os
+
+import directory_listing
+from directory_listing import ListingCache, list_directory
+
+
+def make_tree(root):
+    for name in ('Beta', 'alpha', 'gamma'):
+        os.makedirs(os.path.join(root, name))
+    for name in ('b.jpg', 'A.png', 'c.txt', 'd.cr2', 'e.jpeg'):
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(b'x')
+    with open(os.path.join(root, 'alpha', 'inside.jpg'), 'wb') as f:
+        f.write(b'x')
+
+
+def walk_pages(client, root, limit):
+    names, offset = [], 0
+    while offset is not None:
+        page = client.post('/api/v1/list-directory', json={'path': root, 'offset': offset, 'limit': limit}).json
+        names += [entry['name'] for entry in page['directories'] + page['files']]
+        offset = page['nextOffset']
+    return names
+
+
+def test_pages_cover_every_entry_once_in_order(client, tmp_path):
+    root = str(tmp_path / 'library')
+    make_tree(root)
+    expected = ['alpha', 'Beta', 'gamma', 'A.png', 'b.jpg', 'c.txt', 'd.cr2', 'e.jpeg']
+    for limit in (1, 2, 3, 8, 100):
+        assert walk_pages(client, root, limit) == expected
+
+    page = client.post('/api/v1/list-directory', json={'path': root, 'limit': 2, 'counts': True}).json
+    assert (page['totalDirectories'], page['totalFiles'], page['imageCount']) == (3, 5, 4)
+    assert [(entry['name'], entry['imageCount']) for entry in page['directories']] == [('alpha', 1), ('Beta', 0)]
+
+
+def test_pages_come_from_one_cached_scan_until_the_directory_changes(tmp_path, monkeypatch):
+    root = str(tmp_path / 'library')
+    make_tree(root)
+    scans = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(directory_listing.os, 'scandir', lambda path: scans.append(path) or real_scandir(path))
+    cache = ListingCache(ttl=3600)
+
+    first = list_directory(root, offset=0, limit=4, lazy=True, cache=cache)
+    second = list_directory(root, offset=first['nextOffset'], limit=4, lazy=True, cache=cache)
+    assert scans == [root]
+    assert [entry['name'] for entry in second['files']] == ['b.jpg', 'c.txt', 'd.cr2', 'e.jpeg']
+    assert 'size' not in second['files'][0]
+
+    with open(os.path.join(root, 'f.jpg'), 'wb') as f:
+        f.write(b'x')
+    os.utime(root, ns=(0, os.stat(root).st_mtime_ns + 1_000_000))
+    assert list_directory(root, cache=cache)['totalFiles'] == 6
+    assert scans == [root, root]
@@ -0,0 +1,150 @@
+import os
+import hashlib
+
+import pytest
+
+import db
+from duplicates import duplicate_report, resolve_duplicates
+
+
+def add_file(conn, path, content, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
+    file_stat = os.stat(path)
+    with conn:
+        cursor = conn.execute('''
+        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash,
+                           mtime_ns, inode)
+        VALUES (?, ?, ?, ?, '', '', ?, ?, ?)
+        ''', (os.path.basename(path), path, file_stat.st_size, os.path.splitext(path)[1],
+              hashlib.sha256(content).hexdigest(), file_stat.st_mtime_ns, file_stat.st_ino))
+    return cursor.lastrowid
+
+
+@pytest.fixture
+def library(workdir):
+    # One group of three copies: the oldest is deepest, the shortest path is newest
+    root = str(workdir / 'library')
+    conn = db.create_connection()
+    paths = {
+        'oldest': os.path.join(root, 'archive', '2019', 'photo.jpg'),
+        'middle': os.path.join(root, 'imports', 'photo.jpg'),
+        'newest': os.path.join(root, 'a.jpg'),
+    }
+    add_file(conn, paths['oldest'], b'same bytes', 1_000_000)
+    add_file(conn, paths['middle'], b'same bytes', 2_000_000)
+    add_file(conn, paths['newest'], b'same bytes', 3_000_000)
+    add_file(conn, os.path.join(root, 'unique.jpg'), b'other bytes', 1_000_000)
+    yield conn, root, paths
+    conn.close()
+
+
+def remaining_paths(conn):
+    return {row['file_path'] for row in conn.execute('SELECT file_path FROM files')}
+
+
+@pytest.mark.parametrize('policy, kept', [('oldest', 'oldest'), ('shortest_path', 'newest')])
+def test_delete_keeps_one_copy_per_policy(library, policy, kept):
+    conn, root, paths = library
+    result = resolve_duplicates(conn, policy=policy, action='delete')
+
+    assert result['files'] == 2 and result['failed'] == 0
+    assert result['groups'][0]['keep'] == paths[kept]
+    for name, path in paths.items():
+        assert os.path.exists(path) == (name == kept)
+    assert paths[kept] in remaining_paths(conn)
+    assert len(remaining_paths(conn)) == 2
+
+
+def test_preferred_root_policy(library):
+    conn, root, paths = library
+    result = resolve_duplicates(conn, policy='preferred_root', preferred_roots=[os.path.join(root, 'imports')],
+                                action='delete')
+    assert result['groups'][0]['keep'] == paths['middle']
+    assert os.path.exists(paths['middle'])
+    assert not os.path.exists(paths['oldest'])
+
+
+def test_preferred_root_needs_roots(library):
+    conn, _, _ = library
+    with pytest.raises(ValueError):
+        resolve_duplicates(conn, policy='preferred_root', action='delete')
+
+
+def test_move_mirrors_paths_under_quarantine(library, workdir):
+    conn, _, paths = library
+    quarantine = str(workdir / 'quarantine')
+    result = resolve_duplicates(conn, policy='oldest', action='move', move_to=quarantine)
+
+    assert result['files'] == 2 and result['failed'] == 0
+    for name in ('middle', 'newest'):
+        assert not os.path.exists(paths[name])
+        moved = os.path.join(quarantine, paths[name].lstrip(os.sep))
+        with open(moved, 'rb') as f:
+            assert f.read() == b'same bytes'
+    assert os.path.exists(paths['oldest'])
+
+
+def test_move_needs_destination(library):
+    conn, _, _ = library
+    with pytest.raises(ValueError):
+        resolve_duplicates(conn, action='move')
+
+
+def test_hardlink_links_copies_and_refreshes_rows(library):
+    conn, _, paths = library
+    result = resolve_duplicates(conn, policy='oldest', action='hardlink')
+
+    assert result['files'] == 2 and result['failed'] == 0
+    kept = os.stat(paths['oldest'])
+    for name in ('middle', 'newest'):
+        linked = os.stat(paths[name])
+        assert (linked.st_dev, linked.st_ino) == (kept.st_dev, kept.st_ino)
+    # Rows stay, with the stat cache updated to the linked inode
+    inodes = {row['inode'] for row in conn.execute("SELECT inode FROM files WHERE file_name != 'unique.jpg'")}
+    assert inodes == {kept.st_ino}
+
+    # A second run finds every copy already linked
+    again = resolve_duplicates(conn, policy='oldest', action='hardlink')
+    assert again['skipped'] == 2 and again['files'] == 0 and again['bytes'] == 0
+
+
+def test_dry_run_changes_nothing(library):
+    conn, _, paths = library
+    before = remaining_paths(conn)
+    result = resolve_duplicates(conn, policy='oldest', action='delete', dry_run=True)
+
+    assert result['dry_run'] and result['files'] == 2 and result['bytes'] == 2 * len(b'same bytes')
+    assert all(os.path.exists(path) for path in paths.values())
+    assert remaining_paths(conn) == before
+
+
+def test_file_changed_since_indexing_is_left_alone(library):
+    conn, _, paths = library
+    with open(paths['newest'], 'ab') as f:
+        f.write(b' edited')
+    result = resolve_duplicates(conn, policy='oldest', action='delete')
+
+    assert result['failed'] == 1 and result['files'] == 1
+    assert result['errors'][0]['file_path'] == paths['newest']
+    assert os.path.exists(paths['newest'])
+    assert paths['newest'] in remaining_paths(conn)
+
+
+def test_changed_kept_copy_blocks_its_group(library):
+    conn, _, paths = library
+    os.utime(paths['oldest'], (1_500_000, 1_500_000))
+    result = resolve_duplicates(conn, policy='oldest', action='delete')
+
+    assert result['failed'] == 2 and result['files'] == 0
+    assert all(os.path.exists(path) for path in paths.values())
+
+
+def test_report_hides_stat_cache_columns(library):
+    conn, _, _ = library
+    report = duplicate_report(conn)
+    assert report['summary']['groups'] == 1
+    file = report['groups'][0]['files'][0]
+    assert 'mtime_ns' not in file and 'inode' not in file
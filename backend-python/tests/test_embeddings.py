@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+import db
+import embeddings
+from embeddings import VectorStore, search_embeddings
+
+
+def test_store_sees_vectors_another_process_wrote_first(workdir):
+    # A store cached before any vectors existed, as a server worker's would be
+    cached = VectorStore('model', directory=str(workdir / 'vectors'))
+    assert cached.rows() == 0 and cached.matrix() is None
+
+    writer = VectorStore('model', directory=str(workdir / 'vectors'))
+    assert writer.append(np.eye(3)[:2]).tolist() == [0, 1]
+
+    assert cached.rows() == 2
+    assert cached.matrix().shape == (2, 3)
+    rows, scores = cached.search(np.array([0, 1, 0]), limit=1)
+    assert rows.tolist() == [1]
+
+def test_appends_continue_the_row_numbers(workdir):
+    first = VectorStore('model', directory=str(workdir / 'vectors'))
+    first.append(np.eye(4)[:3])
+    second = VectorStore('model', directory=str(workdir / 'vectors'))
+    assert second.append(np.eye(4)[3:]).tolist() == [3]
+    with pytest.raises(ValueError):
+        second.append(np.ones((1, 5)))
+
+def test_image_query_without_stored_vectors_is_not_found(workdir, monkeypatch):
+    monkeypatch.setattr(embeddings, '_stores', {})
+    conn = db.create_connection()
+    try:
+        with conn:
+            conn.execute('INSERT INTO embeddings (model, hash, row) VALUES (?, ?, ?)', ('clip', 'h1', 0))
+        # The row was recorded but vectors.bin is gone
+        assert not os.path.exists(os.path.join('embeddings', 'clip', 'vectors.bin'))
+        with pytest.raises(LookupError):
+            search_embeddings(conn, 'clip', file_hash='h1')
+    finally:
+        conn.close()
@@ -0,0 +1,61 @@
+import pytest
+
+import db
+import file_query
+
+
+@pytest.fixture
+def library(client):
+    conn = db.create_connection()
+    with conn:
+        conn.executemany('''
+        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash)
+        VALUES (?, ?, ?, '.jpg', '', '', ?)
+        ''', [(f'{i}.jpg', f'/photos/{i}.jpg', i, f'h{i}') for i in range(1, 8)])
+    conn.close()
+
+
+def test_files_are_paged_by_default(library, client, monkeypatch):
+    monkeypatch.setattr(file_query, 'DEFAULT_PAGE_SIZE', 3)
+    page = client.get('/api/v1/files').json
+    assert [item['id'] for item in page['items']] == [1, 2, 3]
+    assert page['next_cursor']
+
+def test_cursor_walks_every_file_once(library, client):
+    ids, cursor = [], None
+    while True:
+        page = client.get('/api/v1/files?limit=3&sort=file_size&order=desc'
+                          + (f'&cursor={cursor}' if cursor else '')).json
+        ids += [item['id'] for item in page['items']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert ids == [7, 6, 5, 4, 3, 2, 1]
+
+def test_all_streams_the_legacy_array(library, client):
+    files = client.get('/api/v1/files?all=1').json
+    assert isinstance(files, list) and len(files) == 7
+
+
+def test_hand_added_labels_are_not_an_analysis(library, client):
+    response = client.post('/api/v1/files/bulk', json={'operation': 'tag', 'ids': [1], 'add': ['Beach']})
+    assert response.status_code == 200
+    conn = db.create_connection()
+    with conn:
+        conn.execute("INSERT INTO image_analysis (hash, description, tags) VALUES ('h2', 'A dog', '[\"dog\"]')")
+    conn.close()
+
+    files = {item['id']: item for item in client.get('/api/v1/files?limit=3').json['items']}
+    assert files[1]['analysis'] is None
+    assert files[1]['labels'] == {'tags': ['Beach'], 'categories': []}
+    assert files[2]['analysis']['description'] == 'A dog'
+    assert files[2]['labels'] == {'tags': ['dog'], 'categories': []}
+    assert files[3]['analysis'] is None and files[3]['labels'] == {'tags': [], 'categories': []}
+
+    # The streamed array splices the same JSON in
+    streamed = {item['id']: item for item in client.get('/api/v1/files?all=1').json}
+    assert [streamed[i]['labels'] for i in (1, 2, 3)] == [files[i]['labels'] for i in (1, 2, 3)]
+    assert streamed[1]['analysis'] is None
+
+    only_labels = client.get('/api/v1/files?limit=1&fields=labels').json['items']
+    assert only_labels == [{'labels': {'tags': ['Beach'], 'categories': []}}]
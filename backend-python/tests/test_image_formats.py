@@ -0,0 +1,289 @@
+import io
+import random
+import struct
+import warnings
+import importlib.util
+
+import pytest
+from PIL import Image
+
+from image_formats import MAX_IFDS, TiffReader, open_image
+from indexer import get_image_properties
+
+CR3_METADATA_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+CR3_PREVIEW_UUID = bytes.fromhex('eaf42b5e1c984b88b9fbb7dc406e4d16')
+
+
+def jpeg(width, height, color, exif=None):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(output, 'JPEG', **({'exif': exif} if exif else {}))
+    return output.getvalue()
+
+
+class Tiff:
+    # Little-endian TIFF builder. Blobs and IFDs are appended as they are
+    # added, so offsets are known before the IFDs pointing at them are written.
+    def __init__(self):
+        self.data = bytearray(b'II*\x00\x00\x00\x00\x00')
+
+    def blob(self, data):
+        offset = len(self.data)
+        self.data += data
+        if len(self.data) % 2:
+            self.data += b'\x00'
+        return offset
+
+    def ifd(self, entries, next_offset=0):
+        # entries are (tag, type, values): a string for ASCII, floats for RATIONAL
+        fields = []
+        for tag, field_type, values in sorted(entries):
+            if field_type == 2:
+                value = values.encode() + b'\x00'
+                count = len(value)
+            elif field_type == 5:
+                value = b''.join(struct.pack('<LL', int(v * 1000), 1000) for v in values)
+                count = len(values)
+            else:
+                fmt = {3: 'H', 4: 'L'}[field_type]
+                value = struct.pack(f'<{fmt * len(values)}', *values)
+                count = len(values)
+            field = value.ljust(4, b'\x00') if len(value) <= 4 else struct.pack('<L', self.blob(value))
+            fields.append(struct.pack('<HHL', tag, field_type, count) + field)
+        offset = len(self.data)
+        self.data += struct.pack('<H', len(fields)) + b''.join(fields) + struct.pack('<L', next_offset)
+        return offset
+
+    def finish(self, first):
+        self.data[4:8] = struct.pack('<L', first)
+        return bytes(self.data)
+
+
+def tiff(entries):
+    builder = Tiff()
+    return builder.finish(builder.ifd(entries))
+
+
+def box(box_type, payload):
+    return struct.pack('>L', 8 + len(payload)) + box_type + payload
+
+def full(box_type, version, payload, flags=0):
+    return box(box_type, bytes([version]) + flags.to_bytes(3, 'big') + payload)
+
+
+# A lossless-JPEG sensor strip (SOF3), which Pillow cannot decode
+LOSSLESS = b'\xff\xd8\xff\xc3\x00\x0b\x08\x0f\xa0\x17\x70\x01\x01\x11\x00' + b'\x00' * 100
+
+
+def make_dng():
+    # IFD0 with EXIF and GPS, SubIFDs of two preview sizes and the sensor
+    # data, and a thumbnail in IFD1
+    t = Tiff()
+    thumb = jpeg(160, 120, 'red')
+    thumb_offset = t.blob(thumb)
+    small, large = jpeg(640, 480, 'green'), jpeg(1600, 1200, 'blue')
+    small_offset, large_offset = t.blob(small), t.blob(large)
+    raw_offset = t.blob(LOSSLESS)
+    exif = t.ifd([(0x9003, 2, '2021:05:06 07:08:09'), (0xA002, 4, [6000]), (0xA003, 4, [4000])])
+    gps = t.ifd([(1, 2, 'N'), (2, 5, [40, 30, 0]), (3, 2, 'W'), (4, 5, [73, 0, 0])])
+    previews = [
+        t.ifd([(254, 4, [1]), (256, 4, [640]), (257, 4, [480]), (259, 3, [7]), (262, 3, [6]),
+               (273, 4, [small_offset]), (279, 4, [len(small)])]),
+        t.ifd([(254, 4, [1]), (259, 3, [7]), (262, 3, [6]), (273, 4, [large_offset]), (279, 4, [len(large)])]),
+    ]
+    sensor = t.ifd([(254, 4, [0]), (256, 4, [6000]), (257, 4, [4000]), (259, 3, [7]), (262, 3, [32803]),
+                    (273, 4, [raw_offset]), (279, 4, [len(LOSSLESS)])])
+    ifd1 = t.ifd([(513, 4, [thumb_offset]), (514, 4, [len(thumb)])])
+    ifd0 = t.ifd([(271, 2, 'TestCam'), (272, 2, 'Model X'), (274, 3, [6]), (306, 2, '2021:01:01 00:00:00'),
+                  (330, 4, previews + [sensor]), (0x8769, 4, [exif]), (0x8825, 4, [gps])], next_offset=ifd1)
+    return t.finish(ifd0)
+
+def make_sensor_only_nef():
+    t = Tiff()
+    raw_offset = t.blob(LOSSLESS)
+    return t.finish(t.ifd([(254, 4, [0]), (256, 4, [100]), (257, 4, [50]), (259, 3, [7]), (262, 3, [32803]),
+                           (271, 2, 'Other'), (273, 4, [raw_offset]), (279, 4, [len(LOSSLESS)])]))
+
+def make_raf():
+    exif = Image.Exif()
+    exif[271] = 'FUJIFILM'
+    exif[272] = 'X-T3'
+    preview = jpeg(1920, 1280, 'yellow', exif.tobytes())
+    header = b'FUJIFILMCCD-RAW 0201FF383501'.ljust(84, b'\x00') + struct.pack('>LL', 100, len(preview))
+    return header.ljust(100, b'\x00') + preview
+
+def make_cr3():
+    cmt1 = tiff([(271, 2, 'Canon'), (272, 2, 'Canon EOS R5'), (306, 2, '2022:02:02 02:02:02')])
+    cmt2 = tiff([(0x9003, 2, '2022:03:03 03:03:03'), (0xA002, 4, [8192]), (0xA003, 4, [5464])])
+    thumb = struct.pack('>HHLHH', 160, 120, 0, 0, 0) + b'\x00' * 4 + jpeg(160, 120, 'red')
+    preview = b'\x00' * 4 + struct.pack('>HHHL', 1620, 1080, 0, 0) + jpeg(1620, 1080, 'purple')
+    metadata = box(b'uuid', CR3_METADATA_UUID + box(b'CMT1', cmt1) + box(b'CMT2', cmt2) + box(b'THMB', thumb))
+    return (box(b'ftyp', b'crx \x00\x00\x00\x01crx isom') + box(b'moov', metadata)
+            + box(b'uuid', CR3_PREVIEW_UUID + b'\x00' * 8 + box(b'PRVW', preview)) + box(b'mdat', b'\x00' * 64))
+
+def make_heic():
+    # A primary HEVC item with an ispe property, and an Exif item in mdat
+    exif = tiff([(271, 2, 'Apple'), (272, 2, 'iPhone 15'), (274, 3, [6])])
+
+    def head(exif_offset):
+        items = full(b'iinf', 0, struct.pack('>H', 2)
+                     + full(b'infe', 2, struct.pack('>HH', 1, 0) + b'hvc1\x00')
+                     + full(b'infe', 2, struct.pack('>HH', 2, 0) + b'Exif\x00'))
+        locations = full(b'iloc', 0, bytes([0x44, 0x00]) + struct.pack('>H', 2)
+                         + struct.pack('>HHHLL', 1, 0, 1, 0, 10)
+                         + struct.pack('>HHHLL', 2, 0, 1, exif_offset, 4 + len(exif)))
+        properties = box(b'ipco', full(b'ispe', 0, struct.pack('>LL', 4032, 3024)))
+        associations = full(b'ipma', 0, struct.pack('>L', 1) + struct.pack('>HB', 1, 1) + bytes([0x81]))
+        meta = full(b'meta', 0, full(b'hdlr', 0, b'\x00' * 4 + b'pict' + b'\x00' * 13)
+                    + full(b'pitm', 0, struct.pack('>H', 1)) + items + locations
+                    + box(b'iprp', properties + associations))
+        return box(b'ftyp', b'heic\x00\x00\x00\x00mif1heic') + meta
+
+    exif_offset = len(head(0)) + 8
+    return head(exif_offset) + box(b'mdat', struct.pack('>L', 0) + exif)
+
+
+FILES = {
+    'photo.dng': make_dng(),
+    'sensor_only.nef': make_sensor_only_nef(),
+    'photo.raf': make_raf(),
+    'photo.cr3': make_cr3(),
+    'photo.heic': make_heic(),
+}
+
+
+@pytest.mark.parametrize('size, expected', [(300, (640, 480)), (1000, (1600, 1200)), (None, (1600, 1200))])
+def test_dng_opens_smallest_preview_covering_size(size, expected):
+    with open_image('photo.dng', FILES['photo.dng'], size=size) as source:
+        assert source.image.size == expected
+        # Dimensions are the sensor's, not the preview's
+        assert source.size == (6000, 4000)
+
+def test_dng_properties_come_from_the_container():
+    with open_image('photo.dng', FILES['photo.dng']) as source:
+        properties = get_image_properties(source)
+    assert (properties['width'], properties['height']) == (4000, 6000)
+    assert properties['camera_make'] == 'TestCam'
+    assert properties['camera_model'] == 'Model X'
+    assert properties['gps_latitude'] == pytest.approx(40.5)
+    assert properties['gps_longitude'] == pytest.approx(-73.0)
+
+def test_dng_reads_from_disk_like_from_memory(tmp_path):
+    path = tmp_path / 'photo.dng'
+    path.write_bytes(FILES['photo.dng'])
+    with open_image(str(path), size=300) as source:
+        assert source.image.size == (640, 480)
+
+def test_raw_without_preview_needs_a_full_decode():
+    if importlib.util.find_spec('rawpy') is not None:
+        pytest.skip('rawpy is installed and would decode the sensor data')
+    source = open_image('sensor_only.nef', FILES['sensor_only.nef'], size=300)
+    assert source.exif.get(271) == 'Other'
+    with pytest.raises(ValueError, match='rawpy'):
+        source.image
+
+def test_raf_preview_carries_the_exif():
+    with open_image('photo.raf', FILES['photo.raf'], size=300) as source:
+        assert source.image.size == (1920, 1280)
+        assert source.exif.get(272) == 'X-T3'
+
+@pytest.mark.parametrize('size, expected', [(100, (160, 120)), (300, (1620, 1080))])
+def test_cr3_thumbnail_or_preview(size, expected):
+    with open_image('photo.cr3', FILES['photo.cr3'], size=size) as source:
+        assert source.image.size == expected
+        assert source.size == (8192, 5464)
+        assert source.exif.get(272) == 'Canon EOS R5'
+
+def test_heic_metadata_without_decoding():
+    source = open_image('photo.heic', FILES['photo.heic'])
+    assert source.size == (4032, 3024)
+    assert source.exif.get(271) == 'Apple'
+    properties = get_image_properties(source)
+    assert (properties['width'], properties['height']) == (3024, 4032)
+    assert properties['camera_model'] == 'iPhone 15'
+
+
+@pytest.mark.parametrize('name', FILES)
+def test_truncated_files_fail_cleanly(name):
+    # At every cut, opening and reading metadata either works or raises the
+    # ValueError or OSError indexing reports per file; never a parsing error
+    data = FILES[name]
+    for end in range(0, len(data), max(1, len(data) // 500)):
+        try:
+            with open_image(name, data[:end], size=300) as source:
+                source.size
+                source.exif
+        except (ValueError, OSError):
+            pass
+
+@pytest.mark.parametrize('name', FILES)
+def test_corrupted_structures_fail_cleanly(name):
+    # Bytes overwritten at random, mostly in the headers and directories
+    rng = random.Random(name)
+    for _ in range(300):
+        data = bytearray(FILES[name])
+        for _ in range(rng.randint(1, 6)):
+            data[rng.randrange(min(len(data), 600))] = rng.randrange(256)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                with open_image(name, bytes(data), size=300) as source:
+                    source.size
+                    source.exif
+        except (ValueError, OSError):
+            pass
+
+def test_looping_ifd_chains_end():
+    t = Tiff()
+    # IFD1 points back at IFD0, and IFD0 lists itself among its SubIFDs
+    first = len(t.data)
+    second = first + 2 + 2 * 12 + 4
+    assert t.ifd([(271, 2, 'Lp'), (330, 4, [first])], next_offset=second) == first
+    assert t.ifd([(272, 2, 'Bk')], next_offset=first) == second
+    data = t.finish(first)
+
+    ifds = TiffReader(io.BytesIO(data)).chain()
+    assert len(ifds) == 2
+    source = open_image('loop.nef', data)
+    assert source.exif.get(271) == 'Lp'
+
+def test_long_ifd_chains_are_cut_off():
+    # A chain longer than MAX_IFDS, each IFD pointing at the next
+    t = Tiff()
+    count = MAX_IFDS + 10
+    first = len(t.data)
+    ifd_size = 2 + 12 + 4
+    for i in range(count):
+        t.ifd([(305, 3, [i])], next_offset=first + (i + 1) * ifd_size)
+    ifds = TiffReader(io.BytesIO(t.finish(first))).chain()
+    assert len(ifds) == MAX_IFDS
+
+def test_oversized_counts_are_not_read():
+    # An entry claiming 2**31 values, and an IFD claiming 65535 entries
+    t = Tiff()
+    bogus = struct.pack('<HHLL', 271, 2, 2 ** 31, 8)
+    first = t.blob(struct.pack('<H', 1) + bogus + struct.pack('<L', 0))
+    huge = t.blob(struct.pack('<H', 65535) + struct.pack('<HHL', 272, 2, 4) + b'Cam\x00')
+    data = bytearray(t.finish(first))
+    data[first + 2 + 12:first + 2 + 16] = struct.pack('<L', huge)
+
+    ifds = TiffReader(io.BytesIO(bytes(data))).chain()
+    assert 271 not in ifds[0]
+    assert ifds[1][272] == 'Cam'
+
+def test_multi_valued_preview_tags_are_ignored():
+    t = Tiff()
+    preview = jpeg(64, 48, 'red')
+    offset = t.blob(preview)
+    data = t.finish(t.ifd([(271, 2, 'Odd'), (513, 4, [offset, offset]), (514, 4, [len(preview)])]))
+    source = open_image('odd.nef', data, size=300)
+    assert source.exif.get(271) == 'Odd'
+    assert source._image is None
+
+def test_looping_boxes_end():
+    # A zero-size box runs to the end of its parent; an undersized one ends the walk
+    looping = box(b'ftyp', b'crx \x00\x00\x00\x01') + struct.pack('>L4s', 4, b'moov') + b'\x00' * 32
+    source = open_image('loop.cr3', looping)
+    assert source.exif == {}
+    endless = box(b'ftyp', b'heic\x00\x00\x00\x00') + struct.pack('>L4s', 0, b'meta') + b'\x00' * 4
+    source = open_image('loop.heic', endless)
+    assert source.exif == {}
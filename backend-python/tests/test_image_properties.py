@@ -0,0 +1,49 @@
+from PIL import Image
+
+import db
+from indexer import index_directory
+
+
+def save_photo(path, size, make=None, model=None, taken=None, gps=None, orientation=None):
+    exif = Image.Exif()
+    if make:
+        exif[271], exif[272] = make, model
+    if orientation:
+        exif[274] = orientation
+    if taken:
+        exif.get_ifd(0x8769)[36867] = taken
+    if gps:
+        exif.get_ifd(0x8825).update(gps)
+    Image.new('RGB', size, 'gray').save(path, exif=exif)
+
+
+def test_exif_is_stored_in_columns_and_queryable(client, workdir):
+    photos = workdir / 'photos'
+    photos.mkdir()
+    save_photo(photos / 'london.jpg', (64, 48), 'Canon', 'EOS R5', '2021:06:01 10:00:00',
+               {1: 'N', 2: (51.0, 30.0, 0.0), 3: 'W', 4: (0.0, 7.0, 30.0)})
+    save_photo(photos / 'portrait.jpg', (64, 48), 'Canon', 'EOS R5', '2019:01:02 03:04:05', orientation=6)
+    save_photo(photos / 'plain.jpg', (20, 10))
+    index_directory(str(photos), image_workers=1)
+
+    conn = db.create_connection()
+    try:
+        rows = {row['file_name']: dict(row) for row in conn.execute('SELECT * FROM files')}
+    finally:
+        conn.close()
+    london = rows['london.jpg']
+    assert (london['width'], london['height']) == (64, 48)
+    assert london['date_taken'] == '2021-06-01T10:00:00'
+    assert (london['camera_make'], london['camera_model']) == ('Canon', 'EOS R5')
+    assert round(london['gps_latitude'], 4) == 51.5 and round(london['gps_longitude'], 4) == -0.125
+    # Displayed rotated, so width and height swap
+    assert (rows['portrait.jpg']['width'], rows['portrait.jpg']['height']) == (48, 64)
+    assert rows['plain.jpg']['date_taken'] is None and rows['plain.jpg']['camera_make'] is None
+
+    def names(query):
+        return [item['file_name'] for item in client.get(f'/api/v1/files?fields=file_name&{query}').json['items']]
+
+    assert names('camera_model=EOS R5&sort=date_taken') == ['portrait.jpg', 'london.jpg']
+    assert names('taken_after=2020-01-01') == ['london.jpg']
+    assert names('has_gps=1') == ['london.jpg']
+    assert names('min_width=30&sort=width&order=desc') == ['london.jpg', 'portrait.jpg']
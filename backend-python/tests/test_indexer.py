@@ -0,0 +1,134 @@
+import io
+import os
+import hashlib
+import threading
+import concurrent.futures
+
+from PIL import Image
+
+import db
+import indexer
+from indexer import IMAGE_POOL_CONTEXT, create_image_hash, index_directory, index_paths
+
+
+def test_index_directory_with_image_worker_processes(workdir):
+    photos = workdir / 'photos'
+    photos.mkdir()
+    Image.new('RGB', (640, 480), 'red').save(photos / 'red.jpg')
+    Image.new('RGB', (300, 200), 'blue').save(photos / 'blue.png')
+    (photos / 'notes.txt').write_text('not an image')
+
+    # Workers are not forked from this threaded process
+    assert IMAGE_POOL_CONTEXT.get_start_method() in ('forkserver', 'spawn')
+    index_directory(str(photos), image_workers=2)
+
+    conn = db.create_connection()
+    try:
+        rows = {row['file_name']: row for row in conn.execute('SELECT * FROM files')}
+    finally:
+        conn.close()
+    assert (rows['red.jpg']['width'], rows['red.jpg']['height']) == (640, 480)
+    assert (rows['blue.png']['width'], rows['blue.png']['height']) == (300, 200)
+    # Workers save thumbnails relative to the directory they were started from
+    assert os.path.exists(workdir / rows['red.jpg']['thumbnail_path'])
+
+
+def test_index_paths_leaves_a_shared_pool_running(workdir):
+    photos = workdir / 'photos'
+    photos.mkdir()
+    Image.new('RGB', (64, 48), 'red').save(photos / 'red.jpg')
+    Image.new('RGB', (32, 24), 'blue').save(photos / 'blue.jpg')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=IMAGE_POOL_CONTEXT) as pool:
+        for name in ('red.jpg', 'blue.jpg'):
+            stats = index_paths(str(photos), [str(photos / name)], image_pool=pool)
+            assert stats['new'] == 1 and stats['errors'] == 0
+        assert pool.submit(abs, -1).result() == 1
+
+    conn = db.create_connection()
+    try:
+        sizes = {row['file_name']: (row['width'], row['height']) for row in conn.execute('SELECT * FROM files')}
+    finally:
+        conn.close()
+    assert sizes == {'red.jpg': (64, 48), 'blue.jpg': (32, 24)}
+
+
+def test_create_image_hash_reads_in_configured_chunks(tmp_path, monkeypatch):
+    path = tmp_path / 'large.bin'
+    data = os.urandom(100_000)
+    path.write_bytes(data)
+    reads = []
+
+    class RecordingFile(io.FileIO):
+        def readinto(self, buffer):
+            reads.append(len(buffer))
+            return super().readinto(buffer)
+
+    monkeypatch.setattr(indexer, 'open', lambda file, mode, buffering: RecordingFile(file, mode), raising=False)
+
+    assert create_image_hash(str(path), chunk_size=4096) == hashlib.sha256(data).hexdigest()
+    assert set(reads) == {4096}
+
+
+def test_rescan_skips_unchanged_files(workdir, monkeypatch):
+    photos = workdir / 'photos'
+    photos.mkdir()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        (photos / name).write_text(name)
+    first = index_directory(str(photos))
+    assert first['new'] == 3
+
+    (photos / 'b.txt').write_text('b, edited')
+    opened = []
+    real_read_file = indexer.read_file
+    monkeypatch.setattr(indexer, 'read_file', lambda path, size: opened.append(path) or real_read_file(path, size))
+    second = index_directory(str(photos))
+
+    assert (second['skipped'], second['rehashed'], second['new']) == (2, 1, 0)
+    # Unchanged files are matched on size, mtime and inode without being read
+    assert opened == [str(photos / 'b.txt')]
+    conn = db.create_connection()
+    try:
+        row = conn.execute("SELECT hash FROM files WHERE file_name = 'b.txt'").fetchone()
+    finally:
+        conn.close()
+    assert row['hash'] == hashlib.sha256(b'b, edited').hexdigest()
+
+
+def test_pipeline_with_tiny_queues_indexes_every_file(workdir, monkeypatch):
+    photos = workdir / 'photos'
+    for album in range(5):
+        (photos / f'album{album}').mkdir(parents=True)
+        for i in range(10):
+            (photos / f'album{album}' / f'{i}.txt').write_text(f'{album}-{i}')
+    Image.new('RGB', (40, 30), 'green').save(photos / 'green.png')
+    threads = set()
+    real_read_file = indexer.read_file
+    monkeypatch.setattr(indexer, 'read_file',
+                        lambda path, size: threads.add(threading.current_thread().name) or real_read_file(path, size))
+
+    # Every stage pushes back on the one before it instead of buffering
+    stats = index_directory(str(photos), hash_workers=4, image_workers=1, path_queue_size=1,
+                            image_queue_size=1, write_queue_size=1, write_batch_size=7)
+
+    assert stats['discovered'] == stats['new'] == 51 and stats['errors'] == 0
+    assert threads and all(name.startswith('index-hash-') for name in threads)
+    conn = db.create_connection()
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 51
+        row = conn.execute("SELECT width, thumbnail_path FROM files WHERE file_name = 'green.png'").fetchone()
+    finally:
+        conn.close()
+    assert row['width'] == 40 and row['thumbnail_path']
+
+
+def test_cancelled_pipeline_stops_without_hanging(workdir):
+    photos = workdir / 'photos'
+    photos.mkdir()
+    for i in range(20):
+        (photos / f'{i}.txt').write_text(str(i))
+    cancel_event = threading.Event()
+    cancel_event.set()
+
+    stats = index_directory(str(photos), cancel_event=cancel_event, path_queue_size=1)
+    assert stats['new'] == 0
@@ -0,0 +1,65 @@
+import sqlite3
+import threading
+
+import pytest
+
+from jobs import JobManager
+
+
+@pytest.fixture
+def manager(workdir):
+    # No worker threads, so submitted jobs stay queued
+    manager = JobManager(workers=0)
+    manager.register('embed', lambda job: None)
+    return manager
+
+
+def test_one_active_embedding_job_per_model(manager):
+    first = manager.submit('embed', {'model': 'clip'})
+    with pytest.raises(sqlite3.IntegrityError):
+        manager.submit('embed', {'model': 'clip'})
+    manager.submit('embed', {'model': 'text'})
+
+    manager.cancel(first.id)
+    manager.submit('embed', {'model': 'clip'})
+
+def test_concurrent_embedding_submissions_start_one_job(manager):
+    started, rejected = [], []
+    barrier = threading.Barrier(8)
+
+    def submit():
+        barrier.wait()
+        try:
+            started.append(manager.submit('embed', {'model': 'clip'}))
+        except sqlite3.IntegrityError:
+            rejected.append(True)
+
+    threads = [threading.Thread(target=submit) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(started) == 1 and len(rejected) == 7
+    assert [job.id for job in manager.active('embed')] == [started[0].id]
+
+
+def test_cancelled_queued_job_is_forgotten(manager):
+    job = manager.submit('embed', {'model': 'clip'})
+    assert job.id in manager.jobs
+    manager.cancel(job.id)
+    assert job.id not in manager.jobs
+    assert manager.get(job.id).status == 'cancelled'
+
+
+def test_job_cancelled_before_it_starts_never_runs(manager):
+    calls = []
+    manager.register('index', calls.append)
+    job = manager.submit('index', {})
+    # Cancelled after the worker took it off the queue
+    job.cancel_event.set()
+    manager.run(job)
+
+    assert calls == []
+    assert job.started_at is None
+    assert manager.get(job.id).status == 'cancelled'
+    assert job.id not in manager.jobs
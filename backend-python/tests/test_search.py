@@ -0,0 +1,18 @@
+import db
+
+
+def test_snippets_escape_indexed_text(client):
+    conn = db.create_connection()
+    with conn:
+        conn.execute('''
+        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash)
+        VALUES (?, ?, 1, '.jpg', '', '', 'h1')
+        ''', ('<img src=x onerror=alert(1)> beach.jpg', '/photos/<script>/beach.jpg'))
+    conn.close()
+
+    response = client.get('/api/v1/search?q=beach&in=file_name')
+    assert response.status_code == 200
+    snippet = response.get_json()['items'][0]['snippet']
+    assert '<img' not in snippet
+    assert '&lt;img src=x onerror=alert(1)&gt;' in snippet
+    assert '<mark>beach</mark>' in snippet
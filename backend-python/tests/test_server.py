@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+
+@pytest.mark.parametrize('probes', ['abc', '0', '-3'])
+def test_semantic_search_rejects_bad_probes(client, probes):
+    response = client.get(f'/api/v1/semantic-search?q=cat&probes={probes}')
+    assert response.status_code == 400
+    assert 'probes' in response.json['error']
+
+
+@pytest.fixture
+def finished_job(client):
+    from jobs import Job
+    job = Job('job1', 'index', {}, status='completed')
+    for key in ('a', 'b', 'c'):
+        job.record_item(key, 'done')
+    job.save()
+    return job
+
+
+@pytest.mark.parametrize('url', ['/api/v1/jobs', '/api/v1/jobs/job1/items'])
+def test_job_limits_reject_non_integers(finished_job, client, url):
+    response = client.get(f'{url}?limit=abc')
+    assert response.status_code == 400
+    assert 'limit' in response.json['error']
+
+
+def test_job_limits_are_clamped(finished_job, client):
+    assert len(client.get('/api/v1/jobs?limit=0').json) == 1
+    page = client.get('/api/v1/jobs/job1/items?limit=-5').json
+    assert [item['item_key'] for item in page['items']] == ['a']
+    assert page['next_after'] == 'a'
+    assert len(client.get('/api/v1/jobs/job1/items').json['items']) == 3
+
+
+def test_second_embedding_job_for_a_model_conflicts(client, monkeypatch):
+    import server
+    from jobs import JobManager
+    manager = JobManager(workers=0)
+    manager.register('embed', lambda job: None)
+    monkeypatch.setattr(server, 'job_manager', manager)
+
+    first = client.post('/api/v1/embeddings', json={})
+    assert first.status_code == 202
+    second = client.post('/api/v1/embeddings', json={})
+    assert second.status_code == 409
+    assert second.json['job_id'] == first.json['job_id']
+
+
+def test_metrics_are_labelled_with_the_worker_pid(client):
+    # Request timings are recorded once the response is closed
+    client.get('/api/v1/metrics?format=json').close()
+    text = client.get('/api/v1/metrics').get_data(as_text=True)
+    assert f'revue_http_request_seconds_count{{pid="{os.getpid()}",' in text
+    assert f'revue_process_uptime_seconds{{pid="{os.getpid()}"}}' in text
+    assert client.get('/api/v1/metrics?format=json').json['pid'] == os.getpid()
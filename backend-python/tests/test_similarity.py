@@ -0,0 +1,86 @@
+import random
+
+import numpy as np
+import pytest
+
+import db
+import similarity
+from similarity import MultiIndexHash
+
+
+def planted_hashes(count=3000, seed=7):
+    # Random 64-bit hashes, half of them with a few bits flipped from another
+    rng = random.Random(seed)
+    hashes = [rng.getrandbits(64) for _ in range(count // 2)]
+    for value in list(hashes):
+        for position in rng.sample(range(64), rng.randint(0, 10)):
+            value ^= 1 << position
+        hashes.append(value)
+    return list(enumerate(hashes))
+
+def brute_force_pairs(hashes, radius):
+    values = np.array(hashes, dtype=np.uint64)
+    pairs = set()
+    for index in range(len(values)):
+        distances = similarity.popcount64(values[index + 1:] ^ values[index])
+        pairs.update((index, index + 1 + other) for other in np.flatnonzero(distances <= radius).tolist())
+    return pairs
+
+
+@pytest.mark.parametrize('substrings', [3, 4, 8])
+@pytest.mark.parametrize('radius', [4, 8])
+def test_candidate_pairs_match_brute_force(substrings, radius):
+    index = MultiIndexHash(planted_hashes(), substrings=substrings)
+    found = [(left, right) for lefts, rights in index.candidate_pairs(radius)
+             for left, right in zip(lefts.tolist(), rights.tolist())]
+    assert {tuple(sorted(pair)) for pair in found} == brute_force_pairs(index.hashes, radius)
+
+def test_wide_substrings_use_binary_search(monkeypatch):
+    monkeypatch.setattr(similarity, 'DIRECT_TABLE_BITS', 0)
+    index = MultiIndexHash(planted_hashes(), substrings=3)
+    found = {tuple(sorted(pair)) for lefts, rights in index.candidate_pairs(8)
+             for pair in zip(lefts.tolist(), rights.tolist())}
+    assert found == brute_force_pairs(index.hashes, 8)
+
+def test_clusters_group_row_ids():
+    items = [(1, 0), (2, 0b111), (3, 0), (4, (1 << 64) - 1), (5, (1 << 64) - 2), (6, 0x0F0F0F0F0F0F0F0F)]
+    clusters = MultiIndexHash(items).clusters(8)
+    assert sorted(sorted(cluster) for cluster in clusters) == [[1, 2, 3], [4, 5]]
+
+
+def test_clusters_are_computed_once_per_radius(monkeypatch):
+    index = MultiIndexHash([(1, 0), (2, 0b11), (3, (1 << 20) - 1)])
+    calls = []
+    find_clusters = index.find_clusters
+    monkeypatch.setattr(index, 'find_clusters', lambda radius: calls.append(radius) or find_clusters(radius))
+
+    assert index.clusters(8) == [[1, 2]]
+    assert index.clusters(8) == [[1, 2]]
+    assert index.clusters(1) == []
+    assert calls == [8, 1]
+
+def test_cached_clusters_follow_hash_changes(client):
+    conn = db.create_connection()
+
+    def add(row_id, value):
+        with conn:
+            conn.execute('''
+            INSERT INTO files (id, file_name, file_path, file_size, file_format, date_created, date_modified, hash,
+                               phash)
+            VALUES (?, ?, ?, 1, '.jpg', '', '', ?, ?)
+            ''', (row_id, f'{row_id}.jpg', f'/photos/{row_id}.jpg', f'h{row_id}', similarity.to_signed64(value)))
+
+    try:
+        add(1, 0)
+        add(2, 0b11)
+        add(3, (1 << 64) - 1)
+        first = client.get('/api/v1/get-similar-files?threshold=4').json
+        assert [[file['id'] for file in cluster] for cluster in first] == [[1, 2]]
+        assert similarity.load_hash_index(conn, 'phash', 4).clusters(4) is \
+            similarity.load_hash_index(conn, 'phash', 4).clusters(4)
+
+        add(4, (1 << 64) - 2)
+        second = client.get('/api/v1/get-similar-files?threshold=4').json
+        assert sorted([file['id'] for file in cluster] for cluster in second) == [[1, 2], [3, 4]]
+    finally:
+        conn.close()
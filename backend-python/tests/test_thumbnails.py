@@ -0,0 +1,118 @@
+import io
+import os
+import hashlib
+
+from PIL import Image
+
+import db
+from thumbnails import THUMBNAIL_DIR, collect_garbage, save_thumbnails, thumbnail_path
+
+
+def content_hash(name):
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def make_old(path):
+    os.utime(path, (1_000_000, 1_000_000))
+
+
+def test_gc_removes_unreferenced_and_temp_files(workdir):
+    kept_hash, dropped_hash = content_hash('kept'), content_hash('dropped')
+    image = Image.new('RGB', (50, 50), 'red')
+    save_thumbnails(image, kept_hash)
+    save_thumbnails(image, dropped_hash)
+    # Left by a writer that died between writing and renaming
+    temp_path = f"{thumbnail_path(kept_hash)}.4242.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(b'partial')
+    # Randomly named thumbnails from before content naming
+    legacy_kept = os.path.join(THUMBNAIL_DIR, 'legacy_kept.jpg')
+    legacy_dropped = os.path.join(THUMBNAIL_DIR, 'legacy_dropped.jpg')
+    image.save(legacy_kept)
+    image.save(legacy_dropped)
+
+    conn = db.create_connection()
+    with conn:
+        conn.executemany('''
+        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash,
+                           thumbnail_path)
+        VALUES (?, ?, 1, '.jpg', '', '', ?, ?)
+        ''', [('a.jpg', '/photos/a.jpg', kept_hash, thumbnail_path(kept_hash)),
+              ('b.jpg', '/photos/b.jpg', content_hash('legacy'), legacy_kept)])
+    for root, _, files in os.walk(THUMBNAIL_DIR):
+        for file in files:
+            make_old(os.path.join(root, file))
+
+    dry = collect_garbage(conn, dry_run=True, min_age=60)
+    assert dry['removed'] == 3 and os.path.exists(temp_path)
+
+    stats = collect_garbage(conn, min_age=60)
+    conn.close()
+    assert stats['removed'] == 3
+    assert os.path.exists(thumbnail_path(kept_hash)) and os.path.exists(legacy_kept)
+    assert not os.path.exists(thumbnail_path(dropped_hash))
+    assert not os.path.exists(temp_path) and not os.path.exists(legacy_dropped)
+
+
+def test_gc_spares_recent_files(workdir):
+    save_thumbnails(Image.new('RGB', (50, 50), 'red'), content_hash('unreferenced'))
+    conn = db.create_connection()
+    try:
+        assert collect_garbage(conn, min_age=60)['removed'] == 0
+    finally:
+        conn.close()
+
+
+def add_image(workdir, name, color, size=(80, 60)):
+    path = workdir / name
+    Image.new('RGB', size, color).save(path)
+    file_hash = hashlib.sha256(path.read_bytes()).hexdigest()
+    conn = db.create_connection()
+    with conn:
+        conn.execute('''
+        INSERT INTO files (file_name, file_path, file_size, file_format, date_created, date_modified, hash)
+        VALUES (?, ?, 1, '.jpg', '', '', ?)
+        ''', (name, str(path), file_hash))
+    conn.close()
+    return file_hash
+
+
+def test_thumbnail_is_rendered_on_demand_and_revalidated_with_304(client, workdir):
+    file_hash = add_image(workdir, 'red.jpg', 'red')
+    assert not os.path.exists(thumbnail_path(file_hash))
+
+    response = client.get(f'/api/v1/thumbnails/{file_hash}')
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert os.path.exists(thumbnail_path(file_hash))
+    etag = response.headers['ETag']
+
+    again = client.get(f'/api/v1/thumbnails/{file_hash}', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.data == b''
+    assert again.headers['ETag'] == etag
+
+    assert client.get(f'/api/v1/thumbnails/{"0" * 64}').status_code == 404
+    assert client.get('/api/v1/thumbnails/not-a-hash').status_code == 400
+
+
+def test_sprite_lays_out_tiles_and_reports_missing_ones(client, workdir):
+    hashes = [add_image(workdir, 'red.jpg', 'red'), '0' * 64, add_image(workdir, 'blue.jpg', 'blue')]
+    response = client.post('/api/v1/thumbnails/sprite', json={'hashes': hashes, 'tile_size': 50, 'columns': 2})
+    assert response.status_code == 200
+    assert response.headers['X-Sprite-Columns'] == '2'
+    assert response.headers['X-Sprite-Missing'] == '1'
+    with Image.open(io.BytesIO(response.data)) as sheet:
+        assert sheet.size == (100, 100)
+        # Tile 0 at the top left is red, tile 2 at the bottom left blue
+        red, _, blue = sheet.convert('RGB').getpixel((25, 25))
+        assert red > 200 and blue < 60
+        red, _, blue = sheet.convert('RGB').getpixel((25, 75))
+        assert blue > 200 and red < 60
+
+    cached = client.post('/api/v1/thumbnails/sprite', json={'hashes': hashes, 'tile_size': 50, 'columns': 2},
+                         headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+
+    page = client.get('/api/v1/thumbnails/sprite?tile_size=50&limit=1')
+    assert page.status_code == 200 and page.headers['X-Sprite-Count'] == '1'
+    assert page.headers['X-Next-Cursor']
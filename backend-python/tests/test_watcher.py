@@ -0,0 +1,253 @@
+import os
+import select
+import concurrent.futures
+
+import pytest
+
+import db
+import watcher
+from watcher import ChangeSet, InotifyWatcher, PollingWatcher, WatchManager, WatchedRoot, inotify_available
+
+
+def write(path, content=b'bytes'):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def changes_of(changes):
+    moves, deletes, paths = changes.drain()
+    return moves, sorted(deletes), sorted(paths)
+
+
+class Lost:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+
+
+@pytest.fixture
+def root(tmp_path):
+    path = tmp_path / 'library'
+    path.mkdir()
+    return str(path)
+
+
+def test_polling_create_modify_move_delete(root):
+    changes, lost = ChangeSet(), Lost()
+    existing = os.path.join(root, 'existing.jpg')
+    write(existing)
+    poller = PollingWatcher(root, changes, on_overflow=None, on_lost=lost)
+
+    created = os.path.join(root, 'new.jpg')
+    write(created)
+    poller.poll()
+    assert changes_of(changes) == ([], [], [created])
+
+    write(existing, b'edited and longer')
+    poller.poll()
+    assert changes_of(changes) == ([], [], [existing])
+
+    os.mkdir(os.path.join(root, 'album'))
+    moved = os.path.join(root, 'album', 'new.jpg')
+    os.rename(created, moved)
+    poller.poll()
+    assert changes_of(changes) == ([(created, moved)], [], [])
+
+    os.remove(existing)
+    poller.poll()
+    assert changes_of(changes) == ([], [existing], [])
+    assert lost.count == 0
+
+
+def test_polling_root_gone_is_not_a_mass_delete(root):
+    changes, lost = ChangeSet(), Lost()
+    write(os.path.join(root, 'a.jpg'))
+    poller = PollingWatcher(root, changes, on_overflow=None, on_lost=lost)
+
+    os.remove(os.path.join(root, 'a.jpg'))
+    os.rmdir(root)
+    poller.poll()
+    assert len(changes) == 0
+    assert lost.count == 1 and poller.stop_event.is_set()
+
+
+needs_inotify = pytest.mark.skipif(not inotify_available(), reason='inotify is Linux only')
+
+
+def pump(inotify):
+    # Handles every queued event on this thread instead of the watcher's own
+    while select.select([inotify.fd], [], [], 0.1)[0]:
+        inotify.handle(os.read(inotify.fd, watcher.EVENT_READ_SIZE))
+    inotify.expire_moves()
+
+
+@pytest.fixture
+def inotify(root):
+    lost = Lost()
+    inotify = InotifyWatcher(root, ChangeSet(), on_overflow=None, on_lost=lost)
+    inotify.lost = lost
+    yield inotify
+    os.close(inotify.fd)
+
+
+@needs_inotify
+def test_inotify_create_modify_move_delete(inotify, root, monkeypatch):
+    changes = inotify.changes
+    created = os.path.join(root, 'new.jpg')
+    write(created)
+    pump(inotify)
+    assert changes_of(changes) == ([], [], [created])
+
+    write(created, b'edited')
+    pump(inotify)
+    assert changes_of(changes) == ([], [], [created])
+
+    renamed = os.path.join(root, 'renamed.jpg')
+    os.rename(created, renamed)
+    pump(inotify)
+    assert changes_of(changes) == ([(created, renamed)], [], [])
+
+    os.remove(renamed)
+    pump(inotify)
+    assert changes_of(changes) == ([], [renamed], [])
+
+    # A move out of the root has no IN_MOVED_TO and becomes a delete
+    monkeypatch.setattr(watcher, 'MOVE_PAIR_TIMEOUT', 0)
+    leaving = os.path.join(root, 'leaving.jpg')
+    write(leaving)
+    pump(inotify)
+    changes.drain()
+    os.rename(leaving, os.path.join(os.path.dirname(root), 'leaving.jpg'))
+    pump(inotify)
+    assert changes_of(changes) == ([], [leaving], [])
+
+
+@needs_inotify
+def test_inotify_new_directory_is_watched_and_indexed(inotify, root):
+    album = os.path.join(root, 'album')
+    os.mkdir(album)
+    pump(inotify)
+    photo = os.path.join(album, 'photo.jpg')
+    write(photo)
+    pump(inotify)
+    assert album in inotify.watches
+    assert changes_of(inotify.changes) == ([], [], [photo])
+
+
+@needs_inotify
+def test_inotify_hard_link_is_indexed(inotify, root, tmp_path):
+    source = tmp_path / 'outside.jpg'
+    write(source)
+    linked = os.path.join(root, 'linked.jpg')
+    os.link(source, linked)
+    pump(inotify)
+    assert changes_of(inotify.changes) == ([], [], [linked])
+
+
+@needs_inotify
+@pytest.mark.parametrize('lose', ['delete', 'move'])
+def test_inotify_lost_root(inotify, root, lose):
+    if lose == 'delete':
+        os.rmdir(root)
+    else:
+        os.rename(root, root + '-moved')
+    pump(inotify)
+    assert inotify.lost.count == 1 and inotify.stop_event.is_set()
+    assert len(inotify.changes) == 0
+
+
+class RecordingIndex:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, root, paths, **options):
+        self.calls.append((root, sorted(paths), options['image_pool']))
+        return {'new': len(paths)}
+
+
+@pytest.fixture
+def manager(workdir, monkeypatch):
+    index = RecordingIndex()
+    monkeypatch.setattr(watcher, 'index_paths', index)
+    manager = WatchManager()
+    monkeypatch.setattr(manager, 'get_image_pool', lambda: 'shared-pool')
+    manager.index = index
+    yield manager
+
+
+def add_row(conn, path):
+    with conn:
+        conn.execute("INSERT INTO files (file_name, file_path, file_size, file_format, date_created, "
+                     "date_modified, hash) VALUES (?, ?, 1, '.jpg', '', '', ?)",
+                     (os.path.basename(path), path, path))
+
+
+def test_apply_renames_deletes_and_indexes(manager, root):
+    conn = db.create_connection()
+    moved_from, moved_to = os.path.join(root, 'a.jpg'), os.path.join(root, 'b.jpg')
+    deleted = os.path.join(root, 'gone.jpg')
+    add_row(conn, moved_from)
+    add_row(conn, deleted)
+    write(moved_to)
+    created = os.path.join(root, 'new.jpg')
+    write(created)
+
+    watched = WatchedRoot(root)
+    watched.changes.move(moved_from, moved_to)
+    watched.changes.delete(deleted)
+    watched.changes.index(created)
+    manager.apply(watched)
+
+    assert {row['file_path'] for row in conn.execute('SELECT file_path FROM files')} == {moved_to}
+    conn.close()
+    assert manager.index.calls == [(root, [created], 'shared-pool')]
+    assert watched.stats == {'indexed': 1, 'moved': 1, 'removed': 1, 'errors': 0}
+
+
+def test_batches_share_one_image_pool(workdir, root, monkeypatch):
+    index = RecordingIndex()
+    monkeypatch.setattr(watcher, 'index_paths', index)
+    manager = WatchManager()
+    watched = WatchedRoot(root)
+    try:
+        for name in ('a.jpg', 'b.jpg'):
+            watched.changes.index(os.path.join(root, name))
+            manager.apply(watched)
+        pools = [pool for _, _, pool in index.calls]
+        assert isinstance(pools[0], concurrent.futures.ProcessPoolExecutor)
+        assert pools[0] is pools[1]
+    finally:
+        manager.image_pool.shutdown()
+
+
+def run_once(manager):
+    # One pass of the manager loop, which otherwise runs forever
+    calls = []
+
+    def wait(timeout=None):
+        if calls:
+            raise StopIteration
+        calls.append(timeout)
+        return True
+
+    manager.wake.wait = wait
+    with pytest.raises(StopIteration):
+        manager.run()
+
+
+def test_lost_root_is_retried_and_resynced(manager, root):
+    watched = WatchedRoot(root)
+    watched.watcher = PollingWatcher(root, watched.changes, on_overflow=None,
+                                     on_lost=lambda: manager.root_lost(watched))
+    watched.needs_sync = False
+    manager.roots[root] = watched
+    manager.refreshed_at = float('inf')
+    os.rmdir(root)
+    watched.watcher.poll()
+    assert watched.lost
+
+    run_once(manager)
+    assert watched.watcher is None and watched.needs_sync
+    assert watched.status == 'unavailable' and not watched.lost
@@ -0,0 +1,336 @@
+import io
+import os
+import re
+import sys
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from PIL import Image, features
+
+from db import create_connection
+from image_formats import open_image
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = 'thumbnails'
+# The size recorded in files.thumbnail_path; the grid is laid out for it
+THUMBNAIL_SIZE = 300
+# Every size is rendered from one decode, largest first, each from the previous
+THUMBNAIL_SIZES = sorted({THUMBNAIL_SIZE, *(int(size) for size in
+                          os.environ.get('THUMBNAIL_SIZES', '').split(',') if size.strip())}, reverse=True)
+THUMBNAIL_FORMAT = os.environ.get('THUMBNAIL_FORMAT', 'jpeg').lower()
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 85))
+# Files younger than this are never collected; an index run may not have committed their rows yet
+GC_MIN_AGE = 3600
+
+FORMAT_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp'}
+MIMETYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+# Thumbnails requested before any index run made them are rendered on demand
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', os.cpu_count() or 1))
+# Seconds before content that could not be rendered (not an image, or no
+# copy left on disk) is tried again
+THUMBNAIL_RETRY_AFTER = 300
+UNAVAILABLE_ENTRIES = 10000
+# A URL naming a content hash always returns the same bytes
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+# Sprite sheets: one image holding a page of thumbnails as square tiles
+MAX_SPRITE_TILES = 500
+DEFAULT_SPRITE_TILE_SIZE = 100
+DEFAULT_SPRITE_COLUMNS = 10
+SPRITE_BACKGROUND = (255, 255, 255)
+
+CONTENT_HASH = re.compile(r'^[0-9a-f]{64}$')
+CONTENT_THUMBNAIL = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}_\d+\.(jpg|webp)$')
+
+if THUMBNAIL_FORMAT not in FORMAT_EXTENSIONS:
+    raise ValueError(f"Unsupported THUMBNAIL_FORMAT {THUMBNAIL_FORMAT}; expected jpeg or webp")
+if THUMBNAIL_FORMAT == 'webp' and not features.check('webp'):
+    logger.warning("Pillow was built without WebP support; writing JPEG thumbnails")
+    THUMBNAIL_FORMAT = 'jpeg'
+
+
+def thumbnail_path(file_hash, size=THUMBNAIL_SIZE, fmt=None):
+    # Named by content hash so every copy of an image shares one file. The
+    # two-character shard keeps directories small.
+    extension = FORMAT_EXTENSIONS[fmt or THUMBNAIL_FORMAT]
+    return os.path.join(THUMBNAIL_DIR, file_hash[:2], f"{file_hash}_{size}.{extension}")
+
+def thumbnail_paths(file_hash):
+    return {size: thumbnail_path(file_hash, size) for size in THUMBNAIL_SIZES}
+
+def reduce_decode(img, size=max(THUMBNAIL_SIZES)):
+    # JPEGs decode at the smallest DCT scale (1/2, 1/4, 1/8) that still
+    # covers size, which skips most of the IDCT work for large photos. Must
+    # be called before the image is loaded; img.size changes accordingly.
+    img.draft('RGB', (size, size))
+    return img
+
+def flatten(img):
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new(img.mode[:-1], img.size, (255, 255, 255))
+        background.paste(img, img.split()[-1])
+        return background.convert('RGB')
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+def save_thumbnails(img, file_hash):
+    # Writes any missing sizes for file_hash and returns the primary path.
+    # img is left untouched.
+    paths = thumbnail_paths(file_hash)
+    missing = [size for size in THUMBNAIL_SIZES if not os.path.exists(paths[size])]
+    if not missing:
+        return paths[THUMBNAIL_SIZE]
+
+    current = flatten(img)
+    if current is img:
+        current = img.copy()
+    os.makedirs(os.path.dirname(paths[THUMBNAIL_SIZE]), exist_ok=True)
+    for size in THUMBNAIL_SIZES:
+        current.thumbnail((size, size))
+        if size not in missing:
+            continue
+        # Worker processes may race on the same content; the rename is atomic
+        temp_path = f"{paths[size]}.{os.getpid()}.tmp"
+        current.save(temp_path, THUMBNAIL_FORMAT.upper(), quality=THUMBNAIL_QUALITY)
+        os.replace(temp_path, paths[size])
+    return paths[THUMBNAIL_SIZE]
+
+def generate_thumbnail(file_path, file_hash):
+    with open_image(file_path, size=max(THUMBNAIL_SIZES)) as source:
+        return save_thumbnails(reduce_decode(source.image), file_hash)
+
+
+def is_content_hash(value):
+    return bool(CONTENT_HASH.match(value))
+
+def is_content_thumbnail(filename):
+    # Content-named thumbnails never change once written
+    return bool(CONTENT_THUMBNAIL.match(filename.replace(os.sep, '/')))
+
+def find_thumbnail(file_hash, size=THUMBNAIL_SIZE):
+    # The thumbnail on disk in the configured format, else one left in the
+    # other format by an earlier configuration
+    for fmt in dict.fromkeys([THUMBNAIL_FORMAT, *FORMAT_EXTENSIONS]):
+        path = thumbnail_path(file_hash, size, fmt)
+        if os.path.exists(path):
+            return path
+    return None
+
+def thumbnail_etag(file_hash, size, path):
+    return f"{file_hash}-{size}.{path.rsplit('.', 1)[-1]}"
+
+
+class ThumbnailGenerator:
+    # Renders missing thumbnails on a small thread pool. Concurrent requests
+    # for the same content share one render instead of each decoding it.
+    def __init__(self, workers=THUMBNAIL_WORKERS, retry_after=THUMBNAIL_RETRY_AFTER):
+        self.workers = workers
+        self.retry_after = retry_after
+        self.pool = None
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        # Content that could not be rendered, so a grid of non-images does
+        # not decode them again on every scroll
+        self.unavailable = OrderedDict()
+
+    def ensure(self, file_hash):
+        # A future of the primary thumbnail path, or None if the content
+        # cannot be rendered
+        with self.lock:
+            failed_at = self.unavailable.get(file_hash)
+            if failed_at is not None and time.monotonic() - failed_at < self.retry_after:
+                future = concurrent.futures.Future()
+                future.set_result(None)
+                return future
+            future = self.in_flight.get(file_hash)
+            if future is None:
+                if self.pool is None:
+                    self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                      thread_name_prefix='thumbnail')
+                future = self.in_flight[file_hash] = self.pool.submit(self.run, file_hash)
+            return future
+
+    def run(self, file_hash):
+        try:
+            path = self.generate(file_hash)
+        finally:
+            with self.lock:
+                self.in_flight.pop(file_hash, None)
+        if path is None:
+            with self.lock:
+                self.unavailable[file_hash] = time.monotonic()
+                self.unavailable.move_to_end(file_hash)
+                while len(self.unavailable) > UNAVAILABLE_ENTRIES:
+                    self.unavailable.popitem(last=False)
+        return path
+
+    def generate(self, file_hash):
+        # Renders every size from the first indexed copy still readable on disk
+        conn = create_connection()
+        try:
+            file_paths = [row['file_path'] for row in
+                          conn.execute('SELECT file_path FROM files WHERE hash = ? ORDER BY id', (file_hash,))]
+            for file_path in file_paths:
+                try:
+                    with metrics.stage('thumbnail_on_demand'):
+                        path = generate_thumbnail(file_path, file_hash)
+                except Exception as e:
+                    logger.info(f"Could not render thumbnail of {file_path}: {e}")
+                    continue
+                with conn:
+                    conn.execute('UPDATE files SET thumbnail_path = ? WHERE hash = ? AND thumbnail_path IS NULL',
+                                 (path, file_hash))
+                return path
+            return None
+        finally:
+            conn.close()
+
+    def thumbnail(self, file_hash, size=THUMBNAIL_SIZE):
+        # Path of the thumbnail, rendering it first if needed; None if it
+        # cannot be rendered
+        path = find_thumbnail(file_hash, size)
+        if path is None and self.ensure(file_hash).result():
+            path = find_thumbnail(file_hash, size)
+        return path
+
+
+thumbnail_generator = ThumbnailGenerator()
+
+def sprite_layout(file_hashes, tile_size, columns):
+    # (columns, stored size the tiles are scaled from) after validating the request
+    if not file_hashes:
+        raise ValueError("A sprite needs at least one thumbnail")
+    if len(file_hashes) > MAX_SPRITE_TILES:
+        raise ValueError(f"A sprite holds at most {MAX_SPRITE_TILES} thumbnails")
+    if not 0 < tile_size <= max(THUMBNAIL_SIZES):
+        raise ValueError(f"Tile size must be between 1 and {max(THUMBNAIL_SIZES)}")
+    # The smallest stored size that covers a tile
+    source_size = min(size for size in THUMBNAIL_SIZES if size >= tile_size)
+    return max(1, min(columns, len(file_hashes))), source_size
+
+def sprite_etag(file_hashes, tile_size=DEFAULT_SPRITE_TILE_SIZE, columns=DEFAULT_SPRITE_COLUMNS):
+    # Changes with the tiles, their layout and which of them have a thumbnail
+    # yet; costs a stat per tile rather than a decode
+    columns, source_size = sprite_layout(file_hashes, tile_size, columns)
+    missing = [index for index, file_hash in enumerate(file_hashes) if find_thumbnail(file_hash, source_size) is None]
+    key = f"{','.join(file_hashes)}|{tile_size}|{columns}|{missing}|{THUMBNAIL_FORMAT}|{THUMBNAIL_QUALITY}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def build_sprite(file_hashes, tile_size=DEFAULT_SPRITE_TILE_SIZE, columns=DEFAULT_SPRITE_COLUMNS,
+                 generator=thumbnail_generator):
+    # Lays the thumbnails out in row-major tile_size squares, columns to a
+    # row, each centered in its tile. Returns the encoded image, the number of
+    # columns and the indexes of tiles left blank for want of a thumbnail.
+    columns, source_size = sprite_layout(file_hashes, tile_size, columns)
+    rows = -(-len(file_hashes) // columns)
+
+    # Missing thumbnails render in parallel before the sheet is assembled
+    pending = [generator.ensure(file_hash) for file_hash in set(file_hashes)
+               if find_thumbnail(file_hash, source_size) is None]
+    concurrent.futures.wait(pending)
+
+    sheet = Image.new('RGB', (columns * tile_size, rows * tile_size), SPRITE_BACKGROUND)
+    missing = []
+    for index, file_hash in enumerate(file_hashes):
+        path = find_thumbnail(file_hash, source_size)
+        if path is None:
+            missing.append(index)
+            continue
+        with Image.open(path) as img:
+            img.draft('RGB', (tile_size, tile_size))
+            tile = flatten(img)
+            tile.thumbnail((tile_size, tile_size))
+            x = (index % columns) * tile_size + (tile_size - tile.width) // 2
+            y = (index // columns) * tile_size + (tile_size - tile.height) // 2
+            sheet.paste(tile, (x, y))
+    buffer = io.BytesIO()
+    sheet.save(buffer, THUMBNAIL_FORMAT.upper(), quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue(), columns, missing
+
+
+def remove_thumbnails(conn, rows):
+    # Deletes the thumbnails of removed files rows (hash, thumbnail_path) that
+    # no remaining row still uses. Content-named thumbnails are shared by every
+    # copy of an image, so they go only with the last row of their hash.
+    removed = 0
+    for file_hash in {row['hash'] for row in rows if row['hash']}:
+        if conn.execute('SELECT 1 FROM files WHERE hash = ? LIMIT 1', (file_hash,)).fetchone():
+            continue
+        for size in THUMBNAIL_SIZES:
+            for fmt in FORMAT_EXTENSIONS:
+                path = thumbnail_path(file_hash, size, fmt)
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+    for path in {row['thumbnail_path'] for row in rows if row['thumbnail_path']}:
+        if os.path.exists(path) and not conn.execute('SELECT 1 FROM files WHERE thumbnail_path = ? LIMIT 1',
+                                                     (path,)).fetchone():
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def collect_garbage(conn, dry_run=False, min_age=GC_MIN_AGE):
+    # Removes thumbnails whose content hash and path no longer appear in files.
+    # Older randomly named thumbnails are kept only while a row references them.
+    referenced_hashes = set()
+    referenced_paths = set()
+    for row in conn.execute('SELECT hash, thumbnail_path FROM files WHERE thumbnail_path IS NOT NULL'):
+        referenced_hashes.add(row['hash'])
+        referenced_paths.add(os.path.normpath(row['thumbnail_path']))
+
+    stats = {'scanned': 0, 'removed': 0, 'bytes_freed': 0}
+    cutoff = time.time() - min_age
+    for root, _, files in os.walk(THUMBNAIL_DIR):
+        for file in files:
+            path = os.path.join(root, file)
+            stats['scanned'] += 1
+            if os.path.normpath(path) in referenced_paths:
+                continue
+            # Only thumbnails are kept by their hash; a temp file a crashed
+            # writer left starts with the same hash but is never used
+            if is_content_thumbnail(os.path.relpath(path, THUMBNAIL_DIR)) and file.split('_')[0] in referenced_hashes:
+                continue
+            try:
+                file_stat = os.stat(path)
+                if file_stat.st_mtime > cutoff:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+            except OSError as e:
+                logger.error(f"Could not remove thumbnail {path}: {e}")
+                continue
+            stats['removed'] += 1
+            stats['bytes_freed'] += file_stat.st_size
+    logger.info(f"Thumbnail garbage collection{' (dry run)' if dry_run else ''}: {stats}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Thumbnail maintenance")
+    commands = parser.add_subparsers(dest='command', required=True)
+    gc = commands.add_parser('gc', help="Delete thumbnails no longer referenced by the files table")
+    gc.add_argument('--dry-run', action='store_true', help="Report what would be removed")
+    gc.add_argument('--min-age', type=int, default=GC_MIN_AGE, help="Skip thumbnails newer than this many seconds")
+    args = parser.parse_args(argv)
+
+    conn = create_connection()
+    try:
+        stats = collect_garbage(conn, args.dry_run, args.min_age)
+    finally:
+        conn.close()
+    verb = "Would remove" if args.dry_run else "Removed"
+    print(f"{verb} {stats['removed']} of {stats['scanned']} thumbnails, {stats['bytes_freed']} bytes", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,643 @@
+import os
+import sys
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import stat
+import struct
+import logging
+import threading
+import concurrent.futures
+
+from db import DB_NAME, create_connection
+from indexer import (IMAGE_POOL_CONTEXT, IMAGE_WORKERS, IndexPipeline, index_paths, remove_indexed,
+                     remove_missing, rename_indexed)
+from thumbnails import THUMBNAIL_DIR
+from analysis_cache import ANALYSIS_CACHE_DIR
+from embeddings import EMBEDDING_DIR
+
+logger = logging.getLogger(__name__)
+
+# A root's changes are applied once it has been quiet for WATCH_DEBOUNCE
+# seconds, or WATCH_MAX_DELAY seconds after the first one under constant activity
+WATCH_DEBOUNCE = float(os.environ.get('WATCH_DEBOUNCE', 2.0))
+WATCH_MAX_DELAY = float(os.environ.get('WATCH_MAX_DELAY', 30.0))
+# auto uses inotify where the platform has it and polls elsewhere
+WATCH_BACKEND = os.environ.get('WATCH_BACKEND', 'auto').lower()
+WATCH_POLL_INTERVAL = float(os.environ.get('WATCH_POLL_INTERVAL', 10.0))
+# Seconds an IN_MOVED_FROM waits for its IN_MOVED_TO before counting as a delete
+MOVE_PAIR_TIMEOUT = 0.5
+# Seconds before retrying a root that could not be watched, e.g. an unmounted drive
+WATCH_RETRY_INTERVAL = 30.0
+# Seconds between rereads of watch_roots, which other server processes may change
+WATCH_REFRESH_INTERVAL = 5.0
+
+if WATCH_BACKEND not in ('auto', 'inotify', 'poll'):
+    raise ValueError(f"Unsupported WATCH_BACKEND {WATCH_BACKEND}; expected auto, inotify or poll")
+
+# The app writes these itself; indexing them would feed back into the watcher
+IGNORED_DIRS = tuple(os.path.abspath(path) for path in (THUMBNAIL_DIR, ANALYSIS_CACHE_DIR, EMBEDDING_DIR))
+# The database plus its -wal, -shm and -journal files
+IGNORED_PREFIX = os.path.abspath(DB_NAME)
+
+
+def is_ignored(path):
+    return path.startswith(IGNORED_PREFIX) or any(
+        path == directory or path.startswith(directory + os.sep) for directory in IGNORED_DIRS)
+
+def is_within(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+class ChangeSet:
+    # Debounced changes under one root. Moves keep their order and are applied
+    # first; every other path is then deleted or indexed as its last event says.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.moves = []
+        self.paths = {}
+        self.first_event = None
+        self.last_event = None
+
+    def __len__(self):
+        return len(self.moves) + len(self.paths)
+
+    def touch(self):
+        now = time.monotonic()
+        self.first_event = self.first_event or now
+        self.last_event = now
+
+    def index(self, path):
+        with self.lock:
+            self.paths[path] = 'index'
+            self.touch()
+
+    def delete(self, path):
+        with self.lock:
+            self.paths[path] = 'delete'
+            self.touch()
+
+    def move(self, old_path, new_path):
+        with self.lock:
+            self.moves.append((old_path, new_path))
+            # The move replaces anything pending at its destination, and
+            # anything pending at its source now happens at the destination
+            for path in [path for path in self.paths if is_within(path, new_path)]:
+                del self.paths[path]
+            for path in [path for path in self.paths if is_within(path, old_path)]:
+                self.paths[new_path + path[len(old_path):]] = self.paths.pop(path)
+            self.touch()
+
+    def ready(self, debounce, max_delay):
+        with self.lock:
+            if self.last_event is None:
+                return False
+            now = time.monotonic()
+            return now - self.last_event >= debounce or now - self.first_event >= max_delay
+
+    def drain(self):
+        # Returns (moves, paths to delete, paths to index) and starts over
+        with self.lock:
+            moves, paths = self.moves, self.paths
+            self.moves, self.paths = [], {}
+            self.first_event = self.last_event = None
+        return (moves, [path for path, kind in paths.items() if kind == 'delete'],
+                [path for path, kind in paths.items() if kind == 'index'])
+
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# Files are picked up when their writer closes them rather than on every
+# write, so a file still being copied is not indexed half-written
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR)
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_READ_SIZE = 64 * 1024
+
+_libc = None
+
+def inotify_available():
+    global _libc
+    if not sys.platform.startswith('linux'):
+        return False
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            _libc = libc
+        except (OSError, AttributeError):
+            return False
+    return True
+
+
+class InotifyWatcher:
+    # One inotify instance per root with a watch on every directory under it
+    name = 'inotify'
+
+    def __init__(self, root, changes, on_overflow, on_lost):
+        self.root = root
+        self.changes = changes
+        self.on_overflow = on_overflow
+        self.on_lost = on_lost
+        self.stop_event = threading.Event()
+        self.dirs = {}
+        self.watches = {}
+        # IN_MOVED_FROM events waiting for the IN_MOVED_TO with the same cookie
+        self.pending_moves = {}
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self.add_tree(root)
+            if root not in self.watches:
+                raise OSError(errno.ENOENT, "Cannot watch root", root)
+            self.root_wd = self.watches[root]
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.thread = threading.Thread(target=self.run, name=f'watch-{root}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def add_watch(self, path):
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "inotify watch limit reached; raise fs.inotify.max_user_watches "
+                                     "or set WATCH_BACKEND=poll", path)
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # Removed again already, or unreadable
+                return
+            raise OSError(error, os.strerror(error), path)
+        self.dirs[wd] = path
+        self.watches[path] = wd
+
+    def add_tree(self, path, index=False):
+        # Watches path and every directory below it. With index, files already
+        # inside are queued too: they may have been written before the watch existed.
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [name for name in dirs if not is_ignored(os.path.join(root, name))]
+            self.add_watch(root)
+            if index:
+                for file in files:
+                    self.changes.index(os.path.join(root, file))
+
+    def forget_tree(self, path):
+        for directory in [directory for directory in self.watches if is_within(directory, path)]:
+            wd = self.watches.pop(directory)
+            self.dirs.pop(wd, None)
+            _libc.inotify_rm_watch(self.fd, wd)
+
+    def rename_tree(self, old_path, new_path):
+        # Watches follow a moved directory; only their paths change
+        for directory in [directory for directory in self.watches if is_within(directory, old_path)]:
+            wd = self.watches.pop(directory)
+            moved = new_path + directory[len(old_path):]
+            self.watches[moved] = wd
+            self.dirs[wd] = moved
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select([self.fd], [], [], MOVE_PAIR_TIMEOUT)
+                if readable:
+                    try:
+                        self.handle(os.read(self.fd, EVENT_READ_SIZE))
+                    except BlockingIOError:
+                        pass
+                self.expire_moves()
+        except Exception as exc:
+            logger.error(f"Watcher for {self.root} stopped: {exc}")
+        finally:
+            os.close(self.fd)
+
+    def handle(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            self.dispatch(wd, mask, cookie, name)
+
+    def dispatch(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning(f"inotify queue overflowed for {self.root}; rescanning")
+            self.on_overflow()
+            return
+        if wd == self.root_wd and mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT):
+            # Subdirectories are covered by their parent's events, but nothing
+            # reports on the root itself. Its rows stay until it is back.
+            logger.warning(f"Watched root {self.root} was moved, deleted or unmounted")
+            self.stop()
+            self.on_lost()
+            return
+        if mask & IN_IGNORED:
+            path = self.dirs.pop(wd, None)
+            if path is not None and self.watches.get(path) == wd:
+                del self.watches[path]
+            return
+        directory = self.dirs.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if is_ignored(path):
+            return
+        is_dir = bool(mask & IN_ISDIR)
+
+        if mask & IN_MOVED_FROM:
+            self.pending_moves[cookie] = (path, is_dir, time.monotonic())
+        elif mask & IN_MOVED_TO:
+            source = self.pending_moves.pop(cookie, None)
+            if source:
+                if is_dir:
+                    self.rename_tree(source[0], path)
+                self.changes.move(source[0], path)
+            elif is_dir:
+                # Moved in from outside the root
+                self.add_tree(path, index=True)
+            else:
+                self.changes.index(path)
+        elif mask & IN_CREATE:
+            if is_dir:
+                self.add_tree(path, index=True)
+            elif self.has_contents(path):
+                # A hard link arrives with its contents and is never closed after
+                # writing. A file created empty to be written gets IN_CLOSE_WRITE.
+                self.changes.index(path)
+        elif mask & IN_CLOSE_WRITE:
+            self.changes.index(path)
+        elif mask & IN_DELETE:
+            self.changes.delete(path)
+
+    def has_contents(self, path):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.S_ISREG(file_stat.st_mode) and file_stat.st_size > 0
+
+    def expire_moves(self):
+        # A move with no matching IN_MOVED_TO left the root
+        now = time.monotonic()
+        for cookie, (path, is_dir, moved_at) in list(self.pending_moves.items()):
+            if now - moved_at >= MOVE_PAIR_TIMEOUT:
+                del self.pending_moves[cookie]
+                if is_dir:
+                    self.forget_tree(path)
+                self.changes.delete(path)
+
+
+class PollingWatcher:
+    # Fallback for platforms without inotify, or roots past the watch limit:
+    # rescans the tree every interval and diffs (size, mtime_ns, inode) per file
+    name = 'poll'
+
+    def __init__(self, root, changes, on_overflow, on_lost, interval=WATCH_POLL_INTERVAL):
+        self.root = root
+        self.changes = changes
+        self.on_lost = on_lost
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.snapshot = self.scan()
+        self.thread = threading.Thread(target=self.run, name=f'watch-{root}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def scan(self):
+        snapshot = {}
+        directories = [self.root]
+        while directories:
+            try:
+                with os.scandir(directories.pop()) as entries:
+                    for entry in entries:
+                        if is_ignored(entry.path):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                directories.append(entry.path)
+                            elif entry.is_file():
+                                file_stat = entry.stat()
+                                snapshot[entry.path] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return snapshot
+
+    def poll(self):
+        if not os.path.isdir(self.root):
+            # An empty scan would read as every file deleted
+            logger.warning(f"Watched root {self.root} is gone")
+            self.stop()
+            self.on_lost()
+            return
+        snapshot = self.scan()
+        removed = {path: info for path, info in self.snapshot.items() if path not in snapshot}
+        # A vanished file whose size, mtime and inode turn up at a new path was moved
+        removed_by_info = {info: path for path, info in removed.items()}
+        for path, info in snapshot.items():
+            previous = self.snapshot.get(path)
+            if previous is None:
+                source = removed_by_info.pop(info, None)
+                if source:
+                    del removed[source]
+                    self.changes.move(source, path)
+                else:
+                    self.changes.index(path)
+            elif previous != info:
+                self.changes.index(path)
+        for path in removed:
+            self.changes.delete(path)
+        self.snapshot = snapshot
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as exc:
+                logger.error(f"Polling {self.root} failed: {exc}")
+
+
+class WatchedRoot:
+    def __init__(self, path):
+        self.path = path
+        self.changes = ChangeSet()
+        self.watcher = None
+        self.status = 'starting'
+        # A full incremental pass catches up on changes made while unwatched
+        self.needs_sync = True
+        # Set by a watcher whose root was moved, deleted or unmounted
+        self.lost = False
+        self.cancel_event = threading.Event()
+        self.stats = {'indexed': 0, 'moved': 0, 'removed': 0, 'errors': 0}
+        self.last_sync = None
+        self.last_change = None
+        self.retry_at = 0
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'backend': getattr(self.watcher, 'name', None),
+            'status': self.status,
+            'pending': len(self.changes),
+            'stats': self.stats,
+            'last_sync': self.last_sync,
+            'last_change': self.last_change,
+            'error': self.error,
+        }
+
+
+class WatchManager:
+    # Keeps registered library roots indexed: one watcher per root feeds a
+    # debounced ChangeSet, and a single thread applies the changes. Only the
+    # started manager watches; with several server processes the others just
+    # edit watch_roots, which the started one rereads. Every batch of changes
+    # shares one image process pool, started with the first batch that needs it.
+    def __init__(self, debounce=WATCH_DEBOUNCE, max_delay=WATCH_MAX_DELAY):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.roots = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.active = False
+        self.refreshed_at = 0
+        self.image_pool = None
+
+    def start(self):
+        self.active = True
+        self.refresh()
+        self.ensure_thread()
+
+    def load_paths(self):
+        conn = create_connection()
+        try:
+            return [row['path'] for row in conn.execute('SELECT path FROM watch_roots ORDER BY created_at')]
+        finally:
+            conn.close()
+
+    def refresh(self):
+        # Under the lock, as add and remove change the table under it too
+        with self.lock:
+            paths = self.load_paths()
+            removed = [self.roots.pop(path) for path in list(self.roots) if path not in paths]
+            for path in paths:
+                self.roots.setdefault(path, WatchedRoot(path))
+        self.refreshed_at = time.monotonic()
+        for root in removed:
+            self.stop_root(root)
+
+    def stop_root(self, root):
+        root.cancel_event.set()
+        if root.watcher:
+            root.watcher.stop()
+        logger.info(f"Stopped watching {root.path}")
+
+    def ensure_thread(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='watch-manager', daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        if is_ignored(path):
+            raise ValueError(f"{path} holds the app's own data and cannot be watched")
+        with self.lock:
+            if path in self.roots:
+                return self.roots[path]
+            existing_paths = self.roots if self.active else self.load_paths()
+            for existing in existing_paths:
+                if existing == path:
+                    return self.remote_root(path)
+                if is_within(path, existing) or is_within(existing, path):
+                    raise ValueError(f"{path} overlaps watched root {existing}")
+            conn = create_connection()
+            try:
+                with conn:
+                    conn.execute('INSERT OR IGNORE INTO watch_roots (path, created_at) VALUES (?, ?)',
+                                 (path, time.time()))
+            finally:
+                conn.close()
+            if not self.active:
+                return self.remote_root(path)
+            root = self.roots[path] = WatchedRoot(path)
+        logger.info(f"Watching {path}")
+        self.ensure_thread()
+        return root
+
+    def remove(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            root = self.roots.pop(path, None)
+            conn = create_connection()
+            try:
+                with conn:
+                    deleted = conn.execute('DELETE FROM watch_roots WHERE path = ?', (path,)).rowcount
+            finally:
+                conn.close()
+        if root:
+            self.stop_root(root)
+        return bool(root or deleted)
+
+    def remote_root(self, path):
+        # A root watched by another server process, whose state is not known here
+        root = WatchedRoot(path)
+        root.status = 'remote'
+        return root
+
+    def status(self):
+        if not self.active:
+            return [self.remote_root(path).to_dict() for path in self.load_paths()]
+        with self.lock:
+            return [root.to_dict() for root in self.roots.values()]
+
+    def request_sync(self, root):
+        root.needs_sync = True
+        self.wake.set()
+
+    def root_lost(self, root):
+        root.lost = True
+        self.wake.set()
+
+    def get_image_pool(self):
+        # Only the manager thread calls this. A worker that dies breaks the
+        # whole pool, which is then replaced.
+        if self.image_pool is None or self.image_pool._broken:
+            if self.image_pool is not None:
+                self.image_pool.shutdown(wait=False)
+            self.image_pool = concurrent.futures.ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                                                     mp_context=IMAGE_POOL_CONTEXT)
+        return self.image_pool
+
+    def run(self):
+        while True:
+            self.wake.wait(min(self.debounce, MOVE_PAIR_TIMEOUT))
+            self.wake.clear()
+            if time.monotonic() - self.refreshed_at >= WATCH_REFRESH_INTERVAL:
+                try:
+                    self.refresh()
+                except Exception as exc:
+                    logger.error(f"Reading watch roots failed: {exc}")
+            with self.lock:
+                roots = list(self.roots.values())
+            for root in roots:
+                if root.cancel_event.is_set():
+                    continue
+                if root.lost:
+                    # Retried like a root that was never there; the sync once it is
+                    # back catches up on whatever happened to it meanwhile
+                    root.lost = False
+                    root.watcher = None
+                    root.needs_sync = True
+                    root.status = 'unavailable'
+                    root.retry_at = time.monotonic() + WATCH_RETRY_INTERVAL
+                try:
+                    if root.watcher is None and not self.start_watching(root):
+                        continue
+                    if root.needs_sync:
+                        self.sync(root)
+                    if root.changes.ready(self.debounce, self.max_delay):
+                        self.apply(root)
+                    root.status = 'watching'
+                    root.error = None
+                except Exception as exc:
+                    logger.error(f"Watching {root.path} failed: {exc}")
+                    root.status = 'error'
+                    root.error = str(exc)
+                    root.retry_at = time.monotonic() + WATCH_RETRY_INTERVAL
+                    root.stats['errors'] += 1
+
+    def start_watching(self, root):
+        if time.monotonic() < root.retry_at:
+            return False
+        if not os.path.isdir(root.path):
+            # Leave its rows alone; the directory may only be unmounted
+            root.status = 'unavailable'
+            root.retry_at = time.monotonic() + WATCH_RETRY_INTERVAL
+            return False
+        on_overflow = lambda: self.request_sync(root)
+        on_lost = lambda: self.root_lost(root)
+        watcher = None
+        if WATCH_BACKEND == 'inotify' and not inotify_available():
+            raise OSError("inotify is not available on this platform")
+        if WATCH_BACKEND != 'poll' and inotify_available():
+            try:
+                watcher = InotifyWatcher(root.path, root.changes, on_overflow, on_lost)
+            except OSError as exc:
+                if WATCH_BACKEND == 'inotify':
+                    raise
+                logger.warning(f"Polling {root.path} instead of using inotify: {exc}")
+        if watcher is None:
+            watcher = PollingWatcher(root.path, root.changes, on_overflow, on_lost)
+        watcher.start()
+        root.watcher = watcher
+        logger.info(f"Watching {root.path} with {watcher.name}")
+        return True
+
+    def sync(self, root):
+        # Incremental pass over the whole root, then drop rows of files that
+        # are gone. Moves are claimed by the pass before the pruning runs.
+        root.status = 'syncing'
+        root.needs_sync = False
+        stats = IndexPipeline(root.path, cancel_event=root.cancel_event, image_pool=self.get_image_pool()).run()
+        conn = create_connection()
+        try:
+            removed = remove_missing(conn, root.path)
+        finally:
+            conn.close()
+        root.stats['indexed'] += stats['new'] + stats['rehashed']
+        root.stats['moved'] += stats['moved']
+        root.stats['removed'] += removed
+        root.last_sync = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def apply(self, root):
+        moves, deletes, paths = root.changes.drain()
+        conn = create_connection()
+        try:
+            moved = 0
+            for old_path, new_path in moves:
+                count = rename_indexed(conn, old_path, new_path)
+                if not count and os.path.isfile(new_path):
+                    # The source was never indexed, e.g. a temp file renamed over
+                    # the original by an editor: the file at new_path is new content
+                    paths.append(new_path)
+                moved += count
+            removed = remove_indexed(conn, deletes) if deletes else 0
+        finally:
+            conn.close()
+        stats = index_paths(root.path, paths, cancel_event=root.cancel_event,
+                            image_pool=self.get_image_pool()) if paths else {}
+        indexed = stats.get('new', 0) + stats.get('rehashed', 0)
+        root.stats['indexed'] += indexed
+        root.stats['moved'] += moved + stats.get('moved', 0)
+        root.stats['removed'] += removed
+        root.last_change = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        logger.info(f"Applied changes under {root.path}: {moved} moved, {removed} removed, {indexed} indexed")
@@ -177,10 +177,15 @@ function App() {
           </div>
         </TabsContent>
         <TabsContent value="indexed">
-          <div>Files: {files.data?.length}</div>
+          <div>Files: {files.data?.length}{files.hasNextPage ? "+" : ""}</div>
           <div className="overflow-y-auto">
             <ControlledTable table={tableController} />
           </div>
+          {files.hasNextPage && (
+            <Button onClick={() => files.fetchNextPage()} disabled={files.isFetchingNextPage}>
+              {files.isFetchingNextPage ? "Loading..." : "Load more files"}
+            </Button>
+          )}
         </TabsContent>
         <TabsContent value="duplicates">
           <div>
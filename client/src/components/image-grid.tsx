@@ -1,7 +1,7 @@
 import { useState, useMemo, useEffect } from "react";
 
 import { useFiles } from "../utils/hooks/api/use-files";
-import type { ImageAnalysis, IndexedFileMetadata } from "../types/types";
+import type { FileLabels, ImageAnalysis, IndexedFileMetadata } from "../types/types";
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "./ui/select";
 import { Checkbox } from "./ui/checkbox";
 import { Input } from "./ui/input";
@@ -22,10 +22,12 @@ type Filters = {
 };
 
 const isDev = process.env.NODE_ENV === "development";
+// Addressed by content hash, so the browser caches each thumbnail for good
+const thumbnailUrl = (hash: string) => `${isDev ? "http://localhost:8080" : ""}/api/v1/thumbnails/${hash}`;
 
 
 export const ImageGrid = () => {
-    const { data: files, isLoading, error } = useFiles();
+    const { data: files, isLoading, error, hasNextPage, fetchNextPage, isFetchingNextPage } = useFiles();
     const [sortBy, setSortBy] = useState<SortOption>("name");
     const [selectedFormats, setSelectedFormats] = useState<string[]>([]);
     const [searchTerm, setSearchTerm] = useState("");
@@ -72,13 +74,13 @@ export const ImageGrid = () => {
                 if (file.analysis) {
                     newFilters.moods.push(...file?.analysis?.mood || []);
                     newFilters.colors.push(...file?.analysis?.colors || []);
-                    newFilters.categories.push(...file?.analysis?.categories || []);
                     newFilters.qualities.push(file.analysis.quality);
                     // newFilters.compositions.push(file.analysis.composition);
                     newFilters.subjects.push(...file?.analysis?.subjects || []);
-                    newFilters.tags.push(...file?.analysis?.tags || []);
                     // newFilters.uniqueFeatures.push(...file?.analysis?.uniqueFeatures || []);
                 }
+                newFilters.categories.push(...file.labels?.categories || []);
+                newFilters.tags.push(...file.labels?.tags || []);
             }
 
             // Remove duplicates and sort
@@ -144,6 +146,9 @@ export const ImageGrid = () => {
         for (const [key, values] of Object.entries(selectedFilters)) {
             if (values.length > 0) {
                 filteredFiles = filteredFiles.filter(file => {
+                    if (key in file.labels) {
+                        return values.some(value => file.labels[key as keyof FileLabels].includes(value));
+                    }
                     if (!file.analysis) return false;
                     return values.some(value =>
                         Array.isArray(file?.analysis?.[key as keyof ImageAnalysis])
@@ -249,8 +254,10 @@ export const ImageGrid = () => {
                             <DialogTrigger asChild>
                                 <div className="relative aspect-square cursor-pointer">
                                     <img
-                                        src={isDev ? `http://localhost:8080/${file.thumbnail_path}` : file.thumbnail_path}
+                                        src={thumbnailUrl(file.hash)}
                                         alt={file.file_name}
+                                        loading="lazy"
+                                        decoding="async"
                                         className="object-cover w-full h-full rounded-lg"
                                     />
                                     <div className="absolute bottom-0 left-0 right-0 bg-black bg-opacity-50 text-white p-2 text-sm truncate">
@@ -274,7 +281,7 @@ export const ImageGrid = () => {
                                 </DialogHeader>
                                 <div className="grid grid-cols-2 gap-4">
                                     <img
-                                        src={isDev ? `http://localhost:8080/${file.thumbnail_path}` : file.thumbnail_path}
+                                        src={thumbnailUrl(file.hash)}
                                         alt={file.file_name}
                                         className="w-full h-auto rounded-lg"
                                     />
@@ -291,6 +298,13 @@ export const ImageGrid = () => {
                     )
                 })}
             </div>
+            {hasNextPage && (
+                <div className="mt-4 flex justify-center">
+                    <Button onClick={() => fetchNextPage()} disabled={isFetchingNextPage}>
+                        {isFetchingNextPage ? "Loading..." : "Load more images"}
+                    </Button>
+                </div>
+            )}
         </div>
     );
 };
\ No newline at end of file
@@ -1,6 +1,8 @@
 export type Directory = {
 	name: string;
 	path: string;
+	imageCount?: number | null;
+	imageCountTruncated?: boolean;
 };
 
 export type Drive = {
@@ -15,6 +17,7 @@ export type FileInfo = {
 	size: number;
 	lastModified: string;
 	isDirectory: boolean;
+	isImage?: boolean;
 };
 
 export type DirectoryContents = {
@@ -22,6 +25,11 @@ export type DirectoryContents = {
 	parentPath: string | null;
 	directories: Directory[];
 	files: FileInfo[];
+	totalDirectories?: number;
+	totalFiles?: number;
+	imageCount?: number;
+	offset?: number;
+	nextOffset?: number | null;
 };
 
 export type ImageAnalysis = {
@@ -47,5 +55,42 @@ export type IndexedFileMetadata = {
 	date_modified: string;
 	hash: string;
 	thumbnail_path: string;
+	width: number | null;
+	height: number | null;
+	date_taken: string | null;
+	camera_make: string | null;
+	camera_model: string | null;
+	gps_latitude: number | null;
+	gps_longitude: number | null;
 	analysis: ImageAnalysis | null;
+	// Tags and categories, whether added by hand or by an analysis
+	labels: FileLabels;
+};
+
+export type FileLabels = {
+	tags: string[];
+	categories: string[];
+};
+
+export type FilesPage = {
+	items: IndexedFileMetadata[];
+	next_cursor: string | null;
+};
+
+export type JobStatus = "queued" | "running" | "completed" | "failed" | "cancelled";
+
+export type Job = {
+	id: string;
+	kind: string;
+	status: JobStatus;
+	options: Record<string, unknown>;
+	progress: Record<string, number | null>;
+	elapsed_seconds: number;
+	files_per_sec: number;
+	bytes_per_sec: number;
+	eta_seconds: number | null;
+	errors: string[];
+	created_at: string;
+	started_at: string | null;
+	finished_at: string | null;
 };
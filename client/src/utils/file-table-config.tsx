@@ -48,7 +48,7 @@ export const fileTableColumns: ColumnDef<IndexedFileMetadata>[] = [
         accessorKey: 'thumbnail_path',
         cell: (info) => {
             const value = info.row.original
-            return <img src={value.thumbnail_path} alt="thumbnail" />
+            return <img src={`/api/v1/thumbnails/${value.hash}`} alt="thumbnail" loading="lazy" />
         },
 
     },
@@ -1,25 +1,38 @@
-import { useQuery } from "@tanstack/react-query"
-import type { IndexedFileMetadata } from "../../../types/types"
+import { useInfiniteQuery } from "@tanstack/react-query"
+import { useMemo } from "react"
+import type { FilesPage } from "../../../types/types"
 import { useInvalidator } from "./use-invalidator"
 import { fetchServer } from "../fetch-server"
 
-export const getFiles = async () => {
-    const fetcher = fetchServer("/files", {
+// Files per request; later pages are fetched on demand with the cursor
+export const FILES_PAGE_SIZE = 500
+
+export const getFiles = async (cursor: string | null) => {
+    const params = new URLSearchParams({ limit: String(FILES_PAGE_SIZE) })
+    if (cursor) {
+        params.set("cursor", cursor)
+    }
+    const fetcher = fetchServer(`/files?${params}`, {
         headers: {
             "Content-Type": "application/json",
         }
     })
-    return fetcher.then(response => response.json()) as Promise<IndexedFileMetadata[]>
+    return fetcher.then(response => response.json()) as Promise<FilesPage>
 }
 
 
 export const useFiles = () => {
-    return useQuery({
+    const query = useInfiniteQuery({
         queryKey: ["images"],
-        queryFn: getFiles,
+        queryFn: ({ pageParam }) => getFiles(pageParam),
+        initialPageParam: null as string | null,
+        getNextPageParam: (lastPage) => lastPage.next_cursor,
     })
+    // The pages loaded so far, as one list
+    const data = useMemo(() => query.data?.pages.flatMap(page => page.items), [query.data])
+    return { ...query, data }
 }
 
 export const useInvalidateFiles = () => {
     return useInvalidator(["images"])
-}
\ No newline at end of file
+}
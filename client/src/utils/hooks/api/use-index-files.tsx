@@ -1,7 +1,33 @@
 import { useMutation } from "@tanstack/react-query"
+import type { Job } from "../../../types/types"
 import { useInvalidateFiles } from "./use-files"
 import { fetchServer } from "../fetch-server"
 
+const JOB_POLL_INTERVAL_MS = 1000
+
+export const getJob = async (jobId: string) => {
+  const response = await fetchServer(`/jobs/${jobId}`, {
+    headers: {
+      "Content-Type": "application/json",
+    }
+  })
+  if (!response.ok) {
+    throw new Error("Failed to fetch job")
+  }
+  return response.json() as Promise<Job>
+}
+
+// Indexing runs as a background job; resolve once it reaches a final status
+const waitForJob = async (jobId: string) => {
+  while (true) {
+    const job = await getJob(jobId)
+    if (job.status !== "queued" && job.status !== "running") {
+      return job
+    }
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS))
+  }
+}
+
 const startIndexFiles = async (path: string) => {
   const body = JSON.stringify(
     {
@@ -15,8 +41,12 @@ const startIndexFiles = async (path: string) => {
       "Content-Type": "application/json",
     }
   })
+  if (!result.ok) {
+    throw new Error("Failed to start indexing")
+  }
 
-  return result.json()
+  const { job_id } = await result.json() as { job_id: string }
+  return waitForJob(job_id)
 }
 
 
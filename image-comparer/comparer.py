@@ -1,26 +1,207 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import numpy as np
 import imagehash
 from PIL import Image
 
+HASH_FUNCTIONS = {
+    'ahash': imagehash.average_hash,
+    'dhash': imagehash.dhash,
+    'phash': imagehash.phash,
+}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+# Corpus rows scanned per step of a query, and rows per side of a corpus-vs-corpus
+# block; both bound peak memory independently of corpus size
+QUERY_CHUNK_ROWS = 1 << 20
+PAIR_BLOCK_ROWS = 2048
+
+_BYTE_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
 def compare_images(image1_path, image2_path):
     img1 = Image.open(image1_path)
     img2 = Image.open(image2_path)
-    
+
     # Generate perceptual hashes
     hash1 = imagehash.average_hash(img1)
     hash2 = imagehash.average_hash(img2)
 
     print(f"Image hashes: {hash1} and {hash2}")
-    
+
     # Calculate the difference between hashes
     difference = hash1 - hash2
-    
+
     # A lower difference indicates more similarity
     print(f"Image difference: {difference}")
     return difference
 
-# Example usage
-difference = compare_images('diff-test-1.jpg', 'diff-test-2.jpg')
-if difference < 10:
-    print("Images are likely similar")
-else:
-    print("Images are likely different")
\ No newline at end of file
+
+def popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy < 2.0: count bits a byte at a time
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def check_hash_size(hash_size):
+    # Hashes are compared as whole uint64 words, so a hash must have a
+    # multiple of 64 bits: hash_size 8 (64 bits), 16 (256 bits), 24, ...
+    if hash_size <= 0 or hash_size * hash_size % 64:
+        raise ValueError(f"Unsupported hash size {hash_size}; expected a multiple of 8")
+    return hash_size
+
+def pack_hash(image_hash):
+    # 64-bit hashes become one uint64 word, 256-bit hashes four. Bits are packed
+    # big-endian so a 64-bit word equals int(str(image_hash), 16), the value the
+    # backend stores.
+    check_hash_size(image_hash.hash.shape[0])
+    bits = np.packbits(image_hash.hash.flatten())
+    return bits.view('>u8').astype(np.uint64)
+
+def hash_image(path, algorithm='phash', hash_size=8):
+    check_hash_size(hash_size)
+    with Image.open(path) as img:
+        return pack_hash(HASH_FUNCTIONS[algorithm](img.convert('L'), hash_size=hash_size))
+
+def hash_directory(directory, algorithm='phash', hash_size=8):
+    check_hash_size(hash_size)
+    paths = []
+    hashes = []
+    for root, _, files in os.walk(directory):
+        for file in sorted(files):
+            if not file.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, file)
+            try:
+                hashes.append(hash_image(path, algorithm, hash_size))
+                paths.append(path)
+            except Exception as e:
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+    words = (hash_size * hash_size + 63) // 64
+    packed = np.vstack(hashes) if hashes else np.empty((0, words), dtype=np.uint64)
+    return paths, packed
+
+def load_hashes_from_db(db_path, algorithm='phash'):
+    # The backend stores 64-bit hashes as signed integers; reinterpret the bits
+    if algorithm not in HASH_FUNCTIONS:
+        raise ValueError(f"Unknown hash algorithm {algorithm}")
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(f'SELECT file_path, {algorithm} FROM files WHERE {algorithm} IS NOT NULL').fetchall()
+    finally:
+        conn.close()
+    paths = [row[0] for row in rows]
+    packed = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64).reshape(-1, 1)
+    return paths, packed
+
+
+def hamming_to_corpus(query, corpus):
+    # query: (words,) packed hash; corpus: (n, words). Returns (n,) distances.
+    query = np.asarray(query, dtype=np.uint64).reshape(1, -1)
+    distances = np.empty(len(corpus), dtype=np.uint16)
+    for start in range(0, len(corpus), QUERY_CHUNK_ROWS):
+        chunk = corpus[start:start + QUERY_CHUNK_ROWS]
+        distances[start:start + len(chunk)] = popcount(chunk ^ query).sum(axis=1, dtype=np.uint16)
+    return distances
+
+def nearest(query, corpus, threshold=None, limit=None):
+    # Indices and distances of corpus rows closest to query, nearest first
+    if limit is not None and limit <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.uint16)
+    distances = hamming_to_corpus(query, corpus)
+    if threshold is not None:
+        candidates = np.flatnonzero(distances <= threshold)
+    else:
+        candidates = np.arange(len(distances))
+    if limit is not None and len(candidates) > limit:
+        candidates = candidates[np.argpartition(distances[candidates], limit - 1)[:limit]]
+    candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+    return candidates, distances[candidates]
+
+def pairs_within(corpus_a, corpus_b, threshold):
+    # All (i, j, distance) with hamming(corpus_a[i], corpus_b[j]) <= threshold,
+    # computed block by block
+    for a_start in range(0, len(corpus_a), PAIR_BLOCK_ROWS):
+        block_a = corpus_a[a_start:a_start + PAIR_BLOCK_ROWS]
+        for b_start in range(0, len(corpus_b), PAIR_BLOCK_ROWS):
+            block_b = corpus_b[b_start:b_start + PAIR_BLOCK_ROWS]
+            distances = popcount(block_a[:, None, :] ^ block_b[None, :, :]).sum(axis=2, dtype=np.uint16)
+            rows, columns = np.nonzero(distances <= threshold)
+            for row, column in zip(rows.tolist(), columns.tolist()):
+                yield a_start + row, b_start + column, int(distances[row, column])
+
+def self_pairs_within(corpus, threshold):
+    # Like pairs_within(corpus, corpus) but each unordered pair once
+    for i, j, distance in pairs_within(corpus, corpus, threshold):
+        if i < j:
+            yield i, j, distance
+
+
+def hash_size_argument(value):
+    try:
+        return check_hash_size(int(value))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perceptual hash comparison for images")
+    parser.add_argument('--algorithm', choices=sorted(HASH_FUNCTIONS), default='phash')
+    parser.add_argument('--hash-size', type=hash_size_argument, default=8,
+                        help="8 for 64-bit hashes, 16 for 256-bit; a multiple of 8")
+    parser.add_argument('--threshold', type=int, default=10)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    pair = commands.add_parser('pair', help="Compare two images")
+    pair.add_argument('image1')
+    pair.add_argument('image2')
+
+    dirs = commands.add_parser('dirs', help="Find similar images between two directories")
+    dirs.add_argument('directory_a')
+    dirs.add_argument('directory_b', nargs='?', help="Defaults to comparing directory_a with itself")
+
+    query = commands.add_parser('query', help="Find images similar to one image")
+    query.add_argument('image')
+    source = query.add_mutually_exclusive_group(required=True)
+    source.add_argument('--directory')
+    source.add_argument('--db', help="imagedb.db written by the backend indexer (64-bit hashes only)")
+    query.add_argument('--limit', type=int, default=20)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'pair':
+        difference = compare_images(args.image1, args.image2)
+        print("Images are likely similar" if difference < args.threshold else "Images are likely different")
+        return
+
+    if args.command == 'dirs':
+        paths_a, hashes_a = hash_directory(args.directory_a, args.algorithm, args.hash_size)
+        if args.directory_b:
+            paths_b, hashes_b = hash_directory(args.directory_b, args.algorithm, args.hash_size)
+            matches = pairs_within(hashes_a, hashes_b, args.threshold)
+        else:
+            paths_b = paths_a
+            matches = self_pairs_within(hashes_a, args.threshold)
+        for i, j, distance in matches:
+            print(f"{distance}\t{paths_a[i]}\t{paths_b[j]}")
+        return
+
+    if args.db:
+        paths, corpus = load_hashes_from_db(args.db, args.algorithm)
+        hash_size = 8
+    else:
+        paths, corpus = hash_directory(args.directory, args.algorithm, args.hash_size)
+        hash_size = args.hash_size
+    target = hash_image(args.image, args.algorithm, hash_size)
+    started = time.perf_counter()
+    indices, distances = nearest(target, corpus, args.threshold, args.limit)
+    elapsed = (time.perf_counter() - started) * 1000
+    for index, distance in zip(indices.tolist(), distances.tolist()):
+        print(f"{distance}\t{paths[index]}")
+    print(f"Searched {len(corpus)} hashes in {elapsed:.1f} ms", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()